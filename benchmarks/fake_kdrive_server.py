@@ -0,0 +1,590 @@
+"""
+Local stand-in for the kDrive API endpoints used by python-lib/infomaniak_client.py.
+
+Files live in memory. Synthetic files have no stored content: their bytes are generated
+on the fly, so that trees of 10^5 files stay cheap. Latency, page size and rate limit are
+configurable, and every request is counted per endpoint.
+"""
+import gzip
+import hashlib
+import json
+import re
+import threading
+import time
+import uuid
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+ID_PATH_TOKEN = re.compile(r"^(\d+|[0-9a-fA-F-]{16,})$")
+RANGE_HEADER = re.compile(r"^bytes=(\d+)-(\d*)$")
+MIN_COMPRESSED_SIZE = 1024
+
+
+class FakeDrive(object):
+    def __init__(self, drive_id=1000, root_id=1):
+        self.drive_id = str(drive_id)
+        self.root_id = root_id
+        self.lock = threading.RLock()
+        self.next_id = root_id + 1
+        self.files = {}
+        self.children = {}
+        self.contents = {}
+        self.upload_sessions = {}
+        self.activities = []
+        self.add_node(root_id, "Private", "dir", None)
+
+    def add_node(self, file_id, name, node_type, parent_id, size=0, last_modified_at=None):
+        node = {
+            "id": file_id,
+            "name": name,
+            "type": node_type,
+            "parent_id": parent_id,
+            "size": size if node_type == "file" else None,
+            "last_modified_at": int(last_modified_at or time.time()),
+            "status": None
+        }
+        self.files[file_id] = node
+        if node_type == "dir":
+            self.children[file_id] = []
+        if parent_id is not None:
+            self.children[parent_id].append(file_id)
+        return node
+
+    def create(self, parent_id, name, node_type, size=0, content=None, last_modified_at=None):
+        with self.lock:
+            existing = self.find_child(parent_id, name)
+            if existing is not None:
+                if node_type == "file" and existing["type"] == "file":
+                    existing["size"] = size
+                    existing["last_modified_at"] = int(last_modified_at or time.time())
+                    self.contents[existing["id"]] = content
+                    self.log_activity("file_update", existing)
+                    return existing
+                return None
+            file_id = self.next_id
+            self.next_id += 1
+            node = self.add_node(file_id, name, node_type, parent_id, size=size, last_modified_at=last_modified_at)
+            if content is not None:
+                self.contents[file_id] = content
+            self.log_activity("file_create", node)
+            return node
+
+    def log_activity(self, action, node):
+        self.activities.append({
+            "id": len(self.activities) + 1,
+            "action": action,
+            "created_at": int(time.time()),
+            "file_id": node["id"],
+            "parent_id": node["parent_id"]
+        })
+
+    def find_child(self, parent_id, name):
+        for child_id in self.children.get(parent_id, []):
+            if self.files[child_id]["name"] == name:
+                return self.files[child_id]
+        return None
+
+    def get_path(self, file_id):
+        # Full path from the drive's root folder, which is "/"
+        names = []
+        node = self.files[file_id]
+        while node["parent_id"] is not None:
+            names.append(node["name"])
+            node = self.files[node["parent_id"]]
+        return "/" + "/".join(reversed(names))
+
+    def get_content(self, file_id, first_byte=0, last_byte=None):
+        # Only the requested bytes are generated, so that concurrent range requests stay cheap
+        content = self.contents.get(file_id)
+        size = len(content) if content is not None else self.files[file_id]["size"] or 0
+        last_byte = size - 1 if last_byte is None else min(last_byte, size - 1)
+        if content is not None:
+            return content[first_byte:last_byte + 1]
+        pattern = "{}\n".format(file_id).encode("utf-8")
+        offset = first_byte % len(pattern)
+        length = max(0, last_byte - first_byte + 1)
+        return (pattern * ((offset + length) // len(pattern) + 1))[offset:offset + length]
+
+    def delete(self, file_id):
+        with self.lock:
+            node = self.files.get(file_id)
+            if node is None:
+                return 0
+            deleted_files = 0
+            for child_id in list(self.children.get(file_id, [])):
+                deleted_files += self.delete(child_id)
+            if node["parent_id"] is not None:
+                self.children[node["parent_id"]].remove(file_id)
+            self.files.pop(file_id)
+            self.children.pop(file_id, None)
+            self.contents.pop(file_id, None)
+            self.log_activity("file_delete", node)
+            return deleted_files + (1 if node["type"] == "file" else 0)
+
+    def move(self, file_id, destination_id):
+        with self.lock:
+            node = self.files[file_id]
+            self.children[node["parent_id"]].remove(file_id)
+            self.children[destination_id].append(file_id)
+            node["parent_id"] = destination_id
+            self.log_activity("file_move", node)
+            return node
+
+    def copy(self, file_id, destination_id, name=None):
+        with self.lock:
+            node = self.files[file_id]
+            copy = self.create(
+                destination_id, name or node["name"], node["type"],
+                size=node["size"] or 0,
+                content=self.contents.get(file_id),
+                last_modified_at=node["last_modified_at"]
+            )
+            if copy is None:
+                return None
+            if node["type"] == "file" and file_id not in self.contents:
+                # synthetic content depends on the id, the copy keeps the original bytes
+                self.contents[copy["id"]] = self.get_content(file_id)
+            for child_id in list(self.children.get(file_id, [])):
+                self.copy(child_id, copy["id"])
+            return copy
+
+    def rename(self, file_id, name):
+        with self.lock:
+            node = self.files[file_id]
+            node["name"] = name
+            self.log_activity("file_rename", node)
+            return node
+
+    def build_synthetic_tree(self, depth=3, folders_per_folder=10, files_per_folder=90, file_size=1024, parent_id=None):
+        # depth=3, 10 folders and 90 files per folder gives 1110 folders and 99900 files
+        parent_id = parent_id or self.root_id
+        with self.lock:
+            for file_index in range(files_per_folder):
+                self.create(parent_id, "file_{:05d}.csv".format(file_index), "file", size=file_size)
+            if depth <= 0:
+                return
+            for folder_index in range(folders_per_folder):
+                folder = self.create(parent_id, "folder_{:03d}".format(folder_index), "dir")
+                self.build_synthetic_tree(
+                    depth=depth - 1,
+                    folders_per_folder=folders_per_folder,
+                    files_per_folder=files_per_folder,
+                    file_size=file_size,
+                    parent_id=folder["id"]
+                )
+
+    def get_subtree_ids(self, folder_id):
+        subtree_ids = []
+        folder_ids = [folder_id]
+        while folder_ids:
+            child_ids = self.children.get(folder_ids.pop(0), [])
+            subtree_ids.extend(child_ids)
+            folder_ids.extend(child_id for child_id in child_ids if child_id in self.children)
+        return subtree_ids
+
+    def count_files(self, folder_id=None):
+        folder_id = folder_id or self.root_id
+        count = 0
+        for child_id in self.children.get(folder_id, []):
+            if self.files[child_id]["type"] == "dir":
+                count += self.count_files(child_id)
+            else:
+                count += 1
+        return count
+
+
+class FakeKdriveServer(object):
+    def __init__(self, drive=None, latency=0.0, max_page_size=1000, requests_per_second=None, bandwidth=None,
+                 supports_ranges=True, cut_downloads=0, host="127.0.0.1", port=0):
+        # The next cut_downloads downloads send half of their bytes, then close the connection
+        self.drive = drive or FakeDrive()
+        self.latency = latency
+        self.bandwidth = bandwidth
+        self.supports_ranges = supports_ranges
+        self.cut_downloads = cut_downloads
+        self.max_page_size = max_page_size
+        self.requests_per_second = requests_per_second
+        self.request_counts = {}
+        self.rate_limited_requests = 0
+        self.not_modified_responses = 0
+        self.counts_lock = threading.Lock()
+        self.rate_window_start = time.time()
+        self.rate_window_count = 0
+        handler = type("Handler", (FakeKdriveHandler,), {"fake_server": self})
+        self.http_server = FakeHTTPServer((host, port), handler)
+        self.http_server.daemon_threads = True
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.http_server.server_address[:2]
+        return "http://{}:{}".format(host, port)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.http_server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.http_server.shutdown()
+        self.http_server.server_close()
+
+    def count_request(self, method, path):
+        tokens = path.split("/")
+        tokens = tokens[:2] + ["{id}" if ID_PATH_TOKEN.match(token) else token for token in tokens[2:]]
+        endpoint_name = "{} {}".format(method, "/".join(tokens))
+        with self.counts_lock:
+            self.request_counts[endpoint_name] = self.request_counts.get(endpoint_name, 0) + 1
+
+    def is_rate_limited(self):
+        if not self.requests_per_second:
+            return False
+        with self.counts_lock:
+            now = time.time()
+            if now - self.rate_window_start >= 1:
+                self.rate_window_start = now
+                self.rate_window_count = 0
+            self.rate_window_count += 1
+            if self.rate_window_count > self.requests_per_second:
+                self.rate_limited_requests += 1
+                return True
+            return False
+
+    def take_download_cut(self):
+        with self.counts_lock:
+            if self.cut_downloads <= 0:
+                return False
+            self.cut_downloads -= 1
+            return True
+
+    def count_not_modified(self):
+        with self.counts_lock:
+            self.not_modified_responses += 1
+
+    def get_total_requests(self):
+        with self.counts_lock:
+            return sum(self.request_counts.values())
+
+    def reset_counts(self):
+        with self.counts_lock:
+            self.request_counts = {}
+            self.rate_limited_requests = 0
+            self.not_modified_responses = 0
+
+
+class FakeHTTPServer(ThreadingHTTPServer):
+    # The default backlog of 5 drops the connections of clients opening hundreds at once
+    request_queue_size = 1024
+
+
+class FakeKdriveHandler(BaseHTTPRequestHandler):
+    fake_server = None
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        self.dispatch("GET")
+
+    def do_POST(self):
+        self.dispatch("POST")
+
+    def do_DELETE(self):
+        self.dispatch("DELETE")
+
+    def dispatch(self, method):
+        parsed_url = urlparse(self.path)
+        path = parsed_url.path
+        self.query = {key: values[0] for key, values in parse_qs(parsed_url.query).items()}
+        self.body = self.read_body()
+        if path.startswith("/_benchmark/"):
+            return self.benchmark_control(method, path)
+        self.fake_server.count_request(method, path)
+        if self.fake_server.latency:
+            time.sleep(self.fake_server.latency)
+        if self.fake_server.is_rate_limited():
+            return self.send_json({"result": "error", "error": {"code": "too_many_requests"}}, status=429, headers={"Retry-After": "1"})
+        for route_method, pattern, handler_name in ROUTES:
+            match = re.match(pattern, path)
+            if route_method == method and match:
+                return getattr(self, handler_name)(*match.groups())
+        self.send_json({"result": "error", "error": {"code": "not_found"}}, status=404)
+
+    def benchmark_control(self, method, path):
+        # Not part of the kDrive API, lets a harness in another process read and reset the counters
+        if path == "/_benchmark/reset" and method == "POST":
+            self.fake_server.reset_counts()
+        self.send_json({
+            "total_requests": self.fake_server.get_total_requests(),
+            "request_counts": dict(self.fake_server.request_counts),
+            "rate_limited_requests": self.fake_server.rate_limited_requests,
+            "not_modified_responses": self.fake_server.not_modified_responses,
+            "files": self.drive.count_files(),
+            "folders": len(self.drive.children)
+        })
+
+    def read_body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        if not length:
+            return b""
+        return self.rfile.read(length)
+
+    def get_json_body(self):
+        if not self.body:
+            return {}
+        return json.loads(self.body.decode("utf-8"))
+
+    def send_json(self, payload, status=200, headers=None, with_etag=False):
+        # with_etag, the body is tagged with its hash and not sent again to a client that has it
+        body = json.dumps(payload).encode("utf-8")
+        headers = dict(headers or {})
+        if with_etag:
+            etag = '"{}"'.format(hashlib.sha1(body).hexdigest())
+            headers["ETag"] = etag
+            if self.headers.get("If-None-Match") == etag:
+                self.fake_server.count_not_modified()
+                self.send_response(304)
+                for header_name, header_value in headers.items():
+                    self.send_header(header_name, header_value)
+                self.end_headers()
+                return
+        if len(body) >= MIN_COMPRESSED_SIZE and "gzip" in (self.headers.get("Accept-Encoding") or ""):
+            body = gzip.compress(body, compresslevel=1)
+            headers["Content-Encoding"] = "gzip"
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        for header_name, header_value in headers.items():
+            self.send_header(header_name, header_value)
+        self.end_headers()
+        self.wfile.write(body)
+
+    def send_not_found(self):
+        self.send_json({"result": "error", "error": {"code": "object_not_found"}}, status=404)
+
+    @property
+    def drive(self):
+        return self.fake_server.drive
+
+    def list_files(self, drive_id, file_id):
+        file_id = int(file_id)
+        if file_id not in self.drive.children:
+            return self.send_not_found()
+        limit = min(int(self.query.get("limit", 10)), self.fake_server.max_page_size)
+        offset = int(self.query.get("cursor") or 0)
+        with self.drive.lock:
+            child_ids = self.drive.children[file_id][offset:offset + limit]
+            data = [self.drive.files[child_id] for child_id in child_ids]
+            has_more = offset + limit < len(self.drive.children[file_id])
+        self.send_json({
+            "result": "success",
+            "data": data,
+            "cursor": str(offset + limit),
+            "has_more": has_more
+        }, with_etag=True)
+
+    def search(self, drive_id):
+        # Only the directory_id / depth=unlimited form of the search is served
+        directory_id = int(self.query.get("directory_id") or self.drive.root_id)
+        if directory_id not in self.drive.children:
+            return self.send_not_found()
+        limit = min(int(self.query.get("limit", 10)), self.fake_server.max_page_size)
+        offset = int(self.query.get("cursor") or 0)
+        with self.drive.lock:
+            subtree_ids = self.drive.get_subtree_ids(directory_id)
+            data = [self.drive.files[file_id] for file_id in subtree_ids[offset:offset + limit]]
+        self.send_json({
+            "result": "success",
+            "data": data,
+            "cursor": str(offset + limit),
+            "has_more": offset + limit < len(subtree_ids)
+        })
+
+    def activities(self, drive_id):
+        from_date = int(self.query.get("from_date") or 0)
+        limit = min(int(self.query.get("limit", 10)), self.fake_server.max_page_size)
+        offset = int(self.query.get("cursor") or 0)
+        with self.drive.lock:
+            activities = [activity for activity in self.drive.activities if activity["created_at"] >= from_date]
+        self.send_json({
+            "result": "success",
+            "data": activities[offset:offset + limit],
+            "cursor": str(offset + limit),
+            "has_more": offset + limit < len(activities)
+        })
+
+    def get_file(self, drive_id, file_id):
+        node = self.drive.files.get(int(file_id))
+        if node is None:
+            return self.send_not_found()
+        if "path" in self.query.get("with", "").split(","):
+            node = dict(node, path=self.drive.get_path(node["id"]))
+        self.send_json({"result": "success", "data": node})
+
+    def download(self, drive_id, file_id):
+        file_id = int(file_id)
+        if file_id not in self.drive.files:
+            return self.send_not_found()
+        byte_range = RANGE_HEADER.match(self.headers.get("Range") or "")
+        if byte_range and self.fake_server.supports_ranges:
+            size = self.drive.files[file_id]["size"] or 0
+            first_byte = int(byte_range.group(1))
+            last_byte = min(int(byte_range.group(2) or size - 1), size - 1)
+            content = self.drive.get_content(file_id, first_byte, last_byte)
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(first_byte, last_byte, size))
+        else:
+            content = self.drive.get_content(file_id)
+            self.send_response(200)
+        self.send_header("Content-Type", "application/octet-stream")
+        self.send_header("Content-Length", str(len(content)))
+        self.end_headers()
+        if self.fake_server.take_download_cut():
+            self.wfile.write(content[:len(content) // 2])
+            self.close_connection = True
+            return
+        self.write_throttled(content)
+
+    def write_throttled(self, content):
+        # Caps each connection at the server's bandwidth, in bytes per second
+        if not self.fake_server.bandwidth:
+            return self.wfile.write(content)
+        block_size = 64 * 1024
+        for offset in range(0, len(content), block_size):
+            self.wfile.write(content[offset:offset + block_size])
+            time.sleep(float(block_size) / self.fake_server.bandwidth)
+
+    def upload(self, drive_id):
+        if self.is_upload_conflict(self.query):
+            return self.send_upload_conflict()
+        node = self.drive.create(
+            int(self.query.get("directory_id")),
+            self.query.get("file_name"),
+            "file",
+            size=len(self.body),
+            content=self.body,
+            last_modified_at=self.query.get("last_modified_at")
+        )
+        self.send_json({"result": "success", "data": node})
+
+    def start_upload_session(self, drive_id):
+        data = self.get_json_body()
+        if self.is_upload_conflict(data):
+            return self.send_upload_conflict()
+        token = uuid.uuid4().hex
+        self.drive.upload_sessions[token] = {"parameters": data, "chunks": {}}
+        self.send_json({"result": "success", "data": {"token": token, "upload_url": self.fake_server.url}})
+
+    def is_upload_conflict(self, parameters):
+        # As kDrive, an upload over an existing file fails unless its conflict mode says otherwise
+        directory_id = int(parameters.get("directory_id") or self.drive.root_id)
+        existing = self.drive.find_child(directory_id, parameters.get("file_name"))
+        return existing is not None and parameters.get("conflict") != "version"
+
+    def send_upload_conflict(self):
+        self.send_json({"result": "error", "error": {"code": "conflict_error"}}, status=400)
+
+    def upload_chunk(self, drive_id, token):
+        session = self.drive.upload_sessions.get(token)
+        if session is None:
+            return self.send_not_found()
+        session["chunks"][int(self.query.get("chunk_number"))] = self.body
+        self.send_json({"result": "success", "data": {"received_bytes": len(self.body)}})
+
+    def finish_upload_session(self, drive_id, token):
+        session = self.drive.upload_sessions.pop(token, None)
+        if session is None:
+            return self.send_not_found()
+        parameters = dict(session["parameters"], **self.get_json_body())
+        content = b"".join(session["chunks"][chunk_number] for chunk_number in sorted(session["chunks"]))
+        node = self.drive.create(
+            int(parameters.get("directory_id")),
+            parameters.get("file_name"),
+            "file",
+            size=len(content),
+            content=content,
+            last_modified_at=parameters.get("last_modified_at")
+        )
+        self.send_json({"result": "success", "data": {"file": node}})
+
+    def cancel_upload_session(self, drive_id, token):
+        self.drive.upload_sessions.pop(token, None)
+        self.send_json({"result": "success", "data": True})
+
+    def create_directory(self, drive_id, parent_id):
+        name = self.get_json_body().get("name")
+        node = self.drive.create(int(parent_id), name, "dir")
+        if node is None:
+            return self.send_json({"result": "error", "error": {"code": "destination_already_exists"}}, status=409)
+        self.send_json({"result": "success", "data": node})
+
+    def move(self, drive_id, file_id, destination_id):
+        if int(file_id) not in self.drive.files or int(destination_id) not in self.drive.children:
+            return self.send_not_found()
+        self.drive.move(int(file_id), int(destination_id))
+        self.send_json({"result": "success", "data": True})
+
+    def copy(self, drive_id, file_id, destination_id):
+        if int(file_id) not in self.drive.files or int(destination_id) not in self.drive.children:
+            return self.send_not_found()
+        copy = self.drive.copy(int(file_id), int(destination_id), name=self.get_json_body().get("name"))
+        if copy is None:
+            return self.send_json({"result": "error", "error": {"code": "destination_already_exists"}}, status=409)
+        self.send_json({"result": "success", "data": copy})
+
+    def rename(self, drive_id, file_id):
+        node = self.drive.files.get(int(file_id))
+        if node is None:
+            return self.send_not_found()
+        node = self.drive.rename(int(file_id), self.get_json_body().get("name"))
+        self.send_json({"result": "success", "data": node})
+
+    def bulk_action(self, drive_id):
+        data = self.get_json_body()
+        if data.get("action") != "trash":
+            return self.send_json({"result": "error", "error": {"code": "invalid_action"}}, status=400)
+        for file_id in data.get("file_ids", []):
+            self.drive.delete(int(file_id))
+        self.send_json({"result": "success", "data": True})
+
+    def delete(self, drive_id, file_id):
+        if int(file_id) not in self.drive.files:
+            return self.send_not_found()
+        self.drive.delete(int(file_id))
+        self.send_json({"result": "success", "data": True})
+
+
+ROUTES = [
+    ("GET", r"^/3/drive/(\d+)/files/search$", "search"),
+    ("GET", r"^/3/drive/(\d+)/activities$", "activities"),
+    ("GET", r"^/3/drive/(\d+)/files/(\d+)/files$", "list_files"),
+    ("GET", r"^/3/drive/(\d+)/files/(\d+)$", "get_file"),
+    ("GET", r"^/2/drive/(\d+)/files/(\d+)/download$", "download"),
+    ("POST", r"^/3/drive/(\d+)/upload$", "upload"),
+    ("POST", r"^/3/drive/(\d+)/upload/session/start$", "start_upload_session"),
+    ("POST", r"^/3/drive/(\d+)/upload/session/(\w+)/chunk$", "upload_chunk"),
+    ("POST", r"^/3/drive/(\d+)/upload/session/(\w+)/finish$", "finish_upload_session"),
+    ("DELETE", r"^/3/drive/(\d+)/upload/session/(\w+)$", "cancel_upload_session"),
+    ("POST", r"^/3/drive/(\d+)/files/(\d+)/directory$", "create_directory"),
+    ("POST", r"^/3/drive/(\d+)/files/(\d+)/move/(\d+)$", "move"),
+    ("POST", r"^/3/drive/(\d+)/files/(\d+)/copy/(\d+)$", "copy"),
+    ("POST", r"^/2/drive/(\d+)/files/(\d+)/rename$", "rename"),
+    ("POST", r"^/3/drive/(\d+)/files/bulk$", "bulk_action"),
+    ("DELETE", r"^/2/drive/(\d+)/files/(\d+)$", "delete"),
+]
+
+
+def serve_in_process(connection, tree_settings, server_settings):
+    # Target of a multiprocessing.Process, so that the server's memory and CPU stay out of the measurements
+    drive = FakeDrive()
+    drive.build_synthetic_tree(**tree_settings)
+    big_folder = drive.create(drive.root_id, "big", "dir")
+    drive.create(big_folder["id"], "big.bin", "file", size=server_settings.pop("big_file_size", 0))
+    # the synthetic tree is the starting state, not a change
+    del drive.activities[:]
+    server = FakeKdriveServer(drive=drive, **server_settings).start()
+    connection.send({"url": server.url, "drive_id": drive.drive_id, "root_id": drive.root_id})
+    connection.recv()
+    server.stop()
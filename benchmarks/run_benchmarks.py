@@ -0,0 +1,223 @@
+"""
+Runs the kDrive FSProvider against a local fake kDrive server and reports, for each
+operation, the number of API calls, the wall time and the peak Python memory.
+
+    python benchmarks/run_benchmarks.py --depth 3 --folders-per-folder 10 --files-per-folder 90 --latency 0.02
+"""
+import argparse
+import contextlib
+import importlib.util
+import json
+import multiprocessing
+import os
+import sys
+import time
+import tracemalloc
+import types
+from urllib.request import Request, urlopen
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+PLUGIN_DIR = os.path.dirname(BENCHMARKS_DIR)
+sys.path.insert(0, os.path.join(PLUGIN_DIR, "python-lib"))
+sys.path.insert(0, BENCHMARKS_DIR)
+
+from fake_kdrive_server import serve_in_process  # noqa: E402
+import infomaniak_client  # noqa: E402
+
+OPERATIONS = ["stat", "browse", "enumerate", "read", "write", "delete"]
+
+
+def load_provider_class():
+    try:
+        import dataiku.fsprovider  # noqa: F401
+    except ImportError:
+        # Outside of DSS, FSProvider is only needed as a base class
+        dataiku_module = types.ModuleType("dataiku")
+        fsprovider_module = types.ModuleType("dataiku.fsprovider")
+        fsprovider_module.FSProvider = object
+        dataiku_module.fsprovider = fsprovider_module
+        sys.modules["dataiku"] = dataiku_module
+        sys.modules["dataiku.fsprovider"] = fsprovider_module
+    provider_path = os.path.join(PLUGIN_DIR, "python-fs-providers", "infomaniak_kdrive", "fs-provider.py")
+    spec = importlib.util.spec_from_file_location("kdrive_fs_provider", provider_path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module.CustomFSProvider
+
+
+class CountingSink(object):
+    # Target stream for reads, counts the bytes without keeping them
+    def __init__(self):
+        self.size = 0
+
+    def write(self, data):
+        self.size += len(data)
+
+
+class PatternSource(object):
+    # Source stream for writes, generates the bytes instead of holding them
+    def __init__(self, size):
+        self.remaining = size
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.remaining
+        size = min(size, self.remaining)
+        self.remaining -= size
+        return b"x" * size
+
+
+class FakeServerProcess(object):
+    def __init__(self, tree_settings, server_settings):
+        self.connection, child_connection = multiprocessing.Pipe()
+        self.process = multiprocessing.Process(
+            target=serve_in_process,
+            args=(child_connection, tree_settings, server_settings),
+            daemon=True
+        )
+        self.process.start()
+        self.settings = self.connection.recv()
+        self.url = self.settings["url"]
+
+    def control(self, action):
+        method = "POST" if action == "reset" else "GET"
+        request = Request("{}/_benchmark/{}".format(self.url, action), data=b"" if method == "POST" else None, method=method)
+        with urlopen(request) as response:
+            return json.loads(response.read().decode("utf-8"))
+
+    def stop(self):
+        self.connection.send("stop")
+        self.process.join(10)
+
+
+def build_provider(provider_class, server, extra_config=None):
+    config = {
+        "api_token": {"api_token": "benchmark-token"},
+        "root_url": "https://ksuite.infomaniak.com/kdrive/app/drive/{}/files/{}".format(
+            server.settings["drive_id"],
+            server.settings["root_id"]
+        )
+    }
+    config.update(extra_config or {})
+    return provider_class("", config, {})
+
+
+def measure(server, name, function):
+    server.control("reset")
+    tracemalloc.start()
+    start = time.time()
+    error = None
+    try:
+        function()
+    except Exception as exception:
+        error = "{}".format(exception)
+    wall_time = time.time() - start
+    _, peak_memory = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    stats = server.control("stats")
+    return {
+        "operation": name,
+        "api_calls": stats["total_requests"],
+        "wall_time_s": round(wall_time, 3),
+        "peak_memory_mb": round(peak_memory / (1024.0 * 1024.0), 2),
+        "rate_limited": stats["rate_limited_requests"],
+        "not_modified": stats["not_modified_responses"],
+        "endpoints": stats["request_counts"],
+        "error": error
+    }
+
+
+def run(arguments):
+    tree_settings = {
+        "depth": arguments.depth,
+        "folders_per_folder": arguments.folders_per_folder,
+        "files_per_folder": arguments.files_per_folder,
+        "file_size": arguments.file_size
+    }
+    server_settings = {
+        "latency": arguments.latency,
+        "max_page_size": arguments.page_size,
+        "requests_per_second": arguments.rate_limit,
+        "bandwidth": arguments.bandwidth,
+        "supports_ranges": not arguments.no_ranges,
+        "big_file_size": arguments.big_file_size
+    }
+    server = FakeServerProcess(tree_settings, server_settings)
+    # the provider has no API URL setting, the plugin's default one is pointed at the fake server
+    infomaniak_client.DEFAULT_API_URL = server.url
+    provider_class = load_provider_class()
+    config = json.loads(arguments.config) if arguments.config else {}
+    deep_file = "/".join(["folder_000"] * arguments.depth + ["file_00000.csv"])
+    results = []
+    try:
+        tree = server.control("stats")
+        for repeat in range(arguments.repeat):
+            provider = build_provider(provider_class, server, config)
+            scenarios = {
+                "stat": lambda: provider.stat(deep_file),
+                "browse": lambda: provider.browse("/".join(["folder_000"] * arguments.depth)),
+                "enumerate": lambda: provider.enumerate("/", False),
+                "read": lambda: provider.read("big/big.bin", CountingSink(), -1),
+                "write": lambda: provider.write("written/{}/big.bin".format(repeat), PatternSource(arguments.big_file_size)),
+                # a different folder on each repeat, the last ones so that the other scenarios keep their files
+                "delete": lambda: provider.delete_recursive("folder_{:03d}".format(arguments.folders_per_folder - 1 - repeat))
+            }
+            for operation in arguments.operations:
+                result = measure(server, operation, scenarios[operation])
+                result["repeat"] = repeat
+                results.append(result)
+                if operation == "stat":
+                    results.append(dict(measure(server, "stat (warm)", scenarios[operation]), repeat=repeat))
+            provider.close()
+    finally:
+        server.stop()
+    return {
+        "tree": {"files": tree["files"], "folders": tree["folders"]},
+        "settings": vars(arguments),
+        "results": results
+    }
+
+
+def print_report(report):
+    print("Tree: {files} files, {folders} folders".format(**report["tree"]))
+    print("{:<14} {:>6} {:>10} {:>10} {:>10} {:>12}  {}".format("operation", "repeat", "api calls", "wall (s)", "peak (MB)", "rate limited", "error"))
+    for result in report["results"]:
+        print("{:<14} {:>6} {:>10} {:>10} {:>10} {:>12}  {}".format(
+            result["operation"],
+            result["repeat"],
+            result["api_calls"],
+            result["wall_time_s"],
+            result["peak_memory_mb"],
+            result["rate_limited"],
+            result["error"] or ""
+        ))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the kDrive FSProvider against a local fake kDrive")
+    parser.add_argument("--depth", type=int, default=2)
+    parser.add_argument("--folders-per-folder", type=int, default=10)
+    parser.add_argument("--files-per-folder", type=int, default=20)
+    parser.add_argument("--file-size", type=int, default=1024)
+    parser.add_argument("--big-file-size", type=int, default=20 * 1024 * 1024)
+    parser.add_argument("--latency", type=float, default=0.01, help="Seconds added to every request")
+    parser.add_argument("--page-size", type=int, default=1000, help="Largest page the server returns")
+    parser.add_argument("--rate-limit", type=int, default=None, help="Requests per second before answering 429")
+    parser.add_argument("--bandwidth", type=int, default=None, help="Bytes per second per download connection")
+    parser.add_argument("--no-ranges", action="store_true", help="Ignore the Range header on downloads")
+    parser.add_argument("--operations", nargs="+", choices=OPERATIONS, default=OPERATIONS)
+    parser.add_argument("--repeat", type=int, default=1)
+    parser.add_argument("--config", help="JSON provider settings, for instance '{\"enumerate_threads\": 16}'")
+    parser.add_argument("--json", action="store_true", help="Print the raw report as JSON")
+    arguments = parser.parse_args()
+    with contextlib.redirect_stdout(sys.stderr):
+        # keeps whatever the plugin prints out of the report
+        report = run(arguments)
+    if arguments.json:
+        print(json.dumps(report, indent=2))
+    else:
+        print_report(report)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,7 +1,28 @@
 from dataiku.fsprovider import FSProvider
-from infomaniak_client import KdriveClient, Item
-import os, shutil
-from io import BytesIO
+from infomaniak_client import KdriveClient, MAX_REMEMBERED_CHILDREN
+from infomaniak_auth import get_token_fingerprint
+from async_client import get_async_bridge
+from metadata_index import MetadataIndex, get_index_path
+from content_cache import ContentCache
+from kdrive_walker import FolderWalker, SearchWalker
+from retry_policy import RetryPolicy
+from metrics import Metrics, timed_operation
+from upload_queue import UploadQueue, PrefixedStream, read_up_to
+from safe_logger import SafeLogger, configure_logging, parse_component_levels
+import functools
+import json
+import os
+
+logger = SafeLogger("kDrive provider")
+
+
+def after_pending_uploads(method):
+    # So that reads and changes of the tree see the files written before them
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        self.sync()
+        return method(self, *args, **kwargs)
+    return wrapper
 
 
 class CustomFSProvider(FSProvider):
@@ -15,12 +36,62 @@ class CustomFSProvider(FSProvider):
             root = root[1:]
         self.root = root
         self.provider_root = "/"
+        configure_logging(
+            level=config.get("log_level") or "INFO",
+            component_levels=parse_component_levels(config.get("component_log_levels")),
+            rate_limit=get_int_parameter(config, "log_rate_limit", 10)
+        )
         root_url = config.get("root_url")
 
         auth = config.get("api_token", {})
         api_token = auth.get("api_token")
-        self.client = KdriveClient(api_token=api_token)
+        self.metrics = Metrics()
+        self.metrics.register_summary_hook(log_metrics_summary)
+        self.client = KdriveClient(
+            api_token=api_token,
+            metrics=self.metrics,
+            cache_ttl=get_int_parameter(config, "path_cache_ttl", 60),
+            cache_max_size=get_int_parameter(config, "path_cache_max_size", 10000),
+            cache_max_listing_entries=get_int_parameter(config, "path_cache_max_listing_entries", 100000),
+            download_chunk_size=get_int_parameter(config, "download_chunk_size", 1024) * 1024,
+            download_part_size=get_int_parameter(config, "download_part_size", 8) * 1024 * 1024,
+            download_threads=get_int_parameter(config, "download_threads", 4),
+            delete_threads=get_int_parameter(config, "delete_threads", 8),
+            upload_chunk_size=get_int_parameter(config, "upload_chunk_size", 10) * 1024 * 1024,
+            upload_threads=get_int_parameter(config, "upload_threads", 4),
+            page_size=get_int_parameter(config, "listing_page_size", 1000),
+            retry_policy=RetryPolicy(
+                max_retries=get_int_parameter(config, "max_retries", 5),
+                backoff_base=get_float_parameter(config, "retry_backoff_base", 1.0),
+                max_backoff=get_float_parameter(config, "retry_max_backoff", 60.0)
+            ),
+            requests_per_second=get_float_parameter(config, "requests_per_second", 0),
+            requests_burst=get_int_parameter(config, "requests_burst", 0),
+            http_pool_size=get_int_parameter(config, "http_pool_size", 32),
+            keep_alive_idle=get_int_parameter(config, "keep_alive_idle", 60),
+            use_http2=config.get("use_http2", False),
+            connect_timeout=get_float_parameter(config, "connect_timeout", 30.0),
+            read_timeout=get_float_parameter(config, "read_timeout", 300.0),
+            known_paths_ttl=get_int_parameter(config, "known_paths_ttl", 3600),
+            http_cache_size=get_int_parameter(config, "http_cache_size", 32) * 1024 * 1024,
+            metadata_index=get_metadata_index(config, api_token),
+            content_cache=get_content_cache(config, api_token)
+        )
+        self.client.use_async_bridge(
+            get_async_bridge(api_token, self.client, get_int_parameter(config, "async_requests", 0))
+        )
         self.drive_id, self.root_file_id = extract_id_from_url(root_url)
+        self.client.refresh_metadata_index(self.drive_id)
+        self.enumerate_threads = get_int_parameter(config, "enumerate_threads", 8)
+        self.enumerate_requests_per_second = get_int_parameter(config, "enumerate_requests_per_second", 0)
+        self.use_search_for_enumerate = config.get("use_search_for_enumerate", False)
+        self.browse_limit = get_int_parameter(config, "browse_limit", 0)
+        # Background uploads are opted in with async_upload_threads, since their errors only come up later.
+        # Without them, the queue runs the uploads in the provider's thread
+        self.upload_queue = UploadQueue(
+            max_workers=get_int_parameter(config, "async_upload_threads", 0),
+            max_pending_bytes=get_int_parameter(config, "async_upload_memory", 256) * 1024 * 1024
+        )
 
 
     # util methods
@@ -41,20 +112,38 @@ class CustomFSProvider(FSProvider):
         path_elts = [e for e in path_elts if len(e) > 0]
         return os.path.join(*path_elts)
 
+    def remember_path(self, path, file_id):
+        # So that later calls on this path can look the item up by id instead of listing its parents
+        self.client.remember_path(self.drive_id, self.root_file_id, self.get_full_path(path).strip("/"), file_id)
+
     def close(self):
         """
         Perform any necessary cleanup
         """
-        print('close')
+        try:
+            if self.upload_queue:
+                self.upload_queue.close()
+                self.upload_queue = None
+        finally:
+            self.metrics.publish(self.client.get_metrics_summary())
+            self.client.close()
+
+    def sync(self):
+        """
+        Wait for the queued uploads, raising if any of them failed
+        """
+        if self.upload_queue:
+            self.upload_queue.flush()
 
+    @timed_operation("stat")
+    @after_pending_uploads
     def stat(self, path):
         """
         Get the info about the object at the given path inside the provider's root, or None 
         if the object doesn't exist
         """
         full_path = self.get_full_path(path)
-        print("stat:full_path={}".format(full_path)) # :stat:full_path=/first/second/outside.png
-        # why :stat:full_path=/first/interpolated2.png/interpolated2.png ?
+        logger.debug("stat:full_path={}", full_path)
         item = self.client.get_item(self.drive_id, self.root_file_id, full_path.strip("/"), self.get_lnt_path(path).strip("/"))
         if not item.exists():
             return None
@@ -89,20 +178,30 @@ class CustomFSProvider(FSProvider):
         # else:
         #     return {'path': self.get_lnt_path(path), 'size':os.path.getsize(full_path), 'lastModified':int(os.path.getmtime(full_path)) * 1000, 'isDirectory':False}
 
+    @timed_operation("set_last_modified")
     def set_last_modified(self, path, last_modified):
         """
         Set the modification time on the object denoted by path. Return False if not possible
         """
         full_path = self.get_full_path(path)
-        os.utime(full_path, (os.path.getatime(full_path), last_modified / 1000))
-        return True
+        last_modified_at = int(last_modified / 1000)
+        # kDrive only sets modification times on upload: possible for the file just written, whose last request is staged
+        if self.upload_queue and self.upload_queue.update_staged(full_path, last_modified_at=last_modified_at):
+            return True
+        self.sync()
+        item = self.client.get_item(self.drive_id, self.root_file_id, full_path.strip("/"), self.get_lnt_path(path).strip("/"))
+        if not item.exists():
+            return False
+        return int(item.descriptor.get("last_modified_at") or 0) == last_modified_at
 
+    @timed_operation("browse")
+    @after_pending_uploads
     def browse(self, path):
         """
         List the file or directory at the given path, and its children (if directory)
         """
         full_path = self.get_full_path(path)
-        print("browse:full_path={}, self.drive_id={}, self.root_file_id={}".format(full_path, self.drive_id, self.root_file_id))
+        logger.debug("browse:full_path={}, drive_id={}, root_file_id={}", full_path, self.drive_id, self.root_file_id)
         item = self.client.get_item(self.drive_id, self.root_file_id, full_path.strip("/"), self.get_lnt_path(path).strip("/"))
         if not item.exists():
             ret = {'fullPath' : None, 'exists' : False}
@@ -112,10 +211,15 @@ class CustomFSProvider(FSProvider):
             return ret
         else:
             children = []
-            for child in item.get_next_child():
-                children.append(
-                    child
-                )
+            # paths of the children are remembered below the folder's full path, built once
+            folder_full_path = self.get_full_path(item.path + "/").strip("/")
+            child_path_prefix = folder_full_path + "/" if folder_full_path else ""
+            for child in item.get_next_child(limit=self.browse_limit or None):
+                if len(children) < MAX_REMEMBERED_CHILDREN:
+                    self.client.remember_path(self.drive_id, self.root_file_id, child_path_prefix + child.name, child.id)
+                children.append(child.to_dict(item.path))
+            if self.browse_limit and len(children) >= self.browse_limit:
+                logger.info("Browsing of '{}' limited to {} children", full_path, len(children))
             ret = {
                 'fullPath' : self.get_lnt_path(path),
                 'exists' : True,
@@ -124,6 +228,8 @@ class CustomFSProvider(FSProvider):
             }
             return ret
 
+    @timed_operation("enumerate")
+    @after_pending_uploads
     def enumerate(self, path, first_non_empty):
         """
         Enumerate files recursively from prefix. If first_non_empty, stop at the first non-empty file.
@@ -131,7 +237,7 @@ class CustomFSProvider(FSProvider):
         If the prefix doesn't denote a file or folder, return None
         """
         full_path = self.get_full_path(path)
-        print("enumerate:full_path={}".format(full_path))
+        logger.debug("enumerate:full_path={}", full_path)
         item = self.client.get_item(self.drive_id, self.root_file_id, full_path.strip("/"), self.get_lnt_path(path).strip("/"))
         if not item.exists():
             return None
@@ -150,110 +256,172 @@ class CustomFSProvider(FSProvider):
 
     def list_recursive(self, folder_item, path, full_path, first_non_empty):
         paths = []
-        print("list_recursive={}/{}".format(path, full_path))
-        for child in folder_item.get_next_child():
-            if child.get("directory"):
-                new_paths = self.list_recursive(
-                    Item(self.client, self.drive_id, path, child),
-                    self.get_lnt_path(os.path.join(path, child.get("name"))),
-                    self.get_lnt_path(os.path.join(full_path, child.get("name"))),
-                    first_non_empty
-                )
-                paths.extend(
-                    new_paths
-                )
-            else:
-                full_sub_path = os.path.join(path, child.get("name"))
-                sub_path = full_sub_path[len(os.path.join(self.provider_root, self.root)):]
-                paths.append(
-                    {
-                        'path': self.get_lnt_path(full_sub_path),
-                        'size': child.get("size"),
-                        'lastModified': child.get("lastModified")
-                    }
-                )
-            # {
-            #     "name": item.get("name"),
-            #     "lastModified": int(item.get("last_modified_at")) * 1000,
-            #     "size": self.get_size(item=item),
-            #     "fullPath": "/".join([self.path, item.get("name")]),
-            #     "directory": item.get("type")=="dir"
-            # }
+        for item in self.get_next_file_below(folder_item, path, first_non_empty):
+            self.remember_path(item.path, item.get_file_id())
+            item_description = item.get_description()
+            paths.append(
+                {
+                    'path': self.get_lnt_path(item.path),
+                    'size': item_description.get("size"),
+                    'lastModified': item_description.get("lastModified")
+                }
+            )
         return paths
 
+    def get_next_file_below(self, folder_item, path, first_non_empty):
+        if self.use_search_for_enumerate:
+            try:
+                search_walker = SearchWalker(self.client, self.drive_id)
+                return search_walker.walk(folder_item.get_file_id(), path, first_non_empty=first_non_empty)
+            except Exception as error:
+                logger.warning("Search based enumeration failed ({}), listing folders one by one", error)
+        walker = FolderWalker(
+            self.client,
+            self.drive_id,
+            max_workers=self.enumerate_threads,
+            max_requests_per_second=self.enumerate_requests_per_second
+        )
+        return walker.walk(folder_item.get_file_id(), path, first_non_empty=first_non_empty)
+
+    @timed_operation("delete_recursive")
+    @after_pending_uploads
     def delete_recursive(self, path):
         """
         Delete recursively from path. Return the number of deleted files (optional)
         """
         full_path = self.get_full_path(path)
-        print("delete_recursive:full_path={}".format(full_path)) # :delete_recursive:full_path=/first/Screenshot 2025-03-06 at 16.07.27.png
+        logger.debug("delete_recursive:full_path={}", full_path)
         item = self.client.get_item(self.drive_id, self.root_file_id, full_path.strip("/"), self.get_lnt_path(path).strip("/"))
         if not item.exists():
             return 0
-        else:
+        if item.is_file():
             item.delete()
             return 1
-        # if not os.path.exists(full_path):
-        #     return 0
-        # elif os.path.isfile(full_path):
-        #     os.remove(full_path)
-        #     return 1
-        # else:
-        #     shutil.rmtree(full_path)
-        #     return 0
+        deleted_files = len(self.get_next_file_below(item, path, False))
+        if full_path.strip("/"):
+            item.delete()
+        else:
+            # the connection's root folder is kept, only its content goes
+            self.client.delete_items(self.drive_id, [child.id for child in item.get_next_child()])
+        return deleted_files
 
+    @timed_operation("move")
+    @after_pending_uploads
     def move(self, from_path, to_path):
         """
         Move a file or folder to a new path inside the provider's root. Return false if the moved file didn't exist
         """
+        item_from, destination_folder_id, file_name = self.resolve_relocation(from_path, to_path)
+        if not item_from.exists():
+            return False
+        new_name = file_name if file_name != item_from.get_file_name() else None
+        if are_files_in_same_path(self.get_full_path(from_path), self.get_full_path(to_path)):
+            if new_name:
+                self.client.rename(self.drive_id, item_from.get_file_id(), new_name)
+        else:
+            self.client.move_item(self.drive_id, item_from.get_file_id(), destination_folder_id, new_name=new_name)
+        self.remember_path(to_path, item_from.get_file_id())
+        return True
+
+    @timed_operation("copy")
+    @after_pending_uploads
+    def copy(self, from_path, to_path):
+        """
+        Copy a file or folder to a new path inside the provider's root, on the server side. Return false if the copied file didn't exist
+        """
+        item_from, destination_folder_id, file_name = self.resolve_relocation(from_path, to_path)
+        if not item_from.exists():
+            return False
+        copy = self.client.copy_item(self.drive_id, item_from.get_file_id(), destination_folder_id, new_name=file_name)
+        if copy:
+            self.remember_path(to_path, copy.get("id"))
+        return True
+
+    def resolve_relocation(self, from_path, to_path):
+        # Returns the source item, the destination folder id and the destination name.
+        # Both paths resolve through the same path cache, so their common ancestors are listed once,
+        # and the missing destination folders are created
         full_from_path = self.get_full_path(from_path)
         full_to_path = self.get_full_path(to_path)
-        if are_files_in_same_path(full_from_path, full_to_path):
-            # simple rename
-            _, file_name = os.path.split(full_to_path)
-            item_to_rename = self.client.get_item(self.drive_id, self.root_file_id, full_from_path.strip("/"), self.get_lnt_path(full_from_path).strip("/"))
-            if not item_to_rename.exists():
-                return False
-            self.client.rename(self.drive_id, item_to_rename.get_file_id(), file_name)
-            return True
-        else:
-            # move into new dir
-            item_from = self.client.get_item(self.drive_id, self.root_file_id, full_from_path.strip("/"), self.get_lnt_path(full_from_path).strip("/"))
-            destination_path, _ = os.path.split(full_to_path)
-            item_to = self.client.get_item(self.drive_id, self.root_file_id, destination_path.strip("/"), self.get_lnt_path(destination_path).strip("/"))
-            self.client.move_item(self.drive_id, item_from.get_file_id(), item_to.get_file_id())
-            return True
+        item_from = self.client.get_item(self.drive_id, self.root_file_id, full_from_path.strip("/"), self.get_lnt_path(from_path).strip("/"))
+        destination_path, file_name = os.path.split(full_to_path)
+        if not item_from.exists():
+            return item_from, None, file_name
+        destination_folder_id = self.client.make_dirs(self.drive_id, self.root_file_id, destination_path)
+        return item_from, destination_folder_id, file_name
 
+    @timed_operation("read")
+    @after_pending_uploads
     def read(self, path, stream, limit):
         """
         Read the object denoted by path into the stream. Limit is an optional bound on the number of bytes to send
         """
         full_path = self.get_full_path(path)
-        print("read:full_path={}".format(full_path)) # :read:full_path=/first/second/outside.png
+        logger.debug("read:full_path={}", full_path)
         item = self.client.get_item(self.drive_id, self.root_file_id, full_path.strip("/"), self.get_lnt_path(path).strip("/"))
         if not item.exists():
             raise Exception('Path doesn t exist')
-        response = self.client.get_file_content(self.drive_id, item.get_file_id())
-        bio = BytesIO(response.content)
-        shutil.copyfileobj(bio, stream)
+        self.client.read_file_to_stream(self.drive_id, item.descriptor, stream, limit=limit)
+
+    def make_dirs(self, paths):
+        """
+        Create the folders of a known layout in one pass, before writing many files into them
+        """
+        full_paths = [self.get_full_path(path) for path in paths]
+        self.client.make_dirs_batch(self.drive_id, self.root_file_id, full_paths, max_workers=self.enumerate_threads)
 
+    @timed_operation("write")
     def write(self, path, stream):
         """
         Write the stream to the object denoted by path into the stream
         """
         full_path = self.get_full_path(path)
-        print("write:full_path={}".format(full_path))
+        logger.debug("write:full_path={}", full_path)
         full_path_parent = os.path.dirname(full_path)
-        item = self.client.get_item(self.drive_id, self.root_file_id, full_path_parent.strip("/"), self.get_lnt_path(full_path_parent).strip("/"), create_folder=True)
-        parent_folder_id = item.get_file_id()
-        #if not item.exists():
-        #    print("doesn't exists, creating")
-        #    parent_folder_id = self.client.make_dirs(self.drive_id, self.root_file_id, full_path_parent)
-        bio = BytesIO()
-        shutil.copyfileobj(stream, bio)
-        bio.seek(0)
-        data = bio.read()
-        response = self.client.write_file_content(self.drive_id, parent_folder_id, full_path, data)
+        parent_folder_id = self.client.make_dirs(self.drive_id, self.root_file_id, full_path_parent)
+        # The last request of the upload is staged, so that set_last_modified can still add the time to it.
+        # Small files are read now and sent with that request, the chunks of the others right away
+        data = read_up_to(stream, self.client.upload_chunk_size + 1)
+        if len(data) <= self.client.upload_chunk_size:
+            function, args = self.client.write_file_content, (self.drive_id, parent_folder_id, full_path, data)
+        else:
+            function, args = self.client.prepare_upload(
+                self.drive_id, parent_folder_id, full_path, PrefixedStream(data, stream)
+            )
+            data = b""
+        self.upload_queue.stage(full_path, len(data), self.metrics.with_current_operation(function), *args)
+
+
+def log_metrics_summary(summary):
+    logger.info("API usage summary: {}", json.dumps(summary, sort_keys=True))
+
+
+def get_metadata_index(config, api_token):
+    index_directory = config.get("metadata_index_directory")
+    if not index_directory:
+        return None
+    try:
+        return MetadataIndex(
+            get_index_path(index_directory, get_token_fingerprint(api_token)),
+            max_age=get_int_parameter(config, "metadata_index_max_age", 86400)
+        )
+    except Exception as error:
+        logger.warning("Metadata index disabled, could not open it in '{}': {}", index_directory, error)
+        return None
+
+
+def get_content_cache(config, api_token):
+    cache_directory = config.get("content_cache_directory")
+    if not cache_directory:
+        return None
+    try:
+        return ContentCache(
+            os.path.join(cache_directory, get_token_fingerprint(api_token)[:16]),
+            max_size=get_int_parameter(config, "content_cache_max_size", 1024) * 1024 * 1024
+        )
+    except Exception as error:
+        logger.warning("Content cache disabled, could not use '{}': {}", cache_directory, error)
+        return None
 
 
 def extract_id_from_url(url):
@@ -266,6 +434,20 @@ def extract_id_from_url(url):
         file_id = tokens[-1:][0]
     return drive_id, file_id
 
+def get_int_parameter(config, parameter_name, default_value):
+    value = config.get(parameter_name)
+    if value is None or value == "":
+        return default_value
+    return int(value)
+
+
+def get_float_parameter(config, parameter_name, default_value):
+    value = config.get(parameter_name)
+    if value is None or value == "":
+        return default_value
+    return float(value)
+
+
 def are_files_in_same_path(path_one, path_two):
     file_path_one, _ = os.path.split(path_one)
     file_path_two, _ = os.path.split(path_two)
@@ -1,136 +1,176 @@
+import logging
 import requests
-from safe_logger import SafeLogger
+import time
+from concurrent.futures import ThreadPoolExecutor
+from http_cache import get_cache_key, get_conditional_headers, get_cached_response
+from retry_policy import RetryPolicy
+from safe_logger import SafeLogger, truncate
 
 
 logger = SafeLogger("api-client", forbidden_keys=["Authorization"])
 
+DEFAULT_CONNECT_TIMEOUT = 30
+DEFAULT_READ_TIMEOUT = 300
+
 
 class APIClient():
-    def __init__(self, server_url, auth, pagination=None, max_number_of_retries=None, should_fail_silently=False):
-        self.session = requests.Session()
+    def __init__(self, server_url, auth, pagination=None, max_number_of_retries=None, should_fail_silently=False,
+                 retry_policy=None, rate_limiter=None, session=None, metrics=None, http_cache=None, timeout=None):
+        # timeout is (connect, read) in seconds, so that a stalled connection ends in an error the policy can retry
+        if session is None:
+            session = requests.Session()
+            session.auth = auth
+        self.session = session
         self.server_url = server_url
-        self.session.auth = auth
-        self.number_of_retries = None
         self.page_offset = None
         self.pagination = pagination or DefaultPagination()
         self.max_number_of_retries = max_number_of_retries or 1
+        self.retry_policy = retry_policy or RetryPolicy(max_retries=self.max_number_of_retries - 1)
+        self.rate_limiter = rate_limiter
+        self.metrics = metrics
+        self.http_cache = http_cache
         self.should_fail_silently = should_fail_silently
+        self.timeout = timeout or (DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT)
 
-    def get(self, endpoint, url=None, params=None, raw=False):
-        if url:
-            full_url = url
-        else:
-            full_url = self.get_full_url(endpoint)
-        response = None
-        while self.should_try_again(response):
-            try:
-                logger.info("geting url={}, params={}".format(full_url, params))
-                response = self.session.get(full_url, params=params)
-            except Exception as error:
-                error_message = "Error on get: {}".format(error)
-                logger.error(error_message)
-                self.raise_if_necessary(error_message)
-        display_response_error(response)
-        if raw:
-            return response
-        json_response = response.json()
-        return json_response
+    def get(self, endpoint, url=None, params=None, headers=None, raw=False, stream=False):
+        return self.request("GET", endpoint, url=url, params=params, headers=headers, raw=raw, stream=stream)
 
-    def post(self, endpoint, url=None, params=None, json=None, data=None, headers=None, raw=False):
-        if url:
-            full_url = url
-        else:
-            full_url = self.get_full_url(endpoint)
-        response = self.session.post(
-            full_url,
-            params=params,
-            json=json,
-            data=data,
-            headers=headers
+    def post(self, endpoint, url=None, params=None, json=None, data=None, headers=None, raw=False, idempotent=None):
+        return self.request(
+            "POST", endpoint, url=url, params=params, json=json, data=data, headers=headers, raw=raw,
+            idempotent=idempotent
         )
-        display_response_error(response)
-        if raw:
-            return response
-        json_response = response.json()
-        return json_response
 
     def patch(self, endpoint, url=None, params=None, json=None, data=None, headers=None, raw=False):
-        if url:
-            full_url = url
-        else:
-            full_url = self.get_full_url(endpoint)
-        response = self.session.patch(
-            full_url,
-            params=params,
-            json=json,
-            data=data,
-            headers=headers
-        )
-        display_response_error(response)
-        if raw:
-            return response
-        json_response = response.json()
-        return json_response
+        return self.request("PATCH", endpoint, url=url, params=params, json=json, data=data, headers=headers, raw=raw)
 
     def delete(self, endpoint, url=None, params=None, json=None, data=None, headers=None, raw=False):
+        return self.request("DELETE", endpoint, url=url, params=params, json=json, data=data, headers=headers, raw=raw)
+
+    def request(self, method, endpoint, url=None, raw=False, idempotent=None, **kwargs):
+        # idempotent=True lets the retry policy resend a POST that is safe to send twice
         if url:
             full_url = url
         else:
             full_url = self.get_full_url(endpoint)
-        response = self.session.delete(
-            full_url,
-            params=params,
-            json=json,
-            data=data,
-            headers=headers
-        )
+        kwargs.setdefault("timeout", self.timeout)
+        cache_key = cache_entry = None
+        if self.is_cacheable(method, kwargs):
+            cache_key = get_cache_key(full_url, kwargs.get("params"))
+            cache_entry = self.http_cache.get(cache_key)
+            if cache_entry is not None:
+                kwargs["headers"] = get_conditional_headers(cache_entry, kwargs.get("headers"))
+        attempt = 0
+        while True:
+            attempt += 1
+            response = error = None
+            if self.rate_limiter:
+                self.rate_limiter.acquire()
+            start = time.time()
+            try:
+                logger.debug("{} url={}, params={}", method, full_url, kwargs.get("params"))
+                response = self.session.request(method, full_url, **kwargs)
+            except Exception as request_error:
+                error = request_error
+                logger.error("Error on {}: {}", method, error)
+            if self.metrics:
+                self.record_request_metrics(method, full_url, response, time.time() - start, kwargs.get("stream"))
+            if not self.retry_policy.should_retry(
+                    attempt, method=method, response=response, error=error, idempotent=idempotent):
+                break
+            delay = self.retry_policy.get_delay(attempt, response=response)
+            if self.rate_limiter and response is not None and response.status_code == 429:
+                self.rate_limiter.block_for(delay)
+            logger.warning("Retry {} of {} {} in {:.1f}s", attempt, method, full_url, delay)
+            if self.metrics:
+                self.metrics.record_retry()
+            if response is not None:
+                response.close()
+            time.sleep(delay)
+        if response is None:
+            self.raise_if_necessary("Error on {}: {}".format(method, error))
+            return None
+        if cache_key is not None:
+            response = self.use_http_cache(cache_key, cache_entry, response)
         display_response_error(response)
         if raw:
             return response
         json_response = response.json()
         return json_response
 
+    def is_cacheable(self, method, kwargs):
+        # Streamed and partial downloads are never kept
+        if self.http_cache is None or method != "GET" or kwargs.get("stream"):
+            return False
+        return "Range" not in (kwargs.get("headers") or {})
+
+    def use_http_cache(self, cache_key, cache_entry, response):
+        is_hit = cache_entry is not None and response.status_code == 304
+        if is_hit:
+            response = get_cached_response(cache_entry, response)
+        else:
+            self.http_cache.store(cache_key, response)
+        if self.metrics:
+            self.metrics.record_cache("http_cache", is_hit)
+        return response
+
+    def record_request_metrics(self, method, url, response, seconds, stream):
+        status_code = bytes_in = bytes_out = 0
+        if response is not None:
+            status_code = response.status_code
+            if not stream:
+                bytes_in = len(response.content or b"")
+            request = getattr(response, "request", None)
+            body = getattr(request, "body", None)
+            if isinstance(body, (bytes, str)):
+                bytes_out = len(body)
+        else:
+            status_code = None
+        self.metrics.record_request(method, url, status_code, seconds, bytes_in=bytes_in, bytes_out=bytes_out)
+
     def get_full_url(self, endpoint):
         full_url = "{}/{}".format(self.server_url, endpoint)
         return full_url
 
-    def get_next_row(self, endpoint, url=None, data_path=None, params=None):
-        params = params or {}
-        response = None
-        items_retrieved = 0
-        while self.pagination.has_next_page(response, items_retrieved):
-            params = self.pagination.get_paging_parameters(params)
-            response = self.get(endpoint, url=url, params=params, raw=True)
-            items_retrieved = 0
-            json_response = response.json()
-            for row in get_next_row_from_response(json_response, data_path):
-                items_retrieved += 1
-                yield row
-
-    def should_try_again(self, response):
-        if response is not None:
-            self.number_of_retries = None
-            return False
-        if self.number_of_retries is None:
-            logger.warning("Retrying")
-            self.number_of_retries = 1
-        else:
-            logger.warning("Retry {}".format(self.number_of_retries))
-            self.number_of_retries += 1
-        if self.number_of_retries > self.max_number_of_retries:
-            self.number_of_retries = None
-            logger.error("Max number of retries")
-            return False
-        return True
+    def get_next_row(self, endpoint, url=None, data_path=None, params=None, prefetch=True, on_page=None):
+        # While the rows of one page are consumed, the next page is already being fetched.
+        # on_page is called with each json page before its rows are yielded, and can raise to stop
+        params = self.pagination.get_paging_parameters(params or {})
+        executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
+        get_page = self.metrics.with_current_operation(self.get) if self.metrics else self.get
+        next_page = None
+        try:
+            json_response = self.get(endpoint, url=url, params=params)
+            while True:
+                if on_page:
+                    on_page(json_response)
+                rows = list(get_next_row_from_response(json_response, data_path))
+                next_page = None
+                if self.pagination.has_next_page(json_response, len(rows)):
+                    params = self.pagination.get_paging_parameters(params, json_response)
+                    if executor:
+                        next_page = executor.submit(get_page, endpoint, url=url, params=params)
+                    else:
+                        next_page = params
+                for row in rows:
+                    yield row
+                if next_page is None:
+                    return
+                if executor:
+                    json_response = next_page.result()
+                else:
+                    json_response = self.get(endpoint, url=url, params=next_page)
+        finally:
+            if executor:
+                # a caller stopping early does not wait for, nor send if still queued, the page fetched ahead
+                if next_page is not None:
+                    next_page.cancel()
+                executor.shutdown(wait=False)
 
     def raise_if_necessary(self, error_message):
         if self.should_fail_silently:
             return
-        else:
-            if self.max_number_of_retries == self.max_number_of_retries:
-                raise Exception(error_message)
-            else:
-                return
+        raise Exception(error_message)
 
 
 def get_next_row_from_response(response, data_path=None):
@@ -155,20 +195,16 @@ def get_next_row_from_response(response, data_path=None):
 class DefaultPagination():
     def __init__(self):
         # No pagination, just stops after the first page
-        logger.info("Single page pagination used")
+        logger.debug("Single page pagination used")
         pass
 
     def has_next_page(self, response, items_retrieved):
-        logger.info("DefaultPagination:has_next_page")
-        if response is None:
-            logger.info("DefaultPagination:has_next_page initialisation")
-            return True
-        logger.info("DefaultPagination:has_next_page Stop here")
+        logger.debug("DefaultPagination:has_next_page Stop here")
         return False
 
-    def get_paging_parameters(self):
-        logger.info("DefaultPagination:get_paging_parameters")
-        return {}
+    def get_paging_parameters(self, params, response=None):
+        logger.debug("DefaultPagination:get_paging_parameters")
+        return params
 
 
 def display_response_error(response):
@@ -176,9 +212,10 @@ def display_response_error(response):
         logger.error("Empty response")
     elif isinstance(response, requests.Response):
         status_code = response.status_code
-        logger.info("status_code={}".format(status_code))
+        logger.debug("status_code={}", status_code)
         if status_code >= 400:
-            logger.error("Error {}. Dumping response:{}".format(status_code, response.content))
-            logger.error("url={}, headers={}".format(response.url, response.headers))
+            logger.error("Error {}. Dumping response:{}", status_code, truncate(response.content))
+            if logger.is_enabled_for(logging.DEBUG):
+                logger.debug("url={}, headers={}", response.url, logger.filter_secrets(response.headers))
     else:
         logger.error("Not a requests.Response object")
@@ -0,0 +1,345 @@
+import asyncio
+import itertools
+import json
+import os
+import threading
+import time
+from api_client import DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT
+from infomaniak_auth import get_auth_headers
+from infomaniak_client import (
+    CacheInvalidation, KdrivePagination, check_response, check_upload_response, get_upload_parameters, DEFAULT_API_URL,
+    DEFAULT_MAX_RETRIES
+)
+from kdrive_cache import PathCache
+from retry_policy import RetryPolicy
+from safe_logger import SafeLogger, truncate
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+logger = SafeLogger("async-client", forbidden_keys=["Authorization"])
+
+DEFAULT_MAX_CONCURRENCY = 100
+
+
+class AsyncResponse(object):
+    # The parts of a requests.Response the retry policy and the callers use, with the body already read
+    def __init__(self, status_code, headers, content, url):
+        self.status_code = status_code
+        self.headers = headers
+        self.content = content
+        self.url = url
+
+    def json(self):
+        return json.loads(self.content.decode("utf-8"))
+
+
+class AsyncAPIClient(object):
+    # asyncio counterpart of APIClient. All the coroutines of a client share one aiohttp session,
+    # whose connection pool caps the requests in flight at max_concurrency
+    def __init__(self, api_token, pagination=None, retry_policy=None, rate_limiter=None, metrics=None,
+                 max_concurrency=DEFAULT_MAX_CONCURRENCY, timeout=None):
+        if aiohttp is None:
+            raise Exception("The asynchronous client requires the aiohttp package in the plugin's code environment")
+        self.api_token = api_token
+        self.pagination = pagination or KdrivePagination()
+        self.retry_policy = retry_policy or RetryPolicy(max_retries=DEFAULT_MAX_RETRIES)
+        self.rate_limiter = rate_limiter
+        self.metrics = metrics
+        self.max_concurrency = max_concurrency or DEFAULT_MAX_CONCURRENCY
+        self.timeout = timeout or (DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT)
+        self.session = None
+
+    def get_session(self):
+        # Created on first use, the session belongs to the event loop it is created in
+        if self.session is None:
+            self.session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.max_concurrency),
+                headers=get_auth_headers(self.api_token),
+                timeout=aiohttp.ClientTimeout(
+                    total=None,
+                    sock_connect=self.timeout[0],
+                    sock_read=self.timeout[1]
+                )
+            )
+        return self.session
+
+    async def close(self):
+        if self.session is not None:
+            await self.session.close()
+            self.session = None
+
+    async def get(self, url, params=None, headers=None, raw=False):
+        return await self.request("GET", url, params=params, headers=headers, raw=raw)
+
+    async def post(self, url, params=None, json=None, data=None, headers=None, raw=False, idempotent=None):
+        return await self.request(
+            "POST", url, params=params, json=json, data=data, headers=headers, raw=raw, idempotent=idempotent
+        )
+
+    async def delete(self, url, params=None, json=None, data=None, headers=None, raw=False):
+        return await self.request("DELETE", url, params=params, json=json, data=data, headers=headers, raw=raw)
+
+    async def request(self, method, url, raw=False, params=None, idempotent=None, **kwargs):
+        session = self.get_session()
+        if params:
+            # aiohttp only takes strings as query values
+            params = {key: "{}".format(value) for key, value in params.items()}
+        attempt = 0
+        while True:
+            attempt += 1
+            response = error = None
+            if self.rate_limiter:
+                # the token bucket is shared with the synchronous clients and sleeps, not on the event loop
+                await asyncio.get_event_loop().run_in_executor(None, self.rate_limiter.acquire)
+            start = time.time()
+            try:
+                logger.debug("{} url={}, params={}", method, url, params)
+                async with session.request(method, url, params=params, **kwargs) as http_response:
+                    content = await http_response.read()
+                    response = AsyncResponse(http_response.status, http_response.headers, content, url)
+            except Exception as request_error:
+                error = request_error
+                logger.error("Error on {}: {}", method, error)
+            if self.metrics:
+                self.record_request_metrics(method, url, response, time.time() - start, kwargs.get("data"))
+            if not self.retry_policy.should_retry(
+                    attempt, method=method, response=response, error=error, idempotent=idempotent):
+                break
+            delay = self.retry_policy.get_delay(attempt, response=response)
+            if self.rate_limiter and response is not None and response.status_code == 429:
+                self.rate_limiter.block_for(delay)
+            logger.warning("Retry {} of {} {} in {:.1f}s", attempt, method, url, delay)
+            if self.metrics:
+                self.metrics.record_retry()
+            await asyncio.sleep(delay)
+        if response is None:
+            raise Exception("Error on {}: {}".format(method, error))
+        if response.status_code >= 400:
+            logger.error("Error {}. Dumping response:{}", response.status_code, truncate(response.content))
+        if raw:
+            return response
+        return response.json()
+
+    def record_request_metrics(self, method, url, response, seconds, body):
+        status_code = None
+        bytes_in = 0
+        if response is not None:
+            status_code = response.status_code
+            bytes_in = len(response.content or b"")
+        bytes_out = len(body) if isinstance(body, (bytes, str)) else 0
+        self.metrics.record_request(method, url, status_code, seconds, bytes_in=bytes_in, bytes_out=bytes_out)
+
+    async def get_next_row(self, url, data_path=None, params=None):
+        # Async generator over the rows of all the pages, fetched one after the other
+        params = self.pagination.get_paging_parameters(params or {})
+        while True:
+            json_response = await self.get(url, params=params)
+            rows = json_response
+            for data_path_token in data_path or []:
+                rows = rows.get(data_path_token, {}) if isinstance(rows, dict) else {}
+            rows = rows if isinstance(rows, list) else [rows]
+            for row in rows:
+                yield row
+            if not self.pagination.has_next_page(json_response, len(rows)):
+                return
+            params = self.pagination.get_paging_parameters(params, json_response)
+
+
+class AsyncKdriveClient(CacheInvalidation):
+    # asyncio counterpart of KdriveClient for the calls that are fanned out by the hundreds: listings,
+    # lookups, small downloads and uploads, deletes, moves and renames. Given the path cache and metadata
+    # index of a KdriveClient, it keeps them up to date the same way. on_folders_changed, called after
+    # deletes, moves and renames, is where the KdriveClient forgets the folder ids of make_dirs
+    def __init__(self, api_token=None, api_url=None, page_size=None, retry_policy=None, rate_limiter=None,
+                 metrics=None, path_cache=None, metadata_index=None, max_concurrency=DEFAULT_MAX_CONCURRENCY,
+                 timeout=None, on_folders_changed=None):
+        self.api_url = (api_url or DEFAULT_API_URL).rstrip("/")
+        self.client = AsyncAPIClient(
+            api_token,
+            pagination=KdrivePagination(limit=page_size),
+            retry_policy=retry_policy,
+            rate_limiter=rate_limiter,
+            metrics=metrics,
+            max_concurrency=max_concurrency,
+            timeout=timeout
+        )
+        self.metrics = metrics
+        self.path_cache = path_cache or PathCache()
+        self.metadata_index = metadata_index
+        self.on_folders_changed = on_folders_changed
+
+    async def close(self):
+        await self.client.close()
+
+    async def get_next_folder_item(self, drive_id, file_id):
+        listed_at = time.time()
+        if self.metadata_index:
+            indexed_rows = self.metadata_index.get_children(drive_id, file_id)
+            if self.metrics:
+                self.metrics.record_cache("metadata_index", indexed_rows is not None)
+            if indexed_rows is not None:
+                for row in itertools.islice(indexed_rows, self.path_cache.get_max_listing_size()):
+                    self.path_cache.add_item(drive_id, file_id, row)
+                self.path_cache.add_listing(drive_id, file_id, indexed_rows, listed_at)
+                for row in indexed_rows:
+                    yield row
+                return
+        url = "{}/3/drive/{}/files/{}/files".format(self.api_url, drive_id, file_id)
+        rows = []
+        max_cached_rows = self.path_cache.get_max_listing_size()
+        row_count = 0
+        async for row in self.client.get_next_row(url, data_path=["data"]):
+            row_count += 1
+            if row_count <= max_cached_rows:
+                self.path_cache.add_item(drive_id, file_id, row)
+            elif not self.metadata_index:
+                # as in KdriveClient.get_next_folder_item, rows of listings too large to be cached are not kept
+                rows = None
+            if rows is not None:
+                rows.append(row)
+            yield row
+        if rows is not None:
+            self.path_cache.add_listing(drive_id, file_id, rows, listed_at)
+        if self.metadata_index:
+            self.metadata_index.replace_children(drive_id, file_id, rows)
+
+    async def list_folder(self, drive_id, file_id):
+        return [row async for row in self.get_next_folder_item(drive_id, file_id)]
+
+    async def get_item(self, drive_id, file_id, path):
+        # Returns the descriptor of path below file_id, None if it does not exist
+        path = (path or "").strip("/")
+        if not path:
+            return await self.get_file_descriptor(drive_id, file_id)
+        item = None
+        for path_token in path.split("/"):
+            is_known, item = self.path_cache.lookup(drive_id, file_id, path_token)
+            if not is_known:
+                item = await self.find_item_in_file_id(drive_id, file_id, path_token)
+            if not item:
+                return None
+            file_id = item.get("id")
+        return item
+
+    async def find_item_in_file_id(self, drive_id, file_id, item_name):
+        async for folder_item in self.get_next_folder_item(drive_id, file_id):
+            if folder_item and folder_item.get("name") == item_name:
+                return folder_item
+        return None
+
+    async def get_file_descriptor(self, drive_id, file_id):
+        url = "{}/3/drive/{}/files/{}".format(self.api_url, drive_id, file_id)
+        response = await self.client.get(url, raw=True)
+        if response.status_code == 404:
+            return None
+        descriptor = response.json().get("data")
+        if not descriptor or descriptor.get("status") == "trashed":
+            return None
+        return descriptor
+
+    async def get_file_content(self, drive_id, file_id, byte_range=None):
+        # The whole body is held in memory, large files go through KdriveClient.read_file_to_stream
+        url = "{}/2/drive/{}/files/{}/download".format(self.api_url, drive_id, file_id)
+        headers = {"Accept-Encoding": "identity"}
+        if byte_range:
+            first_byte, last_byte = byte_range
+            headers["Range"] = "bytes={}-{}".format(first_byte, "" if last_byte is None else last_byte)
+        return await self.client.get(url, headers=headers, raw=True)
+
+    async def write_file_content(self, drive_id, parent_folder_id, full_path, data, last_modified_at=None):
+        file_path, file_name = os.path.split(full_path)
+        url = "{}/3/drive/{}/upload".format(self.api_url, drive_id)
+        params = get_upload_parameters(parent_folder_id, file_name, len(data), last_modified_at)
+        response = await self.client.post(url, params=params, data=data, raw=True, idempotent=True)
+        self.invalidate_uploaded_file(drive_id, parent_folder_id, file_name)
+        check_upload_response(response, full_path)
+        self.add_uploaded_file(drive_id, parent_folder_id, response)
+        return response
+
+    async def delete_item(self, drive_id, item_id):
+        url = "{}/2/drive/{}/files/{}".format(self.api_url, drive_id, item_id)
+        response = await self.client.delete(url)
+        self.invalidate_removed_item(drive_id, item_id)
+        return response
+
+    async def move_item(self, drive_id, item_id, destination_directory_id, new_name=None):
+        url = "{}/3/drive/{}/files/{}/move/{}".format(self.api_url, drive_id, item_id, destination_directory_id)
+        response = await self.client.post(url)
+        check_response(response)
+        self.invalidate_moved_item(drive_id, item_id, destination_directory_id)
+        if new_name:
+            response = await self.rename(drive_id, item_id, new_name)
+        return response
+
+    async def rename(self, drive_id, item_to_rename_id, new_name):
+        url = "{}/2/drive/{}/files/{}/rename".format(self.api_url, drive_id, item_to_rename_id)
+        response = await self.client.post(url, json={"name": new_name})
+        check_response(response)
+        self.invalidate_removed_item(drive_id, item_to_rename_id)
+        return response
+
+    def forget_directories(self):
+        if self.on_folders_changed:
+            self.on_folders_changed()
+
+
+class AsyncBridge(object):
+    # Runs an AsyncKdriveClient on an event loop of its own thread, so that synchronous code,
+    # the FSProvider's methods, can wait on hundreds of concurrent calls from a single thread
+    def __init__(self, client):
+        self.client = client
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, name="kdrive-async-bridge")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def run(self, coroutine):
+        if self.client.metrics:
+            coroutine = self.client.metrics.in_current_operation(coroutine)
+        return asyncio.run_coroutine_threadsafe(coroutine, self.loop).result()
+
+    def map(self, function, items):
+        # function(item) returns a coroutine. Returns the results in the order of items, once all
+        # the calls are done, raising the first error if any failed
+        async def run_all():
+            return await asyncio.gather(*[function(item) for item in items], return_exceptions=True)
+        results = self.run(run_all())
+        for result in results:
+            if isinstance(result, Exception):
+                raise result
+        return results
+
+    def close(self):
+        try:
+            self.run(self.client.close())
+        finally:
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.loop.close()
+
+
+def get_async_bridge(api_token, client, max_concurrency):
+    # An AsyncBridge sharing the caches, retry policy and rate limiter of client, a KdriveClient.
+    # None if max_concurrency is 0 or aiohttp is missing, callers then use threads
+    if not max_concurrency or max_concurrency <= 0:
+        return None
+    if aiohttp is None:
+        logger.warning("Concurrent requests require the aiohttp package, falling back to threads")
+        return None
+    async_client = AsyncKdriveClient(
+        api_token=api_token,
+        api_url=client.api_url,
+        page_size=client.client.pagination.limit,
+        retry_policy=client.client.retry_policy,
+        rate_limiter=client.client.rate_limiter,
+        metrics=client.metrics,
+        path_cache=client.path_cache,
+        metadata_index=client.metadata_index,
+        max_concurrency=max_concurrency,
+        timeout=client.client.timeout,
+        on_folders_changed=client.forget_directories
+    )
+    return AsyncBridge(async_client)
@@ -0,0 +1,145 @@
+import glob
+import os
+import shutil
+import tempfile
+import threading
+from contextlib import contextmanager
+from safe_logger import SafeLogger
+
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
+logger = SafeLogger("content-cache")
+
+COPY_BUFFER_SIZE = 1024 * 1024
+
+
+class ContentCache(object):
+    # Files downloaded by read(), kept on local disk up to max_size bytes, least recently read evicted first.
+    # An entry is named after (drive_id, file_id, last_modified_at, size), so a changed file is never served
+    # from a stale entry, and the older versions of a file are removed when the new one is stored.
+    def __init__(self, directory, max_size):
+        self.directory = directory
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.fill_locks = {}
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    def get_entry_path(self, drive_id, file_id, last_modified_at, size):
+        return os.path.join(self.directory, "{}-{}-{}-{}".format(drive_id, file_id, last_modified_at, size))
+
+    def can_store(self, size):
+        return size is not None and int(size) <= self.max_size
+
+    def copy_to_stream(self, entry_path, stream, limit=None):
+        # Returns the number of bytes copied, or None if the entry is not there
+        try:
+            entry = open(entry_path, "rb")
+        except (IOError, OSError):
+            return None
+        with entry:
+            touch(entry_path)
+            bytes_written = 0
+            while limit is None or limit < 0 or bytes_written < limit:
+                buffer_size = COPY_BUFFER_SIZE
+                if limit is not None and limit >= 0:
+                    buffer_size = min(buffer_size, limit - bytes_written)
+                data = entry.read(buffer_size)
+                if not data:
+                    break
+                stream.write(data)
+                bytes_written += len(data)
+        return bytes_written
+
+    def fill(self, drive_id, file_id, last_modified_at, size, download, stream):
+        # download(target) writes the whole file into target. The bytes are sent to stream as they come.
+        # Concurrent readers of the same entry, threads or processes, wait for the first one instead of downloading again.
+        # Returns the number of bytes written to stream
+        entry_path = self.get_entry_path(drive_id, file_id, last_modified_at, size)
+        with self.fill_lock(entry_path):
+            bytes_written = self.copy_to_stream(entry_path, stream)
+            if bytes_written is not None:
+                return bytes_written
+            file_descriptor, temporary_path = tempfile.mkstemp(dir=self.directory, prefix=".fill-")
+            try:
+                with os.fdopen(file_descriptor, "wb") as temporary_file:
+                    bytes_written = download(TeeStream(temporary_file, stream))
+                if bytes_written != int(size):
+                    raise Exception("File {} has {} bytes instead of {}".format(file_id, bytes_written, size))
+                os.rename(temporary_path, entry_path)
+            except Exception:
+                remove_file(temporary_path)
+                raise
+        self.remove_other_versions(drive_id, file_id, entry_path)
+        self.evict()
+        return bytes_written
+
+    @contextmanager
+    def fill_lock(self, entry_path):
+        with self.lock:
+            lock = self.fill_locks.setdefault(entry_path, threading.Lock())
+        with lock:
+            if fcntl is None:
+                yield
+                return
+            with open(entry_path + ".lock", "w") as lock_file:
+                fcntl.flock(lock_file, fcntl.LOCK_EX)
+                try:
+                    yield
+                finally:
+                    fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def remove_other_versions(self, drive_id, file_id, entry_path):
+        for other_path in glob.glob(os.path.join(self.directory, "{}-{}-*".format(drive_id, file_id))):
+            if other_path not in (entry_path, entry_path + ".lock"):
+                remove_file(other_path)
+
+    def evict(self):
+        entries = []
+        for entry_name in os.listdir(self.directory):
+            if entry_name.startswith(".") or entry_name.endswith(".lock"):
+                continue
+            try:
+                entry_stat = os.stat(os.path.join(self.directory, entry_name))
+            except OSError:
+                continue
+            entries.append((entry_stat.st_mtime, entry_stat.st_size, entry_name))
+        total_size = sum(entry[1] for entry in entries)
+        for _, entry_size, entry_name in sorted(entries):
+            if total_size <= self.max_size:
+                break
+            logger.info("Evicting '{}' from the content cache", entry_name)
+            remove_file(os.path.join(self.directory, entry_name))
+            remove_file(os.path.join(self.directory, entry_name + ".lock"))
+            total_size -= entry_size
+
+    def clear(self):
+        shutil.rmtree(self.directory, ignore_errors=True)
+        os.makedirs(self.directory)
+
+
+class TeeStream(object):
+    def __init__(self, *streams):
+        self.streams = streams
+
+    def write(self, data):
+        for stream in self.streams:
+            stream.write(data)
+
+
+def touch(path):
+    # The modification time is the recency used for eviction
+    try:
+        os.utime(path, None)
+    except OSError:
+        pass
+
+
+def remove_file(path):
+    try:
+        os.remove(path)
+    except OSError:
+        pass
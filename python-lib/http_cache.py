@@ -0,0 +1,78 @@
+import copy
+import threading
+from collections import OrderedDict
+
+DEFAULT_HTTP_CACHE_SIZE = 32 * 1024 * 1024
+
+
+class HTTPCache(object):
+    # Bodies of the GET responses that came with an ETag or a Last-Modified header, least recently used
+    # evicted past max_size bytes. Requests for a cached URL carry the validators, and a 304 answer
+    # is turned back into the cached response. Entries are always revalidated, never served as is.
+    def __init__(self, max_size=DEFAULT_HTTP_CACHE_SIZE):
+        self.max_size = max_size
+        self.size = 0
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is not None:
+                self.entries.move_to_end(key)
+            return entry
+
+    def store(self, key, response):
+        etag = response.headers.get("ETag")
+        last_modified = response.headers.get("Last-Modified")
+        if response.status_code != 200 or not (etag or last_modified):
+            return
+        content = response.content or b""
+        if len(content) > self.max_size:
+            return
+        entry = {
+            "etag": etag,
+            "last_modified": last_modified,
+            "content": content,
+            "headers": copy.copy(response.headers),
+            "encoding": response.encoding
+        }
+        with self.lock:
+            previous_entry = self.entries.pop(key, None)
+            if previous_entry:
+                self.size -= len(previous_entry["content"])
+            self.entries[key] = entry
+            self.size += len(content)
+            while self.size > self.max_size and self.entries:
+                _, evicted_entry = self.entries.popitem(last=False)
+                self.size -= len(evicted_entry["content"])
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.size = 0
+
+
+def get_cache_key(url, params=None):
+    return (url, tuple(sorted((params or {}).items())))
+
+
+def get_conditional_headers(entry, headers=None):
+    conditional_headers = dict(headers or {})
+    if entry.get("etag"):
+        conditional_headers["If-None-Match"] = entry["etag"]
+    if entry.get("last_modified"):
+        conditional_headers["If-Modified-Since"] = entry["last_modified"]
+    return conditional_headers
+
+
+def get_cached_response(entry, not_modified_response):
+    # The 304 response, with the cached status, body and headers
+    not_modified_response.status_code = 200
+    not_modified_response._content = entry["content"]
+    not_modified_response._content_consumed = True
+    not_modified_response.encoding = entry["encoding"]
+    headers = copy.copy(entry["headers"])
+    headers.update(not_modified_response.headers)
+    not_modified_response.headers = headers
+    return not_modified_response
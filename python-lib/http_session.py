@@ -0,0 +1,232 @@
+import os
+import socket
+import ssl
+import threading
+import requests
+from requests import certs
+from requests.adapters import BaseAdapter, HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from requests.utils import get_encoding_from_headers, select_proxy
+from urllib3.connection import HTTPConnection
+from urllib3.util.request import ACCEPT_ENCODING
+from infomaniak_auth import get_token_fingerprint
+from safe_logger import SafeLogger
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+logger = SafeLogger("http-session")
+
+DEFAULT_POOL_SIZE = 32
+DEFAULT_KEEP_ALIVE_IDLE = 60
+
+sessions = {}
+sessions_lock = threading.Lock()
+
+
+class KeepAliveHTTPAdapter(HTTPAdapter):
+    # Enables TCP keep-alive probes so that idle pooled connections are not silently dropped
+    def __init__(self, keep_alive_idle=DEFAULT_KEEP_ALIVE_IDLE, **kwargs):
+        self.keep_alive_idle = keep_alive_idle
+        super(KeepAliveHTTPAdapter, self).__init__(**kwargs)
+
+    def init_poolmanager(self, *args, **kwargs):
+        kwargs["socket_options"] = get_keep_alive_socket_options(self.keep_alive_idle)
+        super(KeepAliveHTTPAdapter, self).init_poolmanager(*args, **kwargs)
+
+
+class HTTP2Adapter(BaseAdapter):
+    # Sends the requests of a requests.Session through HTTP/2 httpx clients, one for each combination of
+    # the verify, cert and proxy settings the session resolved for the request
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, keep_alive_idle=DEFAULT_KEEP_ALIVE_IDLE):
+        super(HTTP2Adapter, self).__init__()
+        self.limits = httpx.Limits(
+            max_connections=pool_size,
+            max_keepalive_connections=pool_size,
+            keepalive_expiry=keep_alive_idle
+        )
+        self.clients = {}
+        self.clients_lock = threading.Lock()
+
+    def get_client(self, verify, cert, proxy):
+        if isinstance(cert, list):
+            cert = tuple(cert)
+        key = (verify, cert, proxy)
+        with self.clients_lock:
+            client = self.clients.get(key)
+            if client is None:
+                transport = httpx.HTTPTransport(
+                    http2=True,
+                    limits=self.limits,
+                    verify=get_ssl_context(verify, cert),
+                    proxy=proxy
+                )
+                # requests already merged the environment's proxies and CA bundle into the settings
+                client = httpx.Client(transport=transport, trust_env=False)
+                self.clients[key] = client
+            return client
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        client = self.get_client(verify, cert, select_proxy(request.url, proxies or {}))
+        httpx_request = client.build_request(
+            request.method,
+            request.url,
+            headers=dict(request.headers),
+            content=request.body,
+            timeout=timeout
+        )
+        try:
+            httpx_response = client.send(httpx_request, stream=True)
+        except httpx.TransportError as error:
+            raise get_requests_error(error, request)
+        response = requests.Response()
+        response.status_code = httpx_response.status_code
+        response.headers = CaseInsensitiveDict(httpx_response.headers.items())
+        response.encoding = get_encoding_from_headers(response.headers)
+        response.reason = httpx_response.reason_phrase
+        response.url = request.url
+        response.request = request
+        response.connection = self
+        response.raw = HTTP2RawStream(httpx_response)
+        if not stream:
+            response.content
+        return response
+
+    def close(self):
+        with self.clients_lock:
+            clients, self.clients = list(self.clients.values()), {}
+        for client in clients:
+            client.close()
+
+
+class HTTP2RawStream(object):
+    # Minimal file-like view of an httpx response, as requests expects from urllib3
+    def __init__(self, httpx_response):
+        self.httpx_response = httpx_response
+        self.iterator = None
+        self.buffer = b""
+
+    def stream(self, chunk_size=None, decode_content=True):
+        try:
+            for chunk in self.httpx_response.iter_bytes(chunk_size=chunk_size):
+                yield chunk
+        except httpx.TransportError as error:
+            raise get_body_error(error)
+
+    def read(self, amt=None):
+        if self.iterator is None:
+            self.iterator = self.httpx_response.iter_bytes()
+        while amt is None or len(self.buffer) < amt:
+            try:
+                chunk = next(self.iterator, None)
+            except httpx.TransportError as error:
+                raise get_body_error(error)
+            if chunk is None:
+                break
+            self.buffer += chunk
+        if amt is None:
+            data, self.buffer = self.buffer, b""
+        else:
+            data, self.buffer = self.buffer[:amt], self.buffer[amt:]
+        return data
+
+    def close(self):
+        self.httpx_response.close()
+
+    def release_conn(self):
+        self.httpx_response.close()
+
+
+def get_requests_error(error, request):
+    # The requests exception matching an httpx one, so that callers and the retry policy handle both alike
+    if isinstance(error, httpx.ConnectTimeout):
+        requests_error = requests.exceptions.ConnectTimeout(error, request=request)
+    elif isinstance(error, httpx.TimeoutException):
+        requests_error = requests.exceptions.ReadTimeout(error, request=request)
+    elif isinstance(error, httpx.ProxyError):
+        requests_error = requests.exceptions.ProxyError(error, request=request)
+    else:
+        requests_error = requests.exceptions.ConnectionError(error, request=request)
+    requests_error.__cause__ = error
+    return requests_error
+
+
+def get_body_error(error):
+    # As requests does for urllib3, a body cut short is a ChunkedEncodingError, a stalled one a ConnectionError
+    if isinstance(error, httpx.TimeoutException):
+        body_error = requests.exceptions.ConnectionError(error)
+    else:
+        body_error = requests.exceptions.ChunkedEncodingError(error)
+    body_error.__cause__ = error
+    return body_error
+
+
+def get_ssl_context(verify, cert):
+    # verify and cert as requests takes them: a boolean or a CA bundle path, and a path or a (cert, key) pair
+    if isinstance(verify, str):
+        if os.path.isdir(verify):
+            ssl_context = ssl.create_default_context(capath=verify)
+        else:
+            ssl_context = ssl.create_default_context(cafile=verify)
+    else:
+        ssl_context = ssl.create_default_context(cafile=certs.where())
+        if verify is False:
+            ssl_context.check_hostname = False
+            ssl_context.verify_mode = ssl.CERT_NONE
+    if isinstance(cert, str):
+        ssl_context.load_cert_chain(cert)
+    elif cert:
+        ssl_context.load_cert_chain(*cert)
+    return ssl_context
+
+
+def get_keep_alive_socket_options(keep_alive_idle):
+    socket_options = list(HTTPConnection.default_socket_options)
+    socket_options.append((socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1))
+    if keep_alive_idle:
+        if hasattr(socket, "TCP_KEEPIDLE"):
+            socket_options.append((socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, keep_alive_idle))
+        if hasattr(socket, "TCP_KEEPINTVL"):
+            socket_options.append((socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, max(1, keep_alive_idle // 4)))
+    return socket_options
+
+
+def build_session(auth, pool_size=DEFAULT_POOL_SIZE, keep_alive_idle=DEFAULT_KEEP_ALIVE_IDLE, use_http2=False):
+    session = requests.Session()
+    session.auth = auth
+    # brotli and zstd are added by urllib3 when their decoder is installed
+    session.headers["Accept-Encoding"] = ACCEPT_ENCODING
+    adapter = None
+    if use_http2:
+        if httpx is None:
+            logger.warning("HTTP/2 requires the httpx[http2] package, falling back to HTTP/1.1")
+        else:
+            try:
+                adapter = HTTP2Adapter(pool_size=pool_size, keep_alive_idle=keep_alive_idle)
+            except ImportError as error:
+                logger.warning("HTTP/2 not available ({}), falling back to HTTP/1.1", error)
+    if adapter is None:
+        adapter = KeepAliveHTTPAdapter(
+            keep_alive_idle=keep_alive_idle,
+            pool_connections=pool_size,
+            pool_maxsize=pool_size
+        )
+    session.mount("https://", adapter)
+    session.mount("http://", adapter)
+    return session
+
+
+def get_session(api_token, auth, pool_size=None, keep_alive_idle=None, use_http2=False):
+    # One session per API token in the process, so that connections are reused across providers
+    pool_size = pool_size or DEFAULT_POOL_SIZE
+    keep_alive_idle = DEFAULT_KEEP_ALIVE_IDLE if keep_alive_idle is None else keep_alive_idle
+    key = (get_token_fingerprint(api_token), pool_size, keep_alive_idle, use_http2)
+    with sessions_lock:
+        session = sessions.get(key)
+        if session is None:
+            logger.info("New HTTP session, pool size {}, HTTP/2 {}", pool_size, use_http2)
+            session = build_session(auth, pool_size=pool_size, keep_alive_idle=keep_alive_idle, use_http2=use_http2)
+            sessions[key] = session
+        return session
@@ -1,3 +1,4 @@
+import hashlib
 import requests
 
 
@@ -6,8 +7,17 @@ class InfomaniakAuth(requests.auth.AuthBase):
         self.api_token = api_token
 
     def __call__(self, request):
-        request.headers["Authorization"] = "Bearer {}".format(
-            self.api_token
-        )
-        request.headers["User-Agent"] = "Dataiku DSS infomaniak plugin v0.0.1"
+        request.headers.update(get_auth_headers(self.api_token))
         return request
+
+
+def get_auth_headers(api_token):
+    return {
+        "Authorization": "Bearer {}".format(api_token),
+        "User-Agent": "Dataiku DSS infomaniak plugin v0.0.1"
+    }
+
+
+def get_token_fingerprint(api_token):
+    # Used to key per token resources without keeping the token itself around
+    return hashlib.sha256("{}".format(api_token).encode("utf-8")).hexdigest()
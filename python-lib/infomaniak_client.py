@@ -1,42 +1,101 @@
 from infomaniak_auth import InfomaniakAuth
-from api_client import APIClient
+from api_client import APIClient, DEFAULT_CONNECT_TIMEOUT, DEFAULT_READ_TIMEOUT
+from retry_policy import RetryPolicy
+from rate_limiter import get_rate_limiter
+from http_session import get_session
+from http_cache import HTTPCache, DEFAULT_HTTP_CACHE_SIZE
+from metrics import Metrics
 from safe_logger import SafeLogger
+from kdrive_cache import PathCache, DEFAULT_MAX_LISTING_ENTRIES
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+import itertools
 import os
+import requests
+import shutil
+import tempfile
+import threading
+import time
 
 logger = SafeLogger("Infomaniak client")
 
+DEFAULT_API_URL = "https://api.infomaniak.com"
+DEFAULT_DOWNLOAD_CHUNK_SIZE = 1024 * 1024
+DEFAULT_DOWNLOAD_PART_SIZE = 8 * 1024 * 1024
+DEFAULT_DOWNLOAD_THREADS = 4
+MAX_RESUME_ATTEMPTS = 3
+DEFAULT_DELETE_THREADS = 8
+BULK_DELETE_SIZE = 500
+# Answers of a drive that does not offer an endpoint, such as the bulk actions
+NOT_SUPPORTED_STATUS_CODES = [404, 405]
+DEFAULT_UPLOAD_CHUNK_SIZE = 10 * 1024 * 1024
+DEFAULT_UPLOAD_THREADS = 4
+DEFAULT_PAGE_SIZE = 1000
+DEFAULT_MAX_RETRIES = 5
+DEFAULT_KNOWN_PATHS_TTL = 3600
+# Browsing a folder remembers the paths of its first children only, more would push out every other known path
+MAX_REMEMBERED_CHILDREN = 1000
+# An upload to an existing file adds a version to it, instead of failing or renaming the new file
+UPLOAD_CONFLICT = "version"
+ACTIVITY_CLOCK_MARGIN = 300
+
+
+class Child(object):
+    # One entry of a folder listing, with only the fields browse() returns. Much smaller than the
+    # descriptor it comes from, which is dropped with its page unless the listing is small enough to be cached
+    __slots__ = ("name", "last_modified", "size", "is_directory", "id")
+
+    def __init__(self, descriptor):
+        self.name = descriptor.get("name")
+        self.last_modified = int(descriptor.get("last_modified_at")) * 1000
+        size = descriptor.get("size")
+        self.size = None if size is None else int(size)
+        self.is_directory = descriptor.get("type") == "dir"
+        self.id = descriptor.get("id")
+
+    def to_dict(self, parent_path):
+        return {
+            "name": self.name,
+            "lastModified": self.last_modified,
+            "size": self.size,
+            "fullPath": "{}/{}".format(parent_path, self.name),
+            "directory": self.is_directory,
+            "id": self.id
+        }
+
 
 class Item(object):
-    def __init__(self, client, drive_id, path, descriptor):
+    def __init__(self, client, drive_id, path, descriptor, file_id=None, loader=None):
+        # With a file_id and no descriptor, the item's metadata is only fetched when first needed
         self.client = client
         self.path = path
-        self.descriptor = descriptor or {}
         self.drive_id = drive_id
+        self.file_id = file_id
+        self.loader = loader
+        self._descriptor = descriptor
+        if descriptor is None and file_id is None and loader is None:
+            self._descriptor = {}
 
-    def get_next_child(self):
+    @property
+    def descriptor(self):
+        if self._descriptor is None:
+            if self.loader:
+                self._descriptor = self.loader() or {}
+            else:
+                self._descriptor = self.client.get_file_descriptor(self.drive_id, self.file_id) or {}
+        return self._descriptor
+
+    def get_next_child(self, limit=None):
+        # The first limit children, all of them if None, each converted once as the listing pages come in
         if "data" in self.descriptor:
-            for item in self.descriptor.get("data", []):
-                yield {
-                    "name": item.get("name"),
-                    "lastModified": int(item.get("last_modified_at")) * 1000,
-                    "size": self.get_size(item=item),
-                    "fullPath": "/".join([self.path, item.get("name")]),
-                    "directory": item.get("type")=="dir",
-                    "id": item.get("id")
-                }
-            return 
-        if self.is_file():
+            rows = self.descriptor.get("data", [])
+        elif self.is_file():
             raise Exception("'{}' is a file, cannot list its content".format(self.path))
-        for item in self.client.get_next_folder_item(self.drive_id, self.get_file_id()):
-            is_directory = item.get("type")=="dir"
-            yield {
-                "name": item.get("name"),
-                "lastModified": int(item.get("last_modified_at")) * 1000,
-                "size": self.get_size(item=item),
-                "fullPath": "/".join([self.path, item.get("name")]),
-                "directory": item.get("type")=="dir",
-                "id": item.get("id")
-            }
+        else:
+            rows = self.client.get_next_folder_item(self.drive_id, self.get_file_id(), limit=limit)
+        for row in itertools.islice(rows, limit):
+            yield Child(row)
+
     def get_size(self, item=None):
         if item:
             size = item.get("size")
@@ -66,6 +125,8 @@ class Item(object):
     def exists(self):
         return not not self.descriptor
     def get_file_id(self):
+        if self._descriptor is None and self.file_id is not None:
+            return self.file_id
         return self.descriptor.get("id")
     def get_file_name(self):
         return self.descriptor.get("name")
@@ -73,22 +134,119 @@ class Item(object):
         self.client.delete_item(self.drive_id, self.get_file_id())
     
 
-class KdriveClient():
-    def __init__(self, api_token=None):
-        server_url = "https://api.infomaniak.com/2/drive"
+class CacheInvalidation(object):
+    # Keeps the path cache, the metadata index and the folder ids remembered by make_dirs up to date after
+    # changes to the tree, the same way for KdriveClient and AsyncKdriveClient. Subclasses have path_cache,
+    # metadata_index and forget_directories()
+    def invalidate_uploaded_file(self, drive_id, parent_folder_id, file_name):
+        self.path_cache.invalidate_name(drive_id, parent_folder_id, file_name)
+        self.invalidate_indexed_folder(drive_id, parent_folder_id)
+
+    def add_uploaded_file(self, drive_id, parent_folder_id, response):
+        # The upload answers with the file's descriptor, so a stat right after a write needs no request
+        try:
+            uploaded_file = response.json().get("data") or {}
+        except ValueError:
+            return
+        uploaded_file = uploaded_file.get("file", uploaded_file)
+        if isinstance(uploaded_file, dict) and uploaded_file.get("id") is not None:
+            self.path_cache.add_item(drive_id, parent_folder_id, uploaded_file)
+
+    def invalidate_removed_item(self, drive_id, item_id):
+        # After a delete, a move or a rename
+        self.path_cache.invalidate_item(drive_id, item_id)
+        self.invalidate_indexed_item(drive_id, item_id)
+        self.forget_directories()
+
+    def invalidate_moved_item(self, drive_id, item_id, destination_directory_id):
+        self.invalidate_removed_item(drive_id, item_id)
+        self.path_cache.invalidate_folder(drive_id, destination_directory_id)
+        self.invalidate_indexed_folder(drive_id, destination_directory_id)
+
+    def invalidate_indexed_folder(self, drive_id, folder_id):
+        if self.metadata_index:
+            self.metadata_index.mark_folder_dirty(drive_id, folder_id)
+
+    def invalidate_indexed_item(self, drive_id, item_id):
+        if self.metadata_index:
+            self.metadata_index.invalidate_item(drive_id, item_id)
+
+
+class KdriveClient(CacheInvalidation):
+    def __init__(self, api_token=None, api_url=None, cache_ttl=60, cache_max_size=10000, download_chunk_size=None,
+                 upload_chunk_size=None, upload_threads=None, page_size=None, retry_policy=None,
+                 requests_per_second=None, requests_burst=None, http_pool_size=None, keep_alive_idle=None,
+                 use_http2=False, known_paths_ttl=None, metrics=None, metadata_index=None, content_cache=None,
+                 download_part_size=None, download_threads=None, delete_threads=None, http_cache_size=None,
+                 connect_timeout=None, read_timeout=None, cache_max_listing_entries=None):
+        self.api_url = (api_url or DEFAULT_API_URL).rstrip("/")
+        server_url = "{}/2/drive".format(self.api_url)
+        auth = InfomaniakAuth(api_token=api_token)
+        self.metrics = metrics or Metrics()
         self.client = APIClient(
             server_url=server_url,
-            auth=InfomaniakAuth(api_token=api_token),
-            pagination=KdrivePagination(),
-            max_number_of_retries=1
+            auth=auth,
+            session=get_session(
+                api_token,
+                auth,
+                pool_size=http_pool_size,
+                keep_alive_idle=keep_alive_idle,
+                use_http2=use_http2
+            ),
+            pagination=KdrivePagination(limit=page_size),
+            retry_policy=retry_policy or RetryPolicy(max_retries=DEFAULT_MAX_RETRIES),
+            rate_limiter=get_rate_limiter(api_token, requests_per_second, burst=requests_burst),
+            metrics=self.metrics,
+            http_cache=get_http_cache(http_cache_size),
+            timeout=(connect_timeout or DEFAULT_CONNECT_TIMEOUT, read_timeout or DEFAULT_READ_TIMEOUT)
         )
+        self.path_cache = PathCache(
+            max_size=cache_max_size,
+            ttl=cache_ttl,
+            known_paths_ttl=DEFAULT_KNOWN_PATHS_TTL if known_paths_ttl is None else known_paths_ttl,
+            max_listing_entries=cache_max_listing_entries or DEFAULT_MAX_LISTING_ENTRIES
+        )
+        self.download_chunk_size = download_chunk_size or DEFAULT_DOWNLOAD_CHUNK_SIZE
+        self.download_part_size = download_part_size or DEFAULT_DOWNLOAD_PART_SIZE
+        self.download_threads = download_threads or DEFAULT_DOWNLOAD_THREADS
+        self.delete_threads = delete_threads or DEFAULT_DELETE_THREADS
+        self.is_bulk_delete_supported = True
+        self.directory_ids = {}
+        self.root_paths = {}
+        self.directory_locks = {}
+        self.directory_lock = threading.Lock()
+        self.upload_chunk_size = upload_chunk_size or DEFAULT_UPLOAD_CHUNK_SIZE
+        self.upload_threads = upload_threads or DEFAULT_UPLOAD_THREADS
+        self.metadata_index = metadata_index
+        self.content_cache = content_cache
+        self.async_bridge = None
+
+    def use_async_bridge(self, async_bridge):
+        # With an AsyncBridge, listings of many folders and one by one deletions run as coroutines instead of threads
+        self.async_bridge = async_bridge
+
+    def get_metrics_summary(self):
+        summary = self.metrics.get_summary()
+        if self.client.rate_limiter:
+            summary["rate_limiter"] = self.client.rate_limiter.get_metrics()
+        return summary
 
-    def get(self, endpoint, url=None, raw=False):
-        response = self.client.get(endpoint, url=url, raw=raw)
+    def close(self):
+        if self.async_bridge:
+            self.async_bridge.close()
+            self.async_bridge = None
+        if self.metadata_index:
+            self.metadata_index.close()
+            self.metadata_index = None
+
+    def get(self, endpoint, url=None, params=None, headers=None, raw=False, stream=False):
+        response = self.client.get(endpoint, url=url, params=params, headers=headers, raw=raw, stream=stream)
         return response
 
-    def post(self, endpoint, url=None, params=None, json=None, data=None, headers=None, raw=False):
-        response = self.client.post(endpoint, url=url, params=params, json=json, data=data, headers=headers, raw=raw)
+    def post(self, endpoint, url=None, params=None, json=None, data=None, headers=None, raw=False, idempotent=None):
+        response = self.client.post(
+            endpoint, url=url, params=params, json=json, data=data, headers=headers, raw=raw, idempotent=idempotent
+        )
         return response
 
     def delete(self, endpoint, url=None, params=None, json=None, data=None, headers=None, raw=False):
@@ -96,7 +254,8 @@ class KdriveClient():
         return response
 
     def next_child(self, drive_id, file_id):
-        url = "https://api.infomaniak.com/3/drive/{}/files/{}/files".format(
+        url = "{}/3/drive/{}/files/{}/files".format(
+            self.api_url,
             drive_id,
             file_id
         )
@@ -106,35 +265,175 @@ class KdriveClient():
         url = "?account_id="
         response = self.get(url)
 
-    def get_next_folder_item(self, drive_id, file_id):
-        url = "https://api.infomaniak.com/3/drive/{}/files/{}/files".format(
+    def get_next_folder_item(self, drive_id, file_id, limit=None, prefetch=True):
+        # With a limit, the first page only holds that many items and the next one is not prefetched,
+        # for callers that stop early, as with prefetch=False. The listing is only cached as a whole if it is read to the end
+        listed_at = time.time()
+        if self.metadata_index:
+            indexed_rows = self.metadata_index.get_children(drive_id, file_id)
+            self.metrics.record_cache("metadata_index", indexed_rows is not None)
+            if indexed_rows is not None:
+                for row in itertools.islice(indexed_rows, self.path_cache.get_max_listing_size()):
+                    self.path_cache.add_item(drive_id, file_id, row)
+                self.path_cache.add_listing(drive_id, file_id, indexed_rows, listed_at)
+                for row in indexed_rows:
+                    yield row
+                return
+        url = "{}/3/drive/{}/files/{}/files".format(
+            self.api_url,
             drive_id,
             file_id
         )
-        for row in self.client.get_next_row("", url=url, data_path=["data"]):
+        params = {"limit": min(limit, self.client.pagination.limit)} if limit else None
+        rows = []
+        max_cached_rows = self.path_cache.get_max_listing_size()
+        prefetch = prefetch and not limit
+        for row_count, row in enumerate(
+                self.client.get_next_row("", url=url, data_path=["data"], params=params, prefetch=prefetch), 1):
+            if row_count <= max_cached_rows:
+                self.path_cache.add_item(drive_id, file_id, row)
+            elif not self.metadata_index:
+                # Too many children for the listing to be cached whole. The rows are not kept, nor cached
+                # one by one where they would only push out every other entry
+                rows = None
+            if rows is not None:
+                rows.append(row)
+            yield row
+        if rows is not None:
+            self.path_cache.add_listing(drive_id, file_id, rows, listed_at)
+        if self.metadata_index:
+            self.metadata_index.replace_children(drive_id, file_id, rows)
+
+    def refresh_metadata_index(self, drive_id):
+        # Marks as dirty the indexed folders that changed since the last refresh, according to the activity feed.
+        # Without a usable feed, every indexed folder is listed again when next needed
+        if not self.metadata_index:
+            return
+        refresh_time = time.time()
+        synced_at = self.metadata_index.get_synced_at(drive_id)
+        if synced_at is not None:
+            try:
+                changes = 0
+                for activity in self.get_next_activity(drive_id, int(synced_at) - ACTIVITY_CLOCK_MARGIN):
+                    file_id, parent_id = get_activity_ids(activity)
+                    if file_id is not None:
+                        self.metadata_index.invalidate_item(drive_id, file_id)
+                    if parent_id is not None:
+                        self.metadata_index.mark_folder_dirty(drive_id, parent_id)
+                    changes += 1
+                logger.info("Metadata index of drive {} refreshed, {} changes", drive_id, changes)
+            except Exception as error:
+                logger.warning("Could not read the activity feed of drive {}, dropping its index: {}", drive_id, error)
+                self.metadata_index.mark_all_dirty(drive_id)
+        else:
+            self.metadata_index.mark_all_dirty(drive_id)
+        self.metadata_index.set_synced_at(drive_id, refresh_time)
+
+    def get_next_activity(self, drive_id, from_date):
+        url = "{}/3/drive/{}/activities".format(self.api_url, drive_id)
+        params = {
+            "from_date": from_date
+        }
+        for row in self.client.get_next_row("", url=url, data_path=["data"], params=params, on_page=check_response):
+            yield row
+
+    def get_next_subtree_item(self, drive_id, folder_id):
+        # All the files and folders below folder_id, in a few paginated search requests.
+        # Raises if the search endpoint answers with an error, so that callers can fall back to listing folders
+        url = "{}/3/drive/{}/files/search".format(self.api_url, drive_id)
+        params = {
+            "directory_id": folder_id,
+            "depth": "unlimited"
+        }
+        for row in self.client.get_next_row("", url=url, data_path=["data"], params=params, on_page=check_response):
+            if row.get("parent_id") is not None:
+                self.path_cache.add_item(drive_id, row.get("parent_id"), row)
             yield row
 
     def get_item(self, drive_id, file_id, path, relative_path, create_folder=False):
-        path_tokens = path.split('/')
+        if not path:
+            return Item(self, drive_id, relative_path, None, file_id=file_id)
+        if not create_folder:
+            is_resolved, descriptor = self.walk_path(drive_id, file_id, path, cache_only=True)
+            self.metrics.record_cache("path_cache", is_resolved)
+            if is_resolved:
+                return Item(self, drive_id, relative_path, descriptor)
+            known_file_id = self.path_cache.get_known_path(drive_id, file_id, path)
+            self.metrics.record_cache("known_paths", known_file_id is not None)
+            if known_file_id is not None:
+                return Item(
+                    self, drive_id, relative_path, None,
+                    file_id=known_file_id,
+                    loader=lambda: self.load_known_item(drive_id, file_id, path, known_file_id)
+                )
+        _, descriptor = self.walk_path(drive_id, file_id, path, create_folder=create_folder)
+        return Item(self, drive_id, relative_path, descriptor)
+
+    def walk_path(self, drive_id, file_id, path, create_folder=False, cache_only=False):
+        # Returns (is_resolved, descriptor), descriptor being None if the path does not exist
+        # Every folder on the way is remembered as a known path, so that its descendants can be
+        # forgotten along with it when it is renamed, moved or deleted
         new_file_id = file_id
-        for path_token in path_tokens:
-            item = self.find_item_in_file_id(drive_id, new_file_id, path_token)
+        item = None
+        resolved_tokens = []
+        for path_token in path.split('/'):
+            is_known, item = self.path_cache.lookup(drive_id, new_file_id, path_token)
+            if not is_known:
+                if cache_only:
+                    return False, None
+                item = self.find_item_in_file_id(drive_id, new_file_id, path_token)
             if not item:
                 if create_folder:
-                    item = self.create_folder(drive_id, new_file_id, path_token)
-                    new_file_id = item.get("id")
+                    item = self.create_or_find_folder(drive_id, new_file_id, path_token)
                 else:
-                    return Item(self, drive_id, relative_path, None)
-            elif not path_token:
-                return Item(self, drive_id, relative_path, {"id":file_id, "type": "dir"})
-            else:
-                new_file_id = item.get("id")
-        item = Item(self, drive_id, relative_path, item)
-        return item
+                    return True, None
+            new_file_id = item.get("id")
+            resolved_tokens.append(path_token)
+            self.path_cache.add_known_path(drive_id, file_id, "/".join(resolved_tokens), new_file_id)
+        return True, item
+
+    def load_known_item(self, drive_id, root_file_id, path, known_file_id):
+        # One request: the item, with its full path, which must still be the root's path followed by path
+        descriptor = self.get_file_descriptor(drive_id, known_file_id, with_path=True)
+        root_path = self.get_root_path(drive_id, root_file_id)
+        if descriptor and root_path is not None and descriptor.get("path") == join_drive_path(root_path, path):
+            return descriptor
+        logger.info("'{}' is no longer file {}, resolving it again", path, known_file_id)
+        self.path_cache.forget_known_path(drive_id, root_file_id, path)
+        # the root itself may have been moved
+        self.root_paths.pop((drive_id, root_file_id), None)
+        _, descriptor = self.walk_path(drive_id, root_file_id, path)
+        return descriptor
+
+    def get_root_path(self, drive_id, root_file_id):
+        # Full path of the provider's root folder, fetched once
+        key = (drive_id, root_file_id)
+        root_path = self.root_paths.get(key)
+        if root_path is None:
+            root = self.get_file_descriptor(drive_id, root_file_id, with_path=True)
+            root_path = root.get("path") if root else None
+            if root_path is not None:
+                self.root_paths[key] = root_path
+        return root_path
+
+    def remember_path(self, drive_id, root_file_id, path, item_id):
+        self.path_cache.add_known_path(drive_id, root_file_id, path, item_id)
+
+    def get_file_descriptor(self, drive_id, file_id, with_path=False):
+        url = "{}/3/drive/{}/files/{}".format(self.api_url, drive_id, file_id)
+        params = {"with": "path"} if with_path else None
+        response = self.get("", url=url, params=params, raw=True)
+        if response.status_code == 404:
+            return None
+        descriptor = response.json().get("data")
+        if not descriptor or descriptor.get("status") == "trashed":
+            return None
+        return descriptor
 
     def create_folder(self, drive_id, parent_folder_id, folder_name):
-        logger.info("Creating folder '{}' on drive {} with parent id {}".format(folder_name, drive_id, parent_folder_id))
-        url = "https://api.infomaniak.com/3/drive/{}/files/{}/directory".format(
+        logger.info("Creating folder '{}' on drive {} with parent id {}", folder_name, drive_id, parent_folder_id)
+        url = "{}/3/drive/{}/files/{}/directory".format(
+            self.api_url,
             drive_id,
             parent_folder_id
         )
@@ -142,50 +441,451 @@ class KdriveClient():
             "name": folder_name
         }
         response = self.post("", url=url, json=data)
-        return response.get("data")
+        self.path_cache.invalidate_folder(drive_id, parent_folder_id)
+        self.invalidate_indexed_folder(drive_id, parent_folder_id)
+        if response.get("result") != "success":
+            error = response.get("error") or {}
+            if error.get("code") == "destination_already_exists":
+                return None
+            raise Exception("Could not create folder '{}': {}".format(folder_name, error))
+        folder = response.get("data")
+        self.path_cache.add_item(drive_id, parent_folder_id, folder)
+        # a new folder is empty, looking names up in it needs no listing
+        self.path_cache.add_listing(drive_id, folder.get("id"), [], time.time())
+        return folder
+
+    def create_or_find_folder(self, drive_id, parent_folder_id, folder_name):
+        folder = self.create_folder(drive_id, parent_folder_id, folder_name)
+        if folder is None:
+            logger.info("Folder '{}' was created meanwhile, resolving it again", folder_name)
+            folder = self.find_item_in_file_id(drive_id, parent_folder_id, folder_name)
+            if not folder or folder.get("type") != "dir":
+                raise Exception("Could not create folder '{}' in folder {}".format(folder_name, parent_folder_id))
+        return folder
+
+    def make_dirs(self, drive_id, root_file_id, path):
+        # Returns the id of the folder at path below root_file_id, creating the missing folders.
+        # Ids are remembered for the life of the client, and concurrent callers for one path wait for each other
+        path = path.strip("/")
+        if not path:
+            return root_file_id
+        key = (str(drive_id), str(root_file_id), path)
+        folder_id = self.directory_ids.get(key)
+        if folder_id is not None:
+            return folder_id
+        with self.directory_lock:
+            path_lock = self.directory_locks.setdefault(key, threading.Lock())
+        with path_lock:
+            folder_id = self.directory_ids.get(key)
+            if folder_id is not None:
+                return folder_id
+            parent_path, folder_name = os.path.split(path)
+            parent_folder_id = self.make_dirs(drive_id, root_file_id, parent_path)
+            is_known, folder = self.path_cache.lookup(drive_id, parent_folder_id, folder_name)
+            if not is_known:
+                folder = self.find_item_in_file_id(drive_id, parent_folder_id, folder_name)
+            if not folder:
+                folder = self.create_or_find_folder(drive_id, parent_folder_id, folder_name)
+            elif folder.get("type") != "dir":
+                raise Exception("'{}' is a file, cannot create a folder there".format(path))
+            folder_id = folder.get("id")
+            self.directory_ids[key] = folder_id
+            self.path_cache.add_known_path(drive_id, root_file_id, path, folder_id)
+        return folder_id
+
+    def make_dirs_batch(self, drive_id, root_file_id, paths, max_workers=8):
+        # Creates a whole folder layout ahead of a bulk write, level by level, the folders of a level concurrently
+        levels = {}
+        for path in paths:
+            tokens = [token for token in path.strip("/").split("/") if token]
+            for depth in range(1, len(tokens) + 1):
+                levels.setdefault(depth, set()).add("/".join(tokens[:depth]))
+        make_dirs = self.metrics.with_current_operation(lambda path: self.make_dirs(drive_id, root_file_id, path))
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            for depth in sorted(levels):
+                for _ in executor.map(make_dirs, sorted(levels[depth])):
+                    pass
+        return {path: self.make_dirs(drive_id, root_file_id, path) for path in paths}
+
+    def list_folders(self, drive_id, folder_ids, max_workers=8):
+        # The children of each folder, in the order of folder_ids, all the folders being listed at once
+        if self.async_bridge:
+            async_client = self.async_bridge.client
+            return self.async_bridge.map(lambda folder_id: async_client.list_folder(drive_id, folder_id), folder_ids)
+        list_folder = self.metrics.with_current_operation(
+            lambda folder_id: list(self.get_next_folder_item(drive_id, folder_id))
+        )
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            return list(executor.map(list_folder, folder_ids))
+
+    def forget_directories(self):
+        # Deleted, moved or renamed folders may be ancestors of remembered ones
+        with self.directory_lock:
+            self.directory_ids.clear()
 
     def find_item_in_file_id(self, drive_id, file_id, item_name):
-        for folder_item in self.get_next_folder_item(drive_id, file_id):
+        # Stops at the page holding the item, so no page is fetched ahead
+        for folder_item in self.get_next_folder_item(drive_id, file_id, prefetch=False):
             if not item_name:
                 return folder_item
             if folder_item and folder_item.get("name") == item_name:
                 return folder_item
         return None
     
-    def get_file_content(self, drive_id, file_id):
-        url = "https://api.infomaniak.com/2/drive/{}/files/{}/download".format(drive_id, file_id)
-        response = self.get("", url=url, raw=True)
+    def get_file_content(self, drive_id, file_id, stream=False, byte_range=None):
+        # byte_range is (first, last) inclusive, last being None for the end of the file.
+        # Contents are not compressed in transit, ranges and resumed downloads count raw bytes
+        url = self.get_download_url(drive_id, file_id)
+        headers = {"Accept-Encoding": "identity"}
+        if byte_range:
+            first_byte, last_byte = byte_range
+            headers["Range"] = "bytes={}-{}".format(first_byte, "" if last_byte is None else last_byte)
+        response = self.get("", url=url, headers=headers, raw=True, stream=stream)
         return response
 
-    def write_file_content(self, drive_id, parent_folder_id, full_path, data):
+    def get_download_url(self, drive_id, file_id):
+        return "{}/2/drive/{}/files/{}/download".format(self.api_url, drive_id, file_id)
+
+    def download_file_to_stream(self, drive_id, file_id, stream, limit=None, size=None):
+        # Files known to span several parts are fetched as concurrent byte ranges, the others in a single stream
+        end = None if size is None else int(size)
+        if limit is not None and limit >= 0 and end is not None:
+            end = min(end, limit)
+        if end is not None and self.download_threads > 1 and end > 2 * self.download_part_size:
+            return self.download_ranges_to_stream(drive_id, file_id, stream, end)
+        return self.download_single_stream(drive_id, file_id, stream, limit=limit)
+
+    def download_single_stream(self, drive_id, file_id, stream, limit=None, response=None):
+        # Copies the file chunk by chunk into stream, so memory use does not depend on the file size.
+        # A transfer cut in the middle is resumed with a range request from the last byte received
+        bytes_written = 0
+        attempts = 0
+        while True:
+            if response is None:
+                byte_range = (bytes_written, None) if bytes_written else None
+                response = self.get_file_content(drive_id, file_id, stream=True, byte_range=byte_range)
+            bytes_before = bytes_written
+            try:
+                if response.status_code >= 400:
+                    raise Exception("Error {} while downloading file {}".format(response.status_code, file_id))
+                if bytes_written and response.status_code != 206:
+                    raise Exception("Download of file {} cut at byte {} and the server cannot resume it".format(file_id, bytes_written))
+                for chunk in response.iter_content(chunk_size=self.download_chunk_size):
+                    if not chunk:
+                        continue
+                    if limit is not None and limit >= 0 and bytes_written + len(chunk) >= limit:
+                        stream.write(chunk[:limit - bytes_written])
+                        bytes_written = limit
+                        break
+                    stream.write(chunk)
+                    bytes_written += len(chunk)
+                return bytes_written
+            except requests.exceptions.RequestException as error:
+                attempts += 1
+                if attempts > MAX_RESUME_ATTEMPTS:
+                    raise
+                logger.warning("Download of file {} cut at byte {}, resuming: {}", file_id, bytes_written, error)
+            finally:
+                response.close()
+                response = None
+                self.metrics.record_bytes_in(bytes_written - bytes_before, "GET", self.get_download_url(drive_id, file_id))
+
+    def download_ranges_to_stream(self, drive_id, file_id, stream, end):
+        # Parts are fetched by download_threads workers and written in order, so at most
+        # download_threads + 1 parts are held in memory
+        part_size = self.download_part_size
+        first_response = self.get_file_content(drive_id, file_id, stream=True, byte_range=(0, part_size - 1))
+        if first_response.status_code == 200:
+            logger.info("Byte ranges not supported for file {}, downloading it in a single stream", file_id)
+            return self.download_single_stream(drive_id, file_id, stream, limit=end, response=first_response)
+        stream.write(self.read_range(drive_id, file_id, 0, part_size - 1, response=first_response))
+        bytes_written = part_size
+        next_starts = iter(range(part_size, end, part_size))
+        pending_parts = deque()
+        read_range = self.metrics.with_current_operation(self.read_range)
+
+        def submit_next_part(executor):
+            start = next(next_starts, None)
+            if start is not None:
+                pending_parts.append(executor.submit(read_range, drive_id, file_id, start, min(start + part_size, end) - 1))
+
+        with ThreadPoolExecutor(max_workers=self.download_threads) as executor:
+            try:
+                for _ in range(self.download_threads):
+                    submit_next_part(executor)
+                while pending_parts:
+                    part = pending_parts.popleft().result()
+                    stream.write(part)
+                    bytes_written += len(part)
+                    submit_next_part(executor)
+            except Exception:
+                for pending_part in pending_parts:
+                    pending_part.cancel()
+                raise
+        return bytes_written
+
+    def read_range(self, drive_id, file_id, first_byte, last_byte, response=None):
+        # Returns the bytes first_byte to last_byte, resuming from the last byte received if the transfer is cut
+        expected_size = last_byte - first_byte + 1
+        data = bytearray()
+        attempts = 0
+        while True:
+            if response is None:
+                response = self.get_file_content(drive_id, file_id, stream=True, byte_range=(first_byte + len(data), last_byte))
+            bytes_before = len(data)
+            try:
+                if response.status_code != 206:
+                    raise Exception("Bytes {}-{} of file {} not served: status code {}".format(
+                        first_byte + len(data), last_byte, file_id, response.status_code
+                    ))
+                for chunk in response.iter_content(chunk_size=self.download_chunk_size):
+                    data.extend(chunk)
+                interruption = "connection closed after {} bytes".format(len(data))
+            except requests.exceptions.RequestException as error:
+                interruption = error
+            finally:
+                response.close()
+                response = None
+                self.metrics.record_bytes_in(len(data) - bytes_before, "GET", self.get_download_url(drive_id, file_id))
+            if len(data) >= expected_size:
+                del data[expected_size:]
+                return data
+            attempts += 1
+            if attempts > MAX_RESUME_ATTEMPTS:
+                raise Exception("Bytes {}-{} of file {} could not be downloaded: {}".format(first_byte, last_byte, file_id, interruption))
+            logger.warning("Download of bytes {}-{} of file {} cut, resuming: {}", first_byte, last_byte, file_id, interruption)
+
+    def read_file_to_stream(self, drive_id, descriptor, stream, limit=None):
+        # Goes through the content cache when there is one. Reads with a limit (previews, schema detection)
+        # are served from the cache but do not fill it, so they never download more than they need
+        file_id = descriptor.get("id")
+        last_modified_at = descriptor.get("last_modified_at")
+        size = descriptor.get("size")
+        if not self.content_cache or last_modified_at is None or not self.content_cache.can_store(size):
+            return self.download_file_to_stream(drive_id, file_id, stream, limit=limit, size=size)
+        entry_path = self.content_cache.get_entry_path(drive_id, file_id, last_modified_at, size)
+        bytes_written = self.content_cache.copy_to_stream(entry_path, stream, limit=limit)
+        self.metrics.record_cache("content_cache", bytes_written is not None)
+        if bytes_written is not None:
+            return bytes_written
+        if limit is not None and limit >= 0:
+            return self.download_file_to_stream(drive_id, file_id, stream, limit=limit, size=size)
+        return self.content_cache.fill(
+            drive_id, file_id, last_modified_at, size,
+            lambda target: self.download_file_to_stream(drive_id, file_id, target, size=size),
+            stream
+        )
+
+    def write_file_content(self, drive_id, parent_folder_id, full_path, data, last_modified_at=None):
+        # last_modified_at, in seconds, sets the file's modification time with no extra request
         file_path, file_name = os.path.split(full_path)
-        url = "https://api.infomaniak.com/3/drive/{}/upload".format(
+        url = "{}/3/drive/{}/upload".format(
+            self.api_url,
             drive_id
         )
-        params = {
-            "total_size": len(data),
+        params = get_upload_parameters(parent_folder_id, file_name, len(data), last_modified_at)
+        # With the conflict mode, an upload sent twice makes a new version of the same file, so it is safe to retry
+        response = self.post("", url=url, params=params, data=data, raw=True, idempotent=True)
+        self.invalidate_uploaded_file(drive_id, parent_folder_id, file_name)
+        check_upload_response(response, full_path)
+        self.add_uploaded_file(drive_id, parent_folder_id, response)
+        return response
+
+    def upload_stream(self, drive_id, parent_folder_id, full_path, stream, last_modified_at=None):
+        function, args = self.prepare_upload(drive_id, parent_folder_id, full_path, stream)
+        return function(*args, last_modified_at=last_modified_at)
+
+    def prepare_upload(self, drive_id, parent_folder_id, full_path, stream):
+        # Sends all the requests of an upload but the last one, and returns its function and arguments,
+        # so that the caller can still add last_modified_at to it.
+        # The stream is spooled to disk past one chunk, so that the size is known before choosing
+        # between single-shot and chunked upload, and so that failed chunks can be read again
+        spool = tempfile.SpooledTemporaryFile(max_size=self.upload_chunk_size)
+        try:
+            shutil.copyfileobj(stream, spool, self.download_chunk_size)
+            total_size = spool.tell()
+            spool.seek(0)
+            if total_size <= self.upload_chunk_size:
+                return self.write_file_content, (drive_id, parent_folder_id, full_path, spool.read())
+            session_token = self.upload_chunks(drive_id, parent_folder_id, full_path, spool, total_size)
+            return self.finish_chunked_upload, (drive_id, parent_folder_id, full_path, session_token)
+        finally:
+            spool.close()
+
+    def write_file_content_by_chunks(self, drive_id, parent_folder_id, full_path, source, total_size,
+                                     last_modified_at=None):
+        session_token = self.upload_chunks(
+            drive_id, parent_folder_id, full_path, source, total_size, last_modified_at=last_modified_at
+        )
+        return self.finish_chunked_upload(
+            drive_id, parent_folder_id, full_path, session_token, last_modified_at=last_modified_at
+        )
+
+    def upload_chunks(self, drive_id, parent_folder_id, full_path, source, total_size, last_modified_at=None):
+        # Opens an upload session and sends all the chunks of source. Returns the session token
+        file_path, file_name = os.path.split(full_path)
+        total_chunks = (total_size + self.upload_chunk_size - 1) // self.upload_chunk_size
+        logger.info("Uploading '{}' ({} bytes) in {} chunks", full_path, total_size, total_chunks)
+        session = self.start_upload_session(
+            drive_id, parent_folder_id, file_name, total_size, total_chunks, last_modified_at=last_modified_at
+        )
+        session_token = session.get("token")
+        upload_url = session.get("upload_url") or self.api_url
+        source_lock = threading.Lock()
+
+        def upload_chunk(chunk_number):
+            with source_lock:
+                source.seek((chunk_number - 1) * self.upload_chunk_size)
+                chunk = source.read(self.upload_chunk_size)
+            self.upload_chunk(drive_id, upload_url, session_token, chunk_number, chunk)
+
+        try:
+            with ThreadPoolExecutor(max_workers=self.upload_threads) as executor:
+                for _ in executor.map(self.metrics.with_current_operation(upload_chunk), range(1, total_chunks + 1)):
+                    pass
+        except Exception as error:
+            logger.error("Chunked upload of '{}' failed: {}", full_path, error)
+            self.cancel_upload_session(drive_id, session_token)
+            raise
+        return session_token
+
+    def finish_chunked_upload(self, drive_id, parent_folder_id, full_path, session_token, last_modified_at=None):
+        file_path, file_name = os.path.split(full_path)
+        response = self.finish_upload_session(drive_id, session_token, last_modified_at=last_modified_at)
+        self.invalidate_uploaded_file(drive_id, parent_folder_id, file_name)
+        self.add_uploaded_file(drive_id, parent_folder_id, response)
+        return response
+
+    def start_upload_session(self, drive_id, parent_folder_id, file_name, total_size, total_chunks,
+                             last_modified_at=None):
+        url = "{}/3/drive/{}/upload/session/start".format(self.api_url, drive_id)
+        data = {
+            "directory_id": parent_folder_id,
             "file_name": file_name,
-            "directory_id": parent_folder_id
+            "total_size": total_size,
+            "total_chunks": total_chunks,
+            "conflict": UPLOAD_CONFLICT
         }
-        response = self.post("", url=url, params=params, data=data, raw=True)
+        if last_modified_at is not None:
+            data["last_modified_at"] = int(last_modified_at)
+        response = self.post("", url=url, json=data)
+        if response.get("result") != "success":
+            raise Exception("Could not start upload session for '{}': {}".format(file_name, response.get("error")))
+        return response.get("data", {})
+
+    def upload_chunk(self, drive_id, upload_url, session_token, chunk_number, chunk):
+        url = "{}/3/drive/{}/upload/session/{}/chunk".format(upload_url.rstrip("/"), drive_id, session_token)
+        params = {
+            "chunk_number": chunk_number,
+            "chunk_size": len(chunk)
+        }
+        # Failed chunks are retried by the client's retry policy, the others are not sent again.
+        # A chunk sent twice overwrites itself, so the chunk requests opt in to retries
+        response = self.post("", url=url, params=params, data=chunk, raw=True, idempotent=True)
+        if response.status_code >= 400:
+            raise Exception("Chunk {} could not be uploaded: status code {}".format(chunk_number, response.status_code))
+        return response
+
+    def finish_upload_session(self, drive_id, session_token, last_modified_at=None):
+        url = "{}/3/drive/{}/upload/session/{}/finish".format(self.api_url, drive_id, session_token)
+        data = {"last_modified_at": int(last_modified_at)} if last_modified_at is not None else None
+        response = self.post("", url=url, json=data, raw=True)
+        if response.status_code >= 400:
+            raise Exception("Could not finish upload session: status code {}".format(response.status_code))
         return response
 
+    def cancel_upload_session(self, drive_id, session_token):
+        url = "{}/3/drive/{}/upload/session/{}".format(self.api_url, drive_id, session_token)
+        try:
+            self.delete("", url=url, raw=True)
+        except Exception as error:
+            logger.error("Could not cancel upload session: {}", error)
+
     def delete_item(self, drive_id, item_id):
-        url = "https://api.infomaniak.com/2/drive/{}/files/{}".format(drive_id, item_id)
+        url = "{}/2/drive/{}/files/{}".format(self.api_url, drive_id, item_id)
         response = self.delete("", url=url)
+        self.invalidate_removed_item(drive_id, item_id)
         return response
     
-    def move_item(self, drive_id, item_id, destination_directory_id):
-        url = "https://api.infomaniak.com/3/drive/{}/files/{}/move/{}".format(
+    def delete_items(self, drive_id, item_ids):
+        # Bulk trash action by batches of BULK_DELETE_SIZE. Where the drive does not offer it,
+        # the items left are deleted one by one by delete_threads workers
+        item_ids = list(item_ids)
+        deleted_count = 0
+        while self.is_bulk_delete_supported and deleted_count < len(item_ids):
+            batch = item_ids[deleted_count:deleted_count + BULK_DELETE_SIZE]
+            if self.bulk_delete(drive_id, batch) is None:
+                logger.warning("Bulk delete not available, deleting files one by one")
+                self.is_bulk_delete_supported = False
+                break
+            deleted_count += len(batch)
+        remaining_ids = item_ids[deleted_count:]
+        if remaining_ids and self.async_bridge:
+            async_client = self.async_bridge.client
+            self.async_bridge.map(lambda item_id: async_client.delete_item(drive_id, item_id), remaining_ids)
+        elif remaining_ids:
+            delete_item = self.metrics.with_current_operation(lambda item_id: self.delete_item(drive_id, item_id))
+            with ThreadPoolExecutor(max_workers=self.delete_threads) as executor:
+                for _ in executor.map(delete_item, remaining_ids):
+                    pass
+        return len(item_ids)
+
+    def bulk_delete(self, drive_id, item_ids):
+        # Returns None where the drive does not offer the bulk action, any other failure is raised
+        url = "{}/3/drive/{}/files/bulk".format(self.api_url, drive_id)
+        data = {
+            "action": "trash",
+            "file_ids": item_ids
+        }
+        response = self.post("", url=url, json=data, raw=True)
+        if is_not_supported(response):
+            return None
+        if response.status_code >= 400:
+            raise Exception("status code {}".format(response.status_code))
+        check_response(response.json())
+        for item_id in item_ids:
+            self.path_cache.invalidate_item(drive_id, item_id)
+            self.invalidate_indexed_item(drive_id, item_id)
+        self.forget_directories()
+        return response
+
+    def move_item(self, drive_id, item_id, destination_directory_id, new_name=None):
+        # With a new_name, the item is renamed once in its destination folder
+        url = "{}/3/drive/{}/files/{}/move/{}".format(
+            self.api_url,
             drive_id,
             item_id,
             destination_directory_id
         )
         response = self.post("", url=url)
+        check_response(response)
+        self.invalidate_moved_item(drive_id, item_id, destination_directory_id)
+        if new_name:
+            response = self.rename(drive_id, item_id, new_name)
         return response
 
+    def copy_item(self, drive_id, item_id, destination_directory_id, new_name=None):
+        # The copy is made by kDrive, no byte goes through DSS. Returns the copy's descriptor
+        url = "{}/3/drive/{}/files/{}/copy/{}".format(
+            self.api_url,
+            drive_id,
+            item_id,
+            destination_directory_id
+        )
+        data = {"name": new_name} if new_name else None
+        response = self.post("", url=url, json=data)
+        check_response(response)
+        self.path_cache.invalidate_folder(drive_id, destination_directory_id)
+        self.invalidate_indexed_folder(drive_id, destination_directory_id)
+        copy = response.get("data")
+        if isinstance(copy, dict):
+            self.path_cache.add_item(drive_id, destination_directory_id, copy)
+            return copy
+        return None
+
     def rename(self, drive_id, item_to_rename_id, new_name):
-        url = "https://api.infomaniak.com/2/drive/{}/files/{}/rename".format(
+        url = "{}/2/drive/{}/files/{}/rename".format(
+            self.api_url,
             drive_id,
             item_to_rename_id
         )
@@ -193,23 +893,91 @@ class KdriveClient():
             "name": new_name
         }
         response = self.post("", url=url, json=data)
+        check_response(response)
+        self.invalidate_removed_item(drive_id, item_to_rename_id)
         return response
 
 
+def get_upload_parameters(parent_folder_id, file_name, size, last_modified_at=None):
+    # Query of a direct upload, last_modified_at in seconds
+    params = {
+        "total_size": size,
+        "file_name": file_name,
+        "directory_id": parent_folder_id,
+        "conflict": UPLOAD_CONFLICT
+    }
+    if last_modified_at is not None:
+        params["last_modified_at"] = int(last_modified_at)
+    return params
+
+
+def check_upload_response(response, full_path):
+    if response.status_code >= 400:
+        raise Exception("Could not upload '{}': status code {}".format(full_path, response.status_code))
+
+
+def check_response(json_response):
+    if not isinstance(json_response, dict) or json_response.get("result") != "success":
+        error = json_response.get("error") if isinstance(json_response, dict) else json_response
+        raise Exception("kDrive API error: {}".format(error))
+
+
+def is_not_supported(response):
+    if response.status_code in NOT_SUPPORTED_STATUS_CODES:
+        return True
+    try:
+        error = response.json().get("error") or {}
+    except (ValueError, AttributeError):
+        return False
+    error_code = error.get("code") if isinstance(error, dict) else error
+    return isinstance(error_code, str) and error_code.endswith("not_supported")
+
+
+def join_drive_path(folder_path, path):
+    return "{}/{}".format(folder_path.rstrip("/"), path.strip("/"))
+
+
+def get_activity_ids(activity):
+    # Returns (file_id, parent_id), the activity either holding the ids or the file descriptor
+    file_descriptor = activity.get("file") or {}
+    file_id = activity.get("file_id") or file_descriptor.get("id")
+    parent_id = activity.get("parent_id") or file_descriptor.get("parent_id")
+    return file_id, parent_id
+
+
+def get_http_cache(http_cache_size):
+    # None for the default size, 0 to disable the cache
+    if http_cache_size is None:
+        http_cache_size = DEFAULT_HTTP_CACHE_SIZE
+    if http_cache_size <= 0:
+        return None
+    return HTTPCache(max_size=http_cache_size)
+
+
 class KdrivePagination():
-    def __init__(self):
-        # No pagination, just stops after the first page
-        logger.info("Single page pagination used")
-        pass
+    # Stateless, so that one instance can be shared by concurrent listings.
+    # The v3 endpoints return a cursor and has_more, the v2 ones page and pages.
+    def __init__(self, limit=None):
+        self.limit = limit or DEFAULT_PAGE_SIZE
 
     def has_next_page(self, response, items_retrieved):
-        logger.info("DefaultPagination:has_next_page")
-        if response is None:
-            logger.info("DefaultPagination:has_next_page initialisation")
-            return True
-        logger.info("DefaultPagination:has_next_page Stop here")
+        if not response or not items_retrieved:
+            return False
+        if response.get("cursor"):
+            return bool(response.get("has_more"))
+        page = response.get("page")
+        pages = response.get("pages")
+        if page is not None and pages is not None:
+            return int(page) < int(pages)
         return False
 
-    def get_paging_parameters(self, params):
-        logger.info("DefaultPagination:get_paging_parameters")
-        return {}
+    def get_paging_parameters(self, params, response=None):
+        paging_parameters = dict(params)
+        paging_parameters.setdefault("limit", self.limit)
+        if response:
+            if response.get("cursor"):
+                paging_parameters["cursor"] = response.get("cursor")
+            elif response.get("page") is not None:
+                paging_parameters["page"] = int(response.get("page")) + 1
+                paging_parameters.setdefault("per_page", self.limit)
+        return paging_parameters
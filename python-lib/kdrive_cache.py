@@ -0,0 +1,254 @@
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_MAX_LISTING_ENTRIES = 100000
+
+
+class TTLCache(object):
+    # on_remove(key, value) is called for every entry dropped, expired, evicted, popped or replaced.
+    # With get_size(value), max_size bounds the total size of the values instead of their number,
+    # and a value larger than max_size on its own is not kept
+    def __init__(self, max_size=10000, ttl=60, on_remove=None, get_size=None):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.on_remove = on_remove
+        self.get_size = get_size
+        self.entries = OrderedDict()
+        self.size = 0
+        self.lock = threading.RLock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return default
+            value, expires_at, _ = entry
+            if expires_at < time.time():
+                self.drop(key)
+                self.misses += 1
+                return default
+            self.entries.move_to_end(key)
+            self.hits += 1
+            return value
+
+    def put(self, key, value, created_at=None):
+        # created_at, by default now, is when the value was read: the entry expires ttl seconds later.
+        # Returns whether the value was kept
+        if not self.max_size:
+            return False
+        expires_at = (time.time() if created_at is None else created_at) + self.ttl
+        size = self.measure(value)
+        with self.lock:
+            if key in self.entries:
+                self.drop(key)
+            if size > self.max_size:
+                return False
+            self.entries[key] = (value, expires_at, size)
+            self.size += size
+            self.evict()
+            return True
+
+    def update_size(self, key):
+        # For values changed in place, such as a listing that gained an item
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return
+            value, expires_at, size = entry
+            new_size = self.measure(value)
+            self.entries[key] = (value, expires_at, new_size)
+            self.size += new_size - size
+            if new_size > self.max_size:
+                self.drop(key)
+            self.evict()
+
+    def pop(self, key, default=None):
+        with self.lock:
+            if key not in self.entries:
+                return default
+            return self.drop(key)
+
+    def measure(self, value):
+        return self.get_size(value) if self.get_size else 1
+
+    def evict(self):
+        while self.size > self.max_size:
+            self.drop(next(iter(self.entries)))
+
+    def drop(self, key):
+        value, _, size = self.entries.pop(key)
+        self.size -= size
+        self.removed(key, value)
+        return value
+
+    def removed(self, key, value):
+        if self.on_remove:
+            self.on_remove(key, value)
+
+    def clear(self):
+        with self.lock:
+            if self.on_remove:
+                for key, entry in list(self.entries.items()):
+                    self.on_remove(key, entry[0])
+            self.entries.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self.entries)
+
+
+class PathCache(object):
+    # Caches the (drive, parent folder id, name) -> descriptor edges met while listing folders.
+    # Resolving a path then becomes a chain of in-memory lookups, and renaming or moving a folder
+    # only invalidates one edge since its children stay keyed by the folder's own id.
+    # The children of a fully listed folder are kept as one entry, so that names missing from it
+    # are known not to exist for as long as the whole listing is kept. Listings are bounded by their
+    # total number of children, and a folder with more children than that is not kept as a listing.
+    # Known paths map full paths to ids for longer, ids being stable. They cost one metadata
+    # request to check instead of a listing per path token. They are also kept as a tree, so that
+    # the paths below a renamed, moved or deleted folder are forgotten with it.
+    def __init__(self, max_size=10000, ttl=60, known_paths_ttl=3600, max_listing_entries=DEFAULT_MAX_LISTING_ENTRIES):
+        self.items = TTLCache(max_size=max_size, ttl=ttl)
+        self.keys_by_id = TTLCache(max_size=max_size, ttl=ttl)
+        self.listings = TTLCache(
+            max_size=max_listing_entries, ttl=ttl, on_remove=self.forget_listing_parents, get_size=get_listing_size
+        )
+        self.listing_parents = {}
+        self.known_paths = TTLCache(max_size=max_size, ttl=known_paths_ttl, on_remove=self.forget_known_path_child)
+        self.known_paths_by_id = TTLCache(max_size=max_size, ttl=known_paths_ttl)
+        self.known_path_children = {}
+        self.lock = threading.RLock()
+
+    def lookup(self, drive_id, parent_id, name):
+        # Returns (is_known, descriptor). A known item with a None descriptor means
+        # the parent folder was fully listed and does not contain that name
+        with self.lock:
+            listing = self.listings.get((drive_id, str(parent_id)))
+            if listing is not None:
+                return True, listing.get(name)
+            descriptor = self.items.get((drive_id, str(parent_id), name))
+            if descriptor is not None:
+                return True, descriptor
+            return False, None
+
+    def add_item(self, drive_id, parent_id, descriptor):
+        if not descriptor or descriptor.get("id") is None:
+            return
+        key = (drive_id, str(parent_id), descriptor.get("name"))
+        with self.lock:
+            self.items.put(key, descriptor)
+            self.keys_by_id.put((drive_id, str(descriptor.get("id"))), key)
+            listing = self.listings.get(key[:2])
+            if listing is not None:
+                is_new_name = key[2] not in listing
+                listing[key[2]] = descriptor
+                self.listing_parents[(drive_id, str(descriptor.get("id")))] = key[1]
+                if is_new_name:
+                    self.listings.update_size(key[:2])
+
+    def add_listing(self, drive_id, folder_id, descriptors, listed_at):
+        # descriptors are all the children of the folder, as listed from listed_at on
+        listing = {}
+        for descriptor in descriptors:
+            if descriptor and descriptor.get("id") is not None:
+                listing[descriptor.get("name")] = descriptor
+        with self.lock:
+            if not self.listings.put((drive_id, str(folder_id)), listing, created_at=listed_at):
+                return
+            for descriptor in listing.values():
+                self.listing_parents[(drive_id, str(descriptor.get("id")))] = str(folder_id)
+
+    def get_max_listing_size(self):
+        # The most children a folder can have for its listing to be kept whole
+        return self.listings.max_size - 1
+
+    def forget_listing_parents(self, key, listing):
+        # Called by the listings cache, always under self.lock
+        drive_id, folder_id = key
+        for descriptor in listing.values():
+            child_key = (drive_id, str(descriptor.get("id")))
+            if self.listing_parents.get(child_key) == folder_id:
+                del self.listing_parents[child_key]
+
+    def get_known_path(self, drive_id, root_file_id, path):
+        with self.lock:
+            return self.known_paths.get((drive_id, str(root_file_id), path))
+
+    def add_known_path(self, drive_id, root_file_id, path, item_id):
+        if item_id is None:
+            return
+        key = (drive_id, str(root_file_id), path)
+        with self.lock:
+            self.known_paths.put(key, item_id)
+            self.known_paths_by_id.put((drive_id, str(item_id)), key)
+            parent_key = (drive_id, str(root_file_id), get_parent_path(path))
+            self.known_path_children.setdefault(parent_key, set()).add(path)
+
+    def forget_known_path(self, drive_id, root_file_id, path):
+        with self.lock:
+            self.forget_known_paths_below((drive_id, str(root_file_id), path))
+
+    def forget_known_paths_below(self, key):
+        # Forgets the known path of key and all the ones below it
+        keys = [key]
+        while keys:
+            drive_id, root_file_id, path = keys.pop()
+            self.known_paths.pop((drive_id, root_file_id, path))
+            for child_path in self.known_path_children.pop((drive_id, root_file_id, path), ()):
+                keys.append((drive_id, root_file_id, child_path))
+
+    def forget_known_path_child(self, key, item_id):
+        # Called by the known paths cache, always under self.lock
+        drive_id, root_file_id, path = key
+        parent_key = (drive_id, root_file_id, get_parent_path(path))
+        siblings = self.known_path_children.get(parent_key)
+        if siblings is not None:
+            siblings.discard(path)
+            if not siblings:
+                del self.known_path_children[parent_key]
+
+    def invalidate_item(self, drive_id, item_id):
+        with self.lock:
+            key = self.keys_by_id.pop((drive_id, str(item_id)))
+            if key:
+                self.items.pop(key)
+                self.listings.pop(key[:2])
+            parent_id = self.listing_parents.get((drive_id, str(item_id)))
+            if parent_id is not None:
+                self.listings.pop((drive_id, parent_id))
+            self.listings.pop((drive_id, str(item_id)))
+            known_path_key = self.known_paths_by_id.pop((drive_id, str(item_id)))
+            if known_path_key:
+                self.forget_known_paths_below(known_path_key)
+
+    def invalidate_name(self, drive_id, parent_id, name):
+        with self.lock:
+            self.items.pop((drive_id, str(parent_id), name))
+            self.listings.pop((drive_id, str(parent_id)))
+
+    def invalidate_folder(self, drive_id, folder_id):
+        with self.lock:
+            self.listings.pop((drive_id, str(folder_id)))
+
+    def clear(self):
+        with self.lock:
+            self.items.clear()
+            self.keys_by_id.clear()
+            self.listings.clear()
+            self.listing_parents.clear()
+            self.known_paths.clear()
+            self.known_paths_by_id.clear()
+            self.known_path_children.clear()
+
+
+def get_listing_size(listing):
+    # one more than the children, so that empty listings are bounded too
+    return len(listing) + 1
+
+
+def get_parent_path(path):
+    return path.rpartition("/")[0]
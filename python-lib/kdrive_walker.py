@@ -0,0 +1,122 @@
+from concurrent.futures import ThreadPoolExecutor
+from infomaniak_client import Item
+from safe_logger import SafeLogger
+import os
+import threading
+import time
+
+logger = SafeLogger("kDrive walker")
+
+
+class FolderNode(object):
+    def __init__(self, file_id, path):
+        self.file_id = file_id
+        self.path = path
+        self.children = []
+
+
+class FolderWalker(object):
+    # Lists a folder tree level by level, the folders of one level being listed concurrently.
+    # The files are then returned in the same order as a depth-first walk would give them.
+    def __init__(self, client, drive_id, max_workers=8, max_requests_per_second=None):
+        self.client = client
+        self.drive_id = drive_id
+        self.max_workers = max(1, max_workers or 1)
+        self.min_interval = 1.0 / max_requests_per_second if max_requests_per_second else 0
+        self.next_request_time = 0
+        self.pace_lock = threading.Lock()
+
+    def walk(self, folder_id, path, first_non_empty=False):
+        root = FolderNode(folder_id, path)
+        frontier = [root]
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            while frontier:
+                logger.info("Listing {} folders", len(frontier))
+                next_frontier = []
+                for node, folder_items in zip(frontier, self.list_frontier(executor, frontier)):
+                    for folder_item in folder_items:
+                        item_path = os.path.join(node.path, folder_item.get("name"))
+                        if folder_item.get("type") == "dir":
+                            child_node = FolderNode(folder_item.get("id"), item_path)
+                            node.children.append(child_node)
+                            next_frontier.append(child_node)
+                        else:
+                            item = Item(self.client, self.drive_id, item_path, folder_item)
+                            if first_non_empty and item.get_size():
+                                return [item]
+                            node.children.append(item)
+                frontier = next_frontier
+        return list(self.get_next_file(root))
+
+    def list_frontier(self, executor, frontier):
+        # Without pacing, a client with an async bridge lists the whole level at once
+        if self.client.async_bridge and not self.min_interval:
+            return self.client.list_folders(self.drive_id, [node.file_id for node in frontier])
+        return executor.map(self.client.metrics.with_current_operation(self.list_folder), frontier)
+
+    def list_folder(self, node):
+        self.pace()
+        return list(self.client.get_next_folder_item(self.drive_id, node.file_id))
+
+    def pace(self):
+        if not self.min_interval:
+            return
+        with self.pace_lock:
+            now = time.time()
+            wait_time = self.next_request_time - now
+            self.next_request_time = max(now, self.next_request_time) + self.min_interval
+        if wait_time > 0:
+            time.sleep(wait_time)
+
+    def get_next_file(self, node):
+        for child in node.children:
+            if isinstance(child, FolderNode):
+                for item in self.get_next_file(child):
+                    yield item
+            else:
+                yield child
+
+
+class SearchWalker(object):
+    # Fetches a whole subtree through the search endpoint, then rebuilds the paths from the parent ids.
+    # Raises if the search is not available or returns items whose parents are unknown.
+    def __init__(self, client, drive_id):
+        self.client = client
+        self.drive_id = drive_id
+
+    def walk(self, folder_id, path, first_non_empty=False):
+        folder_id = str(folder_id)
+        folders = {}
+        files = []
+        for descriptor in self.client.get_next_subtree_item(self.drive_id, folder_id):
+            if descriptor.get("type") == "dir":
+                folders[str(descriptor.get("id"))] = descriptor
+            else:
+                files.append(descriptor)
+        logger.info("Search returned {} files and {} folders", len(files), len(folders))
+        folder_paths = {folder_id: path}
+        items = []
+        for descriptor in files:
+            parent_path = self.get_folder_path(str(descriptor.get("parent_id")), folders, folder_paths)
+            item_path = os.path.join(parent_path, descriptor.get("name"))
+            items.append(Item(self.client, self.drive_id, item_path, descriptor))
+        items.sort(key=lambda item: item.path)
+        if first_non_empty:
+            for item in items:
+                if item.get_size():
+                    return [item]
+        return items
+
+    def get_folder_path(self, folder_id, folders, folder_paths):
+        missing_folder_ids = []
+        while folder_id not in folder_paths:
+            folder = folders.get(folder_id)
+            if folder is None or folder_id in missing_folder_ids:
+                raise Exception("Folder {} is not part of the search results".format(folder_id))
+            missing_folder_ids.append(folder_id)
+            folder_id = str(folder.get("parent_id"))
+        parent_path = folder_paths[folder_id]
+        for missing_folder_id in reversed(missing_folder_ids):
+            parent_path = os.path.join(parent_path, folders[missing_folder_id].get("name"))
+            folder_paths[missing_folder_id] = parent_path
+        return parent_path
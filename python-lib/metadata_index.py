@@ -0,0 +1,177 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+from safe_logger import SafeLogger
+
+logger = SafeLogger("metadata-index")
+
+SCHEMA = [
+    """CREATE TABLE IF NOT EXISTS items (
+        drive_id TEXT NOT NULL,
+        file_id TEXT NOT NULL,
+        parent_id TEXT,
+        name TEXT,
+        type TEXT,
+        size INTEGER,
+        last_modified_at INTEGER,
+        descriptor TEXT,
+        PRIMARY KEY (drive_id, file_id)
+    )""",
+    "CREATE INDEX IF NOT EXISTS items_by_parent ON items (drive_id, parent_id)",
+    """CREATE TABLE IF NOT EXISTS folders (
+        drive_id TEXT NOT NULL,
+        folder_id TEXT NOT NULL,
+        last_modified_at INTEGER,
+        listed_at REAL,
+        is_dirty INTEGER NOT NULL DEFAULT 0,
+        PRIMARY KEY (drive_id, folder_id)
+    )""",
+    """CREATE TABLE IF NOT EXISTS sync_state (
+        drive_id TEXT NOT NULL PRIMARY KEY,
+        synced_at REAL
+    )"""
+]
+
+
+class MetadataIndex(object):
+    # On-disk copy of the folder listings, shared by the job processes using the same token.
+    # A folder's children are served from here until the folder is marked dirty, either by one
+    # of our own writes, by the activity feed, or because its last_modified_at changed.
+    def __init__(self, database_path, max_age=86400):
+        self.database_path = database_path
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        directory = os.path.dirname(database_path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.connection = sqlite3.connect(database_path, timeout=30, check_same_thread=False)
+        with self.lock, self.connection:
+            self.connection.execute("PRAGMA journal_mode=WAL")
+            for statement in SCHEMA:
+                self.connection.execute(statement)
+
+    def get_children(self, drive_id, folder_id):
+        # None if the folder is not indexed, or stale
+        drive_id, folder_id = str(drive_id), str(folder_id)
+        with self.lock:
+            folder = self.connection.execute(
+                "SELECT listed_at, is_dirty FROM folders WHERE drive_id=? AND folder_id=?",
+                (drive_id, folder_id)
+            ).fetchone()
+            if folder is None:
+                return None
+            listed_at, is_dirty = folder
+            if is_dirty or (self.max_age and listed_at < time.time() - self.max_age):
+                return None
+            rows = self.connection.execute(
+                "SELECT descriptor FROM items WHERE drive_id=? AND parent_id=? ORDER BY rowid",
+                (drive_id, folder_id)
+            ).fetchall()
+        return [json.loads(row[0]) for row in rows]
+
+    def get_item(self, drive_id, file_id):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT descriptor FROM items WHERE drive_id=? AND file_id=?",
+                (str(drive_id), str(file_id))
+            ).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def replace_children(self, drive_id, folder_id, descriptors):
+        drive_id, folder_id = str(drive_id), str(folder_id)
+        now = time.time()
+        with self.lock, self.connection:
+            changed_folder_ids = self.get_changed_folder_ids(drive_id, descriptors)
+            self.connection.execute("DELETE FROM items WHERE drive_id=? AND parent_id=?", (drive_id, folder_id))
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+                [
+                    (
+                        drive_id,
+                        str(descriptor.get("id")),
+                        folder_id,
+                        descriptor.get("name"),
+                        descriptor.get("type"),
+                        descriptor.get("size"),
+                        descriptor.get("last_modified_at"),
+                        json.dumps(descriptor)
+                    ) for descriptor in descriptors if descriptor.get("id") is not None
+                ]
+            )
+            folder_last_modified_at = self.connection.execute(
+                "SELECT last_modified_at FROM items WHERE drive_id=? AND file_id=?",
+                (drive_id, folder_id)
+            ).fetchone()
+            self.connection.execute(
+                "INSERT OR REPLACE INTO folders VALUES (?, ?, ?, ?, 0)",
+                (drive_id, folder_id, folder_last_modified_at[0] if folder_last_modified_at else None, now)
+            )
+            self.connection.executemany(
+                "UPDATE folders SET is_dirty=1 WHERE drive_id=? AND folder_id=?",
+                [(drive_id, changed_folder_id) for changed_folder_id in changed_folder_ids]
+            )
+
+    def get_changed_folder_ids(self, drive_id, descriptors):
+        # Sub folders whose last_modified_at moved since their own children were indexed
+        changed_folder_ids = []
+        for descriptor in descriptors:
+            if descriptor.get("type") != "dir":
+                continue
+            folder = self.connection.execute(
+                "SELECT last_modified_at FROM folders WHERE drive_id=? AND folder_id=?",
+                (drive_id, str(descriptor.get("id")))
+            ).fetchone()
+            if folder and folder[0] != descriptor.get("last_modified_at"):
+                changed_folder_ids.append(str(descriptor.get("id")))
+        return changed_folder_ids
+
+    def mark_folder_dirty(self, drive_id, folder_id):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "UPDATE folders SET is_dirty=1 WHERE drive_id=? AND folder_id=?",
+                (str(drive_id), str(folder_id))
+            )
+
+    def invalidate_item(self, drive_id, file_id):
+        # Marks the item's parent and the item itself (if it is a folder) as dirty
+        drive_id, file_id = str(drive_id), str(file_id)
+        with self.lock, self.connection:
+            row = self.connection.execute(
+                "SELECT parent_id FROM items WHERE drive_id=? AND file_id=?",
+                (drive_id, file_id)
+            ).fetchone()
+            folder_ids = [file_id] + ([row[0]] if row else [])
+            self.connection.executemany(
+                "UPDATE folders SET is_dirty=1 WHERE drive_id=? AND folder_id=?",
+                [(drive_id, folder_id) for folder_id in folder_ids]
+            )
+
+    def mark_all_dirty(self, drive_id):
+        with self.lock, self.connection:
+            self.connection.execute("UPDATE folders SET is_dirty=1 WHERE drive_id=?", (str(drive_id),))
+
+    def get_synced_at(self, drive_id):
+        with self.lock:
+            row = self.connection.execute(
+                "SELECT synced_at FROM sync_state WHERE drive_id=?",
+                (str(drive_id),)
+            ).fetchone()
+        return row[0] if row else None
+
+    def set_synced_at(self, drive_id, synced_at):
+        with self.lock, self.connection:
+            self.connection.execute(
+                "INSERT OR REPLACE INTO sync_state VALUES (?, ?)",
+                (str(drive_id), synced_at)
+            )
+
+    def close(self):
+        with self.lock:
+            self.connection.close()
+
+
+def get_index_path(directory, token_fingerprint):
+    # One database per API token, so that users never see listings made with someone else's rights
+    return os.path.join(directory, "kdrive-index-{}.sqlite".format(token_fingerprint[:16]))
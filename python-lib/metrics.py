@@ -0,0 +1,192 @@
+import contextvars
+import functools
+import re
+import threading
+import time
+from contextlib import contextmanager
+
+LATENCY_BUCKETS = [0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+ID_PATH_TOKEN = re.compile(r"^(\d+|[0-9a-fA-F-]{16,})$")
+
+
+class LatencyHistogram(object):
+    def __init__(self):
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+        for index, bucket in enumerate(LATENCY_BUCKETS):
+            if seconds <= bucket:
+                self.counts[index] += 1
+                return
+        self.counts[-1] += 1
+
+    def to_dict(self):
+        buckets = {}
+        for bucket, count in zip(LATENCY_BUCKETS + ["inf"], self.counts):
+            if count:
+                buckets["<={}".format(bucket)] = count
+        return {
+            "count": self.count,
+            "total_seconds": round(self.total, 3),
+            "mean_seconds": round(self.total / self.count, 3) if self.count else 0,
+            "max_seconds": round(self.max, 3),
+            "buckets": buckets
+        }
+
+
+class Metrics(object):
+    # Counts the API requests per endpoint and per FSProvider operation.
+    # Requests are attributed to the operation running in their thread or asyncio task when they are sent.
+    # Worker threads and coroutines do not inherit it, work handed to them is wrapped by with_current_operation
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.endpoints = {}
+        self.operations = {}
+        self.operation_variable = contextvars.ContextVar("operation", default=None)
+        self.retries = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.caches = {}
+        self.summary_hooks = []
+
+    @property
+    def current_operation(self):
+        return self.operation_variable.get()
+
+    @contextmanager
+    def operation(self, operation_name):
+        token = self.operation_variable.set(operation_name)
+        start = time.time()
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            with self.lock:
+                operation = self.get_operation(operation_name)
+                operation["histogram"].record(elapsed)
+            self.operation_variable.reset(token)
+
+    def with_current_operation(self, function):
+        # Wraps function so that the requests it sends from another thread count for the operation running now
+        operation_name = self.current_operation
+
+        def run_in_operation(*args, **kwargs):
+            token = self.operation_variable.set(operation_name)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.operation_variable.reset(token)
+        return run_in_operation
+
+    def in_current_operation(self, coroutine):
+        # Same as with_current_operation, for a coroutine run as a task of another thread's event loop
+        operation_name = self.current_operation
+
+        async def run_in_operation():
+            # the task runs in a copy of the context, the operation does not need to be reset
+            self.operation_variable.set(operation_name)
+            return await coroutine
+        return run_in_operation()
+
+    def get_operation(self, operation_name):
+        operation = self.operations.get(operation_name)
+        if operation is None:
+            operation = {"histogram": LatencyHistogram(), "requests": 0, "endpoints": {}}
+            self.operations[operation_name] = operation
+        return operation
+
+    def record_request(self, method, url, status_code, seconds, bytes_in=0, bytes_out=0):
+        endpoint_name = get_endpoint_name(method, url)
+        with self.lock:
+            endpoint = self.endpoints.get(endpoint_name)
+            if endpoint is None:
+                endpoint = {"histogram": LatencyHistogram(), "errors": 0, "bytes_in": 0, "bytes_out": 0}
+                self.endpoints[endpoint_name] = endpoint
+            endpoint["histogram"].record(seconds)
+            if status_code is None or status_code >= 400:
+                endpoint["errors"] += 1
+            endpoint["bytes_in"] += bytes_in
+            endpoint["bytes_out"] += bytes_out
+            self.bytes_in += bytes_in
+            self.bytes_out += bytes_out
+            if self.current_operation:
+                operation = self.get_operation(self.current_operation)
+                operation["requests"] += 1
+                operation["endpoints"][endpoint_name] = operation["endpoints"].get(endpoint_name, 0) + 1
+
+    def record_bytes_in(self, bytes_in, method=None, url=None):
+        # Bytes of a streamed response, read after its request was recorded. Counted for its endpoint if url is given
+        with self.lock:
+            self.bytes_in += bytes_in
+            if url is not None:
+                endpoint = self.endpoints.get(get_endpoint_name(method, url))
+                if endpoint is not None:
+                    endpoint["bytes_in"] += bytes_in
+
+    def record_retry(self):
+        with self.lock:
+            self.retries += 1
+
+    def record_cache(self, cache_name, is_hit):
+        with self.lock:
+            cache = self.caches.setdefault(cache_name, {"hits": 0, "misses": 0})
+            cache["hits" if is_hit else "misses"] += 1
+
+    def register_summary_hook(self, hook):
+        self.summary_hooks.append(hook)
+
+    def get_summary(self):
+        with self.lock:
+            return {
+                "operations": {
+                    name: dict(
+                        operation["histogram"].to_dict(),
+                        requests=operation["requests"],
+                        endpoints=dict(operation["endpoints"])
+                    ) for name, operation in self.operations.items()
+                },
+                "endpoints": {
+                    name: dict(
+                        endpoint["histogram"].to_dict(),
+                        errors=endpoint["errors"],
+                        bytes_in=endpoint["bytes_in"],
+                        bytes_out=endpoint["bytes_out"]
+                    ) for name, endpoint in self.endpoints.items()
+                },
+                "retries": self.retries,
+                "bytes_in": self.bytes_in,
+                "bytes_out": self.bytes_out,
+                "caches": {name: dict(cache) for name, cache in self.caches.items()}
+            }
+
+    def publish(self, summary=None):
+        summary = summary or self.get_summary()
+        for hook in self.summary_hooks:
+            hook(summary)
+        return summary
+
+
+def timed_operation(operation_name):
+    # Decorates a provider method, the provider holding a Metrics instance in self.metrics
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(self, *args, **kwargs):
+            with self.metrics.operation(operation_name):
+                return function(self, *args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def get_endpoint_name(method, url):
+    path = url.split("?")[0]
+    path = re.sub(r"^https?://[^/]+", "", path)
+    tokens = path.split("/")
+    # tokens[1] is the API version
+    tokens = tokens[:2] + ["{id}" if ID_PATH_TOKEN.match(token) else token for token in tokens[2:]]
+    return "{} {}".format(method, "/".join(tokens))
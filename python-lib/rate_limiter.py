@@ -0,0 +1,85 @@
+import threading
+import time
+from infomaniak_auth import get_token_fingerprint
+from safe_logger import SafeLogger
+
+logger = SafeLogger("rate-limiter")
+
+rate_limiters = {}
+rate_limiters_lock = threading.Lock()
+
+
+class TokenBucket(object):
+    def __init__(self, requests_per_second, burst=None):
+        self.requests_per_second = float(requests_per_second)
+        self.burst = max(1, burst or int(requests_per_second) or 1)
+        self.tokens = float(self.burst)
+        self.last_refill = time.time()
+        self.blocked_until = 0
+        self.lock = threading.Lock()
+        self.total_requests = 0
+        self.throttled_requests = 0
+        self.throttled_seconds = 0.0
+
+    def acquire(self):
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.time()
+                self.refill(now)
+                if now >= self.blocked_until and self.tokens >= 1:
+                    self.tokens -= 1
+                    self.total_requests += 1
+                    if waited:
+                        self.throttled_requests += 1
+                        self.throttled_seconds += waited
+                    return waited
+                if now < self.blocked_until:
+                    wait_time = self.blocked_until - now
+                else:
+                    wait_time = (1 - self.tokens) / self.requests_per_second
+            time.sleep(wait_time)
+            waited += wait_time
+
+    def refill(self, now):
+        elapsed = now - self.last_refill
+        self.last_refill = now
+        self.tokens = min(self.burst, self.tokens + elapsed * self.requests_per_second)
+
+    def block_for(self, seconds):
+        # Called when the server rate limits us, so that every thread sharing the token waits
+        with self.lock:
+            self.blocked_until = max(self.blocked_until, time.time() + seconds)
+            self.tokens = 0
+
+    def update(self, requests_per_second, burst=None):
+        with self.lock:
+            self.requests_per_second = float(requests_per_second)
+            self.burst = max(1, burst or int(requests_per_second) or 1)
+            self.tokens = min(self.tokens, self.burst)
+
+    def get_metrics(self):
+        with self.lock:
+            return {
+                "requests_per_second": self.requests_per_second,
+                "burst": self.burst,
+                "total_requests": self.total_requests,
+                "throttled_requests": self.throttled_requests,
+                "throttled_seconds": round(self.throttled_seconds, 3)
+            }
+
+
+def get_rate_limiter(api_token, requests_per_second, burst=None):
+    # One bucket per API token in the process, shared by every client using that token
+    if not requests_per_second:
+        return None
+    key = get_token_fingerprint(api_token)
+    with rate_limiters_lock:
+        rate_limiter = rate_limiters.get(key)
+        if rate_limiter is None:
+            logger.info("New rate limiter: {} requests/s, burst {}", requests_per_second, burst)
+            rate_limiter = TokenBucket(requests_per_second, burst=burst)
+            rate_limiters[key] = rate_limiter
+        elif rate_limiter.requests_per_second != float(requests_per_second) or (burst and rate_limiter.burst != burst):
+            rate_limiter.update(requests_per_second, burst=burst)
+        return rate_limiter
@@ -0,0 +1,134 @@
+import random
+import time
+from email.utils import parsedate_to_datetime
+from urllib3.exceptions import ConnectTimeoutError
+
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+
+RETRYABLE_STATUS_CODES = [429, 500, 502, 503, 504]
+IDEMPOTENT_METHODS = ["GET", "HEAD", "OPTIONS", "PUT", "DELETE"]
+# Answers telling that a request was not acted upon, so that even a POST can be sent again
+NOT_PROCESSED_STATUS_CODES = [429, 503]
+RATE_LIMIT_RESET_HEADERS = ["X-RateLimit-Reset", "RateLimit-Reset"]
+RATE_LIMIT_REMAINING_HEADERS = ["X-RateLimit-Remaining", "RateLimit-Remaining"]
+
+
+class RetryPolicy(object):
+    # max_retries counts the attempts made after the first one.
+    # Delays grow exponentially with full jitter, unless the server says how long to wait.
+    def __init__(self, max_retries=0, backoff_base=1.0, max_backoff=60.0, retryable_status_codes=None):
+        self.max_retries = max_retries or 0
+        self.backoff_base = backoff_base
+        self.max_backoff = max_backoff
+        self.retryable_status_codes = retryable_status_codes or RETRYABLE_STATUS_CODES
+
+    def should_retry(self, attempt, method="GET", response=None, error=None, idempotent=None):
+        # Requests that are not idempotent, such as a POST, are only sent again when the server cannot have
+        # acted on them: on a connection error raised before sending, or on a 429 or 503 with Retry-After.
+        # idempotent=True opts in the requests that are safe to resend, such as uploads
+        if attempt > self.max_retries:
+            return False
+        if idempotent is None:
+            idempotent = "{}".format(method).upper() in IDEMPOTENT_METHODS
+        if error is not None:
+            return idempotent or is_raised_before_sending(error)
+        if response is None or response.status_code not in self.retryable_status_codes:
+            return False
+        if idempotent:
+            return True
+        headers = response.headers or {}
+        return response.status_code in NOT_PROCESSED_STATUS_CODES and bool(headers.get("Retry-After"))
+
+    def get_delay(self, attempt, response=None):
+        server_delay = get_server_delay(response)
+        if server_delay is not None:
+            return server_delay
+        backoff = min(self.max_backoff, self.backoff_base * (2 ** (attempt - 1)))
+        return random.uniform(0, backoff)
+
+
+def get_connection_error_types():
+    connection_error_types = [ConnectTimeoutError]
+    if aiohttp is not None:
+        connection_error_types.append(aiohttp.ClientConnectorError)
+    if httpx is not None:
+        connection_error_types.extend([httpx.ConnectError, httpx.ConnectTimeout])
+    return tuple(connection_error_types)
+
+
+CONNECTION_ERROR_TYPES = get_connection_error_types()
+
+
+def is_raised_before_sending(error):
+    # True when the connection could not be opened. requests wraps the urllib3 error, itself
+    # wrapped in a MaxRetryError, so the causes, arguments and reasons are looked into
+    errors_to_check = [error]
+    checked_errors = set()
+    while errors_to_check:
+        error = errors_to_check.pop()
+        if error is None or id(error) in checked_errors:
+            continue
+        checked_errors.add(id(error))
+        if isinstance(error, CONNECTION_ERROR_TYPES):
+            return True
+        if isinstance(error, BaseException):
+            errors_to_check.extend([error.__cause__, getattr(error, "reason", None)])
+            errors_to_check.extend([argument for argument in error.args if isinstance(argument, BaseException)])
+    return False
+
+
+def get_server_delay(response):
+    if response is None:
+        return None
+    headers = response.headers or {}
+    retry_after = headers.get("Retry-After")
+    if retry_after:
+        return parse_retry_after(retry_after)
+    if response.status_code != 429 and not is_rate_limit_exhausted(headers):
+        return None
+    for header_name in RATE_LIMIT_RESET_HEADERS:
+        reset = headers.get(header_name)
+        if reset:
+            return parse_rate_limit_reset(reset)
+    return None
+
+
+def is_rate_limit_exhausted(headers):
+    for header_name in RATE_LIMIT_REMAINING_HEADERS:
+        remaining = headers.get(header_name)
+        if remaining is not None:
+            try:
+                return int(remaining) <= 0
+            except ValueError:
+                return False
+    return False
+
+
+def parse_retry_after(retry_after):
+    try:
+        return max(0.0, float(retry_after))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(retry_after).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+def parse_rate_limit_reset(reset):
+    try:
+        reset = float(reset)
+    except ValueError:
+        return None
+    if reset > 1000000000:
+        # epoch timestamp rather than a number of seconds
+        reset = reset - time.time()
+    return max(0.0, reset)
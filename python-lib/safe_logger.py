@@ -1,43 +1,163 @@
 import logging
-import copy
+import threading
+import time
+
+try:
+    from collections.abc import Mapping
+except ImportError:
+    from collections import Mapping
 
 MESSAGE_TEMPLATE = "{} - {}"
+DEFAULT_MAX_LOGGED_BODY = 1024
+MAX_RATE_WINDOWS = 1000
+LOG_LEVELS = {
+    "DEBUG": logging.DEBUG,
+    "INFO": logging.INFO,
+    "WARNING": logging.WARNING,
+    "ERROR": logging.ERROR
+}
+
+loggers = {}
+loggers_lock = threading.Lock()
 
 
 class SafeLogger(object):
-    def __init__(self, name, forbidden_keys=None):
+    # Messages are only formatted if their level is enabled: pass the arguments instead of
+    # formatting beforehand, as in logger.info("Listing {} folders", len(folders)).
+    # With a rate_limit, each message template is logged at most rate_limit times per second,
+    # the number of messages dropped meanwhile being appended to the next one. Errors are never dropped.
+    def __init__(self, name, forbidden_keys=None, rate_limit=None):
         self.name = name
         self.logger = logging.getLogger(self.name)
+        # the logger's name is part of the message, the first SafeLogger created sets the format for all
         logging.basicConfig(
             level=logging.INFO,
-            format='{} %(levelname)s - %(message)s'.format(self.name)
+            format='%(levelname)s - %(message)s'
         )
         self.forbidden_keys = forbidden_keys
+        self.lowercase_forbidden_keys = set("{}".format(key).lower() for key in forbidden_keys or [])
+        self.rate_limit = rate_limit
+        self.rate_windows = {}
+        self.rate_lock = threading.Lock()
+        with loggers_lock:
+            loggers[name] = self
+
+    def info(self, message, *args):
+        self.log(logging.INFO, message, args)
+
+    def debug(self, message, *args):
+        self.log(logging.DEBUG, message, args)
+
+    def warning(self, message, *args):
+        self.log(logging.WARNING, message, args)
+
+    def error(self, message, *args):
+        self.log(logging.ERROR, message, args)
+
+    def is_enabled_for(self, level):
+        return self.logger.isEnabledFor(level)
+
+    def log(self, level, message, args):
+        if not self.logger.isEnabledFor(level):
+            return
+        suffix = ""
+        if self.rate_limit and level < logging.ERROR:
+            is_allowed, dropped_count = self.check_rate(message)
+            if not is_allowed:
+                return
+            if dropped_count:
+                suffix = " ({} similar messages dropped)".format(dropped_count)
+        if args:
+            message = message.format(*args)
+        self.logger.log(level, MESSAGE_TEMPLATE.format(self.name, message) + suffix)
+
+    def check_rate(self, message):
+        # Returns (is_allowed, number of messages dropped since the last one allowed)
+        now = time.time()
+        with self.rate_lock:
+            if len(self.rate_windows) > MAX_RATE_WINDOWS:
+                # preformatted messages are all different, they must not pile up
+                self.rate_windows.clear()
+            window = self.rate_windows.get(message)
+            if window is None or now - window[0] >= 1.0:
+                dropped_count = window[2] if window else 0
+                self.rate_windows[message] = [now, 1, 0]
+                return True, dropped_count
+            if window[1] < self.rate_limit:
+                window[1] += 1
+                return True, 0
+            window[2] += 1
+            return False, 0
+
+    def set_level(self, level):
+        self.logger.setLevel(get_log_level(level))
+
+    def filter_secrets(self, data):
+        # Returns data with the values of the forbidden keys hashed, in a single pass. Keys are compared
+        # case-insensitively, as in HTTP headers. Only the dicts and lists leading to a forbidden key are
+        # copied, into plain dicts and lists, everything else is shared with data
+        if not self.lowercase_forbidden_keys:
+            return data
+        return self.filter_value(data)
+
+    def filter_value(self, value):
+        if isinstance(value, Mapping):
+            filtered_mapping = None
+            for key, item in value.items():
+                if isinstance(key, str) and key.lower() in self.lowercase_forbidden_keys:
+                    filtered_item = hash(item)
+                else:
+                    filtered_item = self.filter_value(item)
+                if filtered_item is not item:
+                    if filtered_mapping is None:
+                        filtered_mapping = dict(value.items())
+                    filtered_mapping[key] = filtered_item
+            return value if filtered_mapping is None else filtered_mapping
+        if isinstance(value, (list, tuple)):
+            filtered_list = None
+            for index, item in enumerate(value):
+                filtered_item = self.filter_value(item)
+                if filtered_item is not item:
+                    if filtered_list is None:
+                        filtered_list = list(value)
+                    filtered_list[index] = filtered_item
+            return value if filtered_list is None else filtered_list
+        return value
+
+
+def configure_logging(level=None, component_levels=None, rate_limit=None):
+    # level applies to all the plugin's loggers, component_levels maps logger names to their own level
+    with loggers_lock:
+        safe_loggers = list(loggers.values())
+    for safe_logger in safe_loggers:
+        component_level = (component_levels or {}).get(safe_logger.name, level)
+        if component_level:
+            safe_logger.set_level(component_level)
+        if rate_limit is not None:
+            safe_logger.rate_limit = rate_limit or None
 
-    def info(self, message):
-        self.logger.info(MESSAGE_TEMPLATE.format(self.name, message))
 
-    def debug(self, message):
-        self.logger.debug(MESSAGE_TEMPLATE.format(self.name, message))
+def parse_component_levels(setting):
+    # "api-client:DEBUG, metadata-index:WARNING" -> {"api-client": "DEBUG", "metadata-index": "WARNING"}
+    component_levels = {}
+    for component_setting in (setting or "").split(","):
+        if ":" not in component_setting:
+            continue
+        name, level = component_setting.rsplit(":", 1)
+        component_levels[name.strip()] = level.strip()
+    return component_levels
 
-    def warning(self, message):
-        self.logger.warning(MESSAGE_TEMPLATE.format(self.name, message))
 
-    def error(self, message):
-        self.logger.error(MESSAGE_TEMPLATE.format(self.name, message))
+def get_log_level(level):
+    if isinstance(level, int):
+        return level
+    return LOG_LEVELS.get("{}".format(level).upper(), logging.INFO)
 
-    def filter_secrets(self, dictionary):
-        ret = copy.deepcopy(dictionary)
-        ret = self.dig_secrets(ret)
-        return ret
 
-    def dig_secrets(self, dictionary):
-        for key in dictionary:
-            if isinstance(dictionary[key], dict):
-                dictionary[key] = self.filter_secrets(dictionary[key])
-            if key in self.forbidden_keys:
-                dictionary[key] = hash(dictionary[key])
-        return dictionary
+def truncate(data, max_length=DEFAULT_MAX_LOGGED_BODY):
+    if data is None or len(data) <= max_length:
+        return data
+    return "{}... ({} more)".format(data[:max_length], len(data) - max_length)
 
 
 def hash(data):
@@ -0,0 +1,130 @@
+from concurrent.futures import ThreadPoolExecutor
+from safe_logger import SafeLogger
+import threading
+
+logger = SafeLogger("upload-queue")
+
+
+class UploadQueue(object):
+    # Runs uploads on max_workers threads so that write() can return before they are done.
+    # At most max_pending_bytes of queued data are held in memory, submit() blocking until uploads
+    # complete. Errors are raised by the next submit() or flush(), whichever comes first.
+    # The last staged upload is only submitted with the next one, so that its arguments
+    # can still be completed, for instance with the modification time set right after a write.
+    # With max_workers=0, submitted uploads run right away in the caller's thread, and raise there
+    def __init__(self, max_workers=8, max_pending_bytes=256 * 1024 * 1024):
+        self.executor = ThreadPoolExecutor(max_workers=max_workers) if max_workers > 0 else None
+        self.max_pending_bytes = max_pending_bytes
+        self.condition = threading.Condition()
+        self.pending_bytes = 0
+        self.pending_uploads = {}
+        self.errors = []
+        self.staged_upload = None
+
+    def submit(self, key, size, function, *args, **kwargs):
+        # Uploads with the same key, the target path, run one after the other in submission order.
+        # Earlier errors are raised once this upload is queued, so that it is not lost
+        if self.executor is None:
+            return function(*args, **kwargs)
+        with self.condition:
+            while self.pending_bytes and self.pending_bytes + size > self.max_pending_bytes:
+                self.condition.wait()
+            self.pending_bytes += size
+            previous_upload = self.pending_uploads.get(key)
+            upload = self.executor.submit(self.run, key, size, previous_upload, function, args, kwargs)
+            self.pending_uploads[key] = upload
+        upload.add_done_callback(lambda done_upload: self.forget(key, done_upload))
+        self.raise_errors()
+        return upload
+
+    def stage(self, key, size, function, *args, **kwargs):
+        # The new upload is staged before the previous one is submitted, which can raise
+        with self.condition:
+            previous_upload, self.staged_upload = self.staged_upload, (key, size, function, args, kwargs)
+        if previous_upload:
+            previous_key, previous_size, previous_function, previous_args, previous_kwargs = previous_upload
+            self.submit(previous_key, previous_size, previous_function, *previous_args, **previous_kwargs)
+
+    def update_staged(self, key, **kwargs):
+        # Adds keyword arguments to the staged upload of key and submits it. False if key is not the one staged
+        with self.condition:
+            if self.staged_upload is None or self.staged_upload[0] != key:
+                return False
+            self.staged_upload[4].update(kwargs)
+        self.submit_staged()
+        return True
+
+    def submit_staged(self):
+        with self.condition:
+            staged_upload, self.staged_upload = self.staged_upload, None
+        if staged_upload:
+            key, size, function, args, kwargs = staged_upload
+            self.submit(key, size, function, *args, **kwargs)
+
+    def forget(self, key, upload):
+        with self.condition:
+            if self.pending_uploads.get(key) is upload:
+                self.pending_uploads.pop(key)
+
+    def run(self, key, size, previous_upload, function, args, kwargs):
+        try:
+            if previous_upload:
+                previous_upload.result()
+            function(*args, **kwargs)
+        except Exception as error:
+            logger.error("Upload of {} failed: {}", key, error)
+            with self.condition:
+                self.errors.append((key, error))
+        finally:
+            with self.condition:
+                self.pending_bytes -= size
+                self.condition.notify_all()
+
+    def flush(self):
+        self.submit_staged()
+        with self.condition:
+            uploads = list(self.pending_uploads.values())
+        for upload in uploads:
+            upload.result()
+        self.raise_errors()
+
+    def raise_errors(self):
+        with self.condition:
+            errors, self.errors = self.errors, []
+        if errors:
+            raise Exception("{} uploads failed, first one {}: {}".format(len(errors), errors[0][0], errors[0][1]))
+
+    def close(self):
+        try:
+            self.flush()
+        finally:
+            if self.executor is not None:
+                self.executor.shutdown(wait=True)
+
+
+class PrefixedStream(object):
+    # Gives back the bytes already read from a stream, then the rest of it
+    def __init__(self, prefix, stream):
+        self.prefix = prefix
+        self.stream = stream
+
+    def read(self, size=-1):
+        if not self.prefix:
+            return self.stream.read(size)
+        if size is None or size < 0:
+            data, self.prefix = self.prefix + self.stream.read(), b""
+            return data
+        data, self.prefix = self.prefix[:size], self.prefix[size:]
+        return data
+
+
+def read_up_to(stream, size):
+    data = []
+    remaining = size
+    while remaining > 0:
+        chunk = stream.read(remaining)
+        if not chunk:
+            break
+        data.append(chunk)
+        remaining -= len(chunk)
+    return b"".join(data)
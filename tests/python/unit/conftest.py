@@ -0,0 +1,64 @@
+import io
+import json
+import os
+import socket
+import sys
+
+import pytest
+import requests
+
+PLUGIN_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), "..", "..", ".."))
+
+sys.path.insert(0, os.path.join(PLUGIN_DIR, "python-lib"))
+sys.path.insert(0, os.path.join(PLUGIN_DIR, "benchmarks"))
+
+from fake_kdrive_server import FakeDrive, FakeKdriveServer  # noqa: E402
+
+
+class FakeSession(object):
+    # Stands for a requests.Session, answer(method, url) returning the responses. The requests sent are kept
+    def __init__(self, answer):
+        self.answer = answer
+        self.requests = []
+
+    def request(self, method, url, **kwargs):
+        self.requests.append((method, url))
+        return self.answer(method, url)
+
+
+def build_response(status_code, payload=None, headers=None):
+    response = requests.Response()
+    response.status_code = status_code
+    response.headers = requests.structures.CaseInsensitiveDict(headers or {})
+    response._content = json.dumps({} if payload is None else payload).encode("utf-8")
+    response.raw = io.BytesIO()
+    return response
+
+
+def get_closed_port():
+    with socket.socket() as listening_socket:
+        listening_socket.bind(("127.0.0.1", 0))
+        return listening_socket.getsockname()[1]
+
+
+@pytest.fixture
+def start_server():
+    # start_server(tree settings..., server settings...) runs a fake kDrive until the end of the test
+    servers = []
+
+    def start(latency=0, max_page_size=1000, supports_ranges=True, **tree_settings):
+        drive = FakeDrive()
+        if tree_settings:
+            drive.build_synthetic_tree(**tree_settings)
+        fake_server = FakeKdriveServer(
+            drive=drive,
+            latency=latency,
+            max_page_size=max_page_size,
+            supports_ranges=supports_ranges
+        ).start()
+        servers.append(fake_server)
+        return fake_server
+
+    yield start
+    for fake_server in servers:
+        fake_server.stop()
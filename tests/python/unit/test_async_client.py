@@ -0,0 +1,43 @@
+import pytest
+
+from infomaniak_client import KdriveClient
+
+pytest.importorskip("aiohttp")
+
+from async_client import get_async_bridge  # noqa: E402
+
+
+@pytest.fixture
+def client(start_server):
+    server = start_server(depth=2, folders_per_folder=1, files_per_folder=1, file_size=10)
+    client = KdriveClient(api_token="token", api_url=server.url, http_cache_size=0)
+    client.use_async_bridge(get_async_bridge("token", client, 4))
+    client.drive = server.drive
+    yield client
+    client.close()
+
+
+@pytest.mark.parametrize("change", ["delete", "rename", "move"])
+def test_folder_changed_by_the_async_client_is_forgotten_by_make_dirs(client, change):
+    drive = client.drive
+    folder_id = client.make_dirs(drive.drive_id, drive.root_id, "folder_000/folder_000")
+    parent_id = client.make_dirs(drive.drive_id, drive.root_id, "folder_000")
+    async_client = client.async_bridge.client
+    if change == "delete":
+        client.async_bridge.run(async_client.delete_item(drive.drive_id, parent_id))
+    elif change == "rename":
+        client.async_bridge.run(async_client.rename(drive.drive_id, parent_id, "renamed"))
+    else:
+        destination_id = client.make_dirs(drive.drive_id, drive.root_id, "destination")
+        client.async_bridge.run(async_client.move_item(drive.drive_id, parent_id, destination_id))
+    assert client.directory_ids == {}
+    assert client.make_dirs(drive.drive_id, drive.root_id, "folder_000/folder_000") != folder_id
+
+
+def test_file_uploaded_by_the_async_client_is_found_without_a_request(client):
+    drive = client.drive
+    async_client = client.async_bridge.client
+    client.async_bridge.run(async_client.write_file_content(drive.drive_id, drive.root_id, "/data.csv", b"data"))
+    is_known, descriptor = client.path_cache.lookup(drive.drive_id, drive.root_id, "data.csv")
+    assert is_known and descriptor["size"] == 4
+    assert drive.contents[descriptor["id"]] == b"data"
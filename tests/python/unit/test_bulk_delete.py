@@ -0,0 +1,49 @@
+import pytest
+from conftest import FakeSession, build_response
+from infomaniak_client import KdriveClient
+from retry_policy import RetryPolicy
+
+
+def build_session(bulk_status_code, bulk_error=None):
+    # Answers the bulk action with bulk_status_code and bulk_error, and the one by one deletions with a success
+    def answer(method, url):
+        if url.endswith("/files/bulk") and bulk_error:
+            return build_response(bulk_status_code, {"result": "error", "error": {"code": bulk_error}})
+        if url.endswith("/files/bulk"):
+            return build_response(bulk_status_code, {"result": "success", "data": True})
+        return build_response(200, {"result": "success", "data": True})
+    return FakeSession(answer)
+
+
+def get_deleted_urls(session):
+    return sorted(url for method, url in session.requests if method == "DELETE")
+
+
+def build_client(session):
+    client = KdriveClient(
+        api_token="token",
+        api_url="http://kdrive",
+        http_cache_size=0,
+        retry_policy=RetryPolicy(max_retries=0)
+    )
+    client.client.session = session
+    return client
+
+
+@pytest.mark.parametrize("status_code, error_code", [(404, None), (405, None), (400, "action_not_supported")])
+def test_items_are_deleted_one_by_one_where_bulk_delete_is_not_supported(status_code, error_code):
+    session = build_session(status_code, error_code)
+    client = build_client(session)
+    assert client.delete_items("1000", [11, 12]) == 2
+    assert not client.is_bulk_delete_supported
+    assert get_deleted_urls(session) == ["http://kdrive/2/drive/1000/files/11", "http://kdrive/2/drive/1000/files/12"]
+
+
+@pytest.mark.parametrize("status_code, error_code", [(500, None), (403, "forbidden"), (200, "not_authorized")])
+def test_bulk_delete_failure_is_raised(status_code, error_code):
+    session = build_session(status_code, error_code)
+    client = build_client(session)
+    with pytest.raises(Exception):
+        client.delete_items("1000", [11, 12])
+    assert client.is_bulk_delete_supported
+    assert get_deleted_urls(session) == []
@@ -0,0 +1,84 @@
+import io
+import os
+import threading
+import time
+
+import pytest
+
+import content_cache
+from content_cache import ContentCache
+
+CONTENT = b"0123456789" * 100
+
+
+class SlowDownload(object):
+    # download() of ContentCache.fill, counting its calls and slow enough for concurrent readers to meet
+    def __init__(self, content=CONTENT, delay=0.2):
+        self.content = content
+        self.delay = delay
+        self.calls = 0
+        self.lock = threading.Lock()
+
+    def __call__(self, target):
+        with self.lock:
+            self.calls += 1
+        time.sleep(self.delay)
+        target.write(self.content)
+        return len(self.content)
+
+
+def fill_concurrently(caches, download):
+    # One reader per cache, all filling the same entry at once. Returns what each one read
+    streams = [io.BytesIO() for _ in caches]
+    errors = []
+
+    def fill(cache, stream):
+        try:
+            cache.fill("1000", 42, 1600000000, len(CONTENT), download, stream)
+        except Exception as error:
+            errors.append(error)
+
+    threads = [threading.Thread(target=fill, args=(cache, stream)) for cache, stream in zip(caches, streams)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert errors == []
+    return [stream.getvalue() for stream in streams]
+
+
+def test_concurrent_readers_of_one_file_download_it_once(tmp_path):
+    cache = ContentCache(str(tmp_path), 10000)
+    download = SlowDownload()
+    assert fill_concurrently([cache] * 8, download) == [CONTENT] * 8
+    assert download.calls == 1
+
+
+@pytest.mark.skipif(content_cache.fcntl is None, reason="file locks need fcntl")
+def test_caches_sharing_a_directory_download_a_file_once(tmp_path):
+    # as DSS processes do, each with its own provider
+    download = SlowDownload()
+    caches = [ContentCache(str(tmp_path), 10000) for _ in range(4)]
+    assert fill_concurrently(caches, download) == [CONTENT] * 4
+    assert download.calls == 1
+
+
+def test_failed_download_leaves_no_entry(tmp_path):
+    cache = ContentCache(str(tmp_path), 10000)
+    with pytest.raises(Exception, match="instead of"):
+        cache.fill("1000", 42, 1600000000, len(CONTENT) + 1, SlowDownload(delay=0), io.BytesIO())
+    assert [name for name in os.listdir(str(tmp_path)) if not name.endswith(".lock")] == []
+    download = SlowDownload(delay=0)
+    cache.fill("1000", 42, 1600000000, len(CONTENT), download, io.BytesIO())
+    assert download.calls == 1
+
+
+def test_new_version_of_a_file_replaces_the_old_one(tmp_path):
+    cache = ContentCache(str(tmp_path), 10000)
+    cache.fill("1000", 42, 1600000000, len(CONTENT), SlowDownload(delay=0), io.BytesIO())
+    new_content = b"new"
+    cache.fill("1000", 42, 1600000100, len(new_content), SlowDownload(new_content, delay=0), io.BytesIO())
+    assert cache.copy_to_stream(cache.get_entry_path("1000", 42, 1600000000, len(CONTENT)), io.BytesIO()) is None
+    stream = io.BytesIO()
+    assert cache.copy_to_stream(cache.get_entry_path("1000", 42, 1600000100, len(new_content)), stream) == 3
+    assert stream.getvalue() == new_content
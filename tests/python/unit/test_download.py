@@ -0,0 +1,81 @@
+import io
+import os
+
+import pytest
+
+from infomaniak_client import KdriveClient, MAX_RESUME_ATTEMPTS
+
+DOWNLOAD_ENDPOINT = "GET /2/drive/{id}/files/{id}/download"
+
+
+def start_download_server(start_server, supports_ranges=True, size=10000):
+    # A fake kDrive holding one file of random bytes, so that misplaced parts show
+    server = start_server(supports_ranges=supports_ranges)
+    content = os.urandom(size)
+    descriptor = server.drive.create(server.drive.root_id, "data.bin", "file", size=size, content=content)
+    return server, descriptor, content
+
+
+def build_client(server):
+    return KdriveClient(
+        api_token="token", api_url=server.url, http_cache_size=0,
+        download_part_size=1000, download_threads=4, download_chunk_size=100
+    )
+
+
+def download(client, server, descriptor):
+    stream = io.BytesIO()
+    bytes_written = client.download_file_to_stream(
+        server.drive.drive_id, descriptor["id"], stream, size=descriptor["size"]
+    )
+    assert bytes_written == len(stream.getvalue())
+    return stream.getvalue()
+
+
+def test_parts_are_written_in_order(start_server):
+    server, descriptor, content = start_download_server(start_server)
+    assert download(build_client(server), server, descriptor) == content
+    assert server.request_counts[DOWNLOAD_ENDPOINT] == 10
+
+
+def test_server_ignoring_ranges_is_read_in_a_single_stream(start_server):
+    server, descriptor, content = start_download_server(start_server, supports_ranges=False)
+    assert download(build_client(server), server, descriptor) == content
+    assert server.request_counts[DOWNLOAD_ENDPOINT] == 1
+
+
+def test_part_cut_midway_is_resumed(start_server):
+    server, descriptor, content = start_download_server(start_server)
+    server.cut_downloads = 3
+    assert download(build_client(server), server, descriptor) == content
+    assert server.request_counts[DOWNLOAD_ENDPOINT] == 13
+
+
+def test_single_stream_cut_midway_is_resumed(start_server):
+    server, descriptor, content = start_download_server(start_server, size=1500)
+    server.cut_downloads = 1
+    assert download(build_client(server), server, descriptor) == content
+    assert server.request_counts[DOWNLOAD_ENDPOINT] == 2
+
+
+def test_part_cut_too_many_times_fails(start_server):
+    server, descriptor, content = start_download_server(start_server)
+    server.cut_downloads = 1000
+    with pytest.raises(Exception, match="could not be downloaded"):
+        download(build_client(server), server, descriptor)
+
+
+def test_single_stream_cut_too_many_times_fails(start_server):
+    server, descriptor, content = start_download_server(start_server, size=1500)
+    server.cut_downloads = 1000
+    with pytest.raises(Exception):
+        download(build_client(server), server, descriptor)
+    assert server.request_counts[DOWNLOAD_ENDPOINT] == MAX_RESUME_ATTEMPTS + 1
+
+
+def test_cut_stream_of_a_server_ignoring_ranges_is_not_resumed(start_server):
+    server, descriptor, content = start_download_server(start_server, supports_ranges=False)
+    server.cut_downloads = 1
+    with pytest.raises(Exception, match="cannot resume it"):
+        download(build_client(server), server, descriptor)
+    assert server.request_counts[DOWNLOAD_ENDPOINT] == 2
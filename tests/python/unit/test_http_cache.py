@@ -0,0 +1,54 @@
+import pytest
+
+from conftest import build_response
+from http_cache import HTTPCache
+from infomaniak_client import KdriveClient
+
+
+@pytest.fixture
+def server(start_server):
+    return start_server(max_page_size=40, depth=1, folders_per_folder=1, files_per_folder=90, file_size=10)
+
+
+def list_folder(client, server):
+    drive = server.drive
+    folder = drive.find_child(drive.root_id, "folder_000")
+    return list(client.get_next_folder_item(drive.drive_id, folder["id"]))
+
+
+def test_unchanged_listing_is_served_from_the_cached_pages(server):
+    # without the path cache, every listing goes to the server
+    client = KdriveClient(api_token="token", api_url=server.url, cache_ttl=0, page_size=40)
+    rows = list_folder(client, server)
+    assert server.not_modified_responses == 0
+    assert list_folder(client, server) == rows
+    assert server.not_modified_responses == 3
+    assert client.metrics.get_summary()["caches"]["http_cache"] == {"hits": 3, "misses": 3}
+
+
+def test_changed_listing_is_read_again(server):
+    client = KdriveClient(api_token="token", api_url=server.url, cache_ttl=0, page_size=40)
+    list_folder(client, server)
+    drive = server.drive
+    drive.create(drive.find_child(drive.root_id, "folder_000")["id"], "new.csv", "file", size=1)
+    rows = list_folder(client, server)
+    assert rows[-1]["name"] == "new.csv"
+    assert server.not_modified_responses == 2
+
+
+def test_responses_without_validators_are_not_kept():
+    http_cache = HTTPCache(max_size=100)
+    http_cache.store("plain", build_response(200, {"data": 1}))
+    http_cache.store("error", build_response(404, {"data": 1}, headers={"ETag": '"1"'}))
+    assert http_cache.get("plain") is None
+    assert http_cache.get("error") is None
+
+
+def test_least_recently_used_bodies_are_evicted_past_the_size():
+    http_cache = HTTPCache(max_size=100)
+    for key in ["first", "second", "third"]:
+        http_cache.store(key, build_response(200, {"data": "x" * 30}, headers={"ETag": '"{}"'.format(key)}))
+        http_cache.get("first")
+    assert http_cache.get("second") is None
+    assert http_cache.get("first")["etag"] == '"first"'
+    assert http_cache.size <= 100
@@ -0,0 +1,46 @@
+import io
+import pytest
+import requests
+from conftest import get_closed_port
+from http_session import build_session
+from infomaniak_client import KdriveClient
+
+httpx = pytest.importorskip("httpx")
+
+
+@pytest.fixture
+def server(start_server):
+    return start_server()
+
+
+def test_http2_session_uses_the_proxies(server):
+    session = build_session(None, use_http2=True)
+    url = "{}/3/drive/{}/files/{}".format(server.url, server.drive.drive_id, server.drive.root_id)
+    assert session.get(url).status_code == 200
+    closed_proxy = "http://127.0.0.1:{}".format(get_closed_port())
+    with pytest.raises(requests.ConnectionError):
+        session.get(url, proxies={"http": closed_proxy})
+
+
+def test_http2_session_uses_the_verify_and_cert_settings(server):
+    session = build_session(None, use_http2=True)
+    adapter = session.get_adapter(server.url)
+    url = "{}/3/drive/{}/files/{}".format(server.url, server.drive.drive_id, server.drive.root_id)
+    session.get(url)
+    session.get(url, verify=False)
+    assert len(adapter.clients) == 2
+    assert (False, None, None) in adapter.clients
+    session.close()
+    assert adapter.clients == {}
+
+
+def test_http2_download_cut_midway_is_resumed(start_server):
+    server = start_server(depth=1, folders_per_folder=1, files_per_folder=1, file_size=100000)
+    server.cut_downloads = 1
+    client = KdriveClient(api_token="http2-token", api_url=server.url, http_cache_size=0, use_http2=True)
+    drive = server.drive
+    descriptor = client.walk_path(drive.drive_id, drive.root_id, "folder_000/file_00000.csv")[1]
+    stream = io.BytesIO()
+    client.download_file_to_stream(drive.drive_id, descriptor["id"], stream)
+    assert stream.getvalue() == drive.get_content(descriptor["id"])
+    assert server.cut_downloads == 0
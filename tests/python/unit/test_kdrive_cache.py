@@ -0,0 +1,155 @@
+import time
+
+import pytest
+
+from infomaniak_client import KdriveClient
+from kdrive_cache import PathCache
+
+
+def build_descriptors(count, parent_id=1, first_id=100):
+    return [
+        {"id": first_id + index, "name": "file_{:05d}.csv".format(index), "type": "file", "parent_id": parent_id}
+        for index in range(count)
+    ]
+
+
+def test_listing_larger_than_the_cache_is_kept_whole():
+    path_cache = PathCache(max_size=50, ttl=60)
+    path_cache.add_listing("1000", 1, build_descriptors(90), time.time())
+    assert path_cache.lookup("1000", 1, "file_00001.csv") == (True, build_descriptors(90)[1])
+    assert path_cache.lookup("1000", 1, "file_00089.csv")[1]["id"] == 189
+    assert path_cache.lookup("1000", 1, "missing.csv") == (True, None)
+
+
+def test_listings_are_bounded_by_their_total_entries():
+    path_cache = PathCache(max_size=50, ttl=60, max_listing_entries=200)
+    path_cache.add_listing("1000", 1, build_descriptors(90, parent_id=1, first_id=100), time.time())
+    path_cache.add_listing("1000", 2, build_descriptors(90, parent_id=2, first_id=200), time.time())
+    assert path_cache.listings.size == 182
+    path_cache.add_listing("1000", 3, build_descriptors(90, parent_id=3, first_id=300), time.time())
+    assert path_cache.lookup("1000", 1, "missing.csv") == (False, None)
+    assert path_cache.lookup("1000", 3, "missing.csv") == (True, None)
+    assert path_cache.listings.size == 182
+    assert ("1000", "110") not in path_cache.listing_parents
+
+
+def test_listing_larger_than_the_bound_is_not_kept():
+    path_cache = PathCache(max_size=50, ttl=60, max_listing_entries=200)
+    path_cache.add_listing("1000", 1, build_descriptors(10), time.time())
+    path_cache.add_listing("1000", 2, build_descriptors(300, parent_id=2, first_id=1000), time.time())
+    assert path_cache.lookup("1000", 2, "missing.csv") == (False, None)
+    assert path_cache.lookup("1000", 1, "missing.csv") == (True, None)
+    assert not path_cache.listing_parents.get(("1000", "1000"))
+    for descriptor in build_descriptors(189, parent_id=1, first_id=500):
+        descriptor["name"] = "new_" + descriptor["name"]
+        path_cache.add_item("1000", 1, descriptor)
+    assert path_cache.listings.size == 200
+    path_cache.add_item("1000", 1, {"id": 999, "name": "one_too_many.csv"})
+    assert path_cache.lookup("1000", 1, "missing.csv") == (False, None)
+    assert path_cache.listings.size == 0
+
+
+def test_listing_expires_from_when_it_started():
+    path_cache = PathCache(max_size=50, ttl=1)
+    path_cache.add_listing("1000", 1, build_descriptors(3), time.time() - 2)
+    assert path_cache.lookup("1000", 1, "file_00001.csv") == (False, None)
+    assert path_cache.lookup("1000", 1, "missing.csv") == (False, None)
+
+
+def test_invalidated_child_drops_the_listing_of_its_folder():
+    path_cache = PathCache(max_size=50, ttl=60)
+    path_cache.add_listing("1000", 1, build_descriptors(90), time.time())
+    path_cache.invalidate_item("1000", 150)
+    assert path_cache.lookup("1000", 1, "missing.csv") == (False, None)
+
+
+@pytest.fixture
+def server(start_server):
+    return start_server(max_page_size=40, depth=1, folders_per_folder=2, files_per_folder=90, file_size=10)
+
+
+def test_file_of_a_folder_larger_than_the_cache_is_found(server):
+    client = KdriveClient(api_token="token", api_url=server.url, cache_max_size=50, http_cache_size=0)
+    drive = server.drive
+    folder = client.walk_path(drive.drive_id, drive.root_id, "folder_001")[1]
+    assert len(list(client.get_next_folder_item(drive.drive_id, folder["id"]))) == 90
+    item = client.get_item(drive.drive_id, drive.root_id, "folder_001/file_00001.csv", "folder_001/file_00001.csv")
+    assert item.exists()
+
+
+def test_folder_too_large_to_be_cached_is_not_kept(server):
+    client = KdriveClient(api_token="token", api_url=server.url, cache_max_listing_entries=50, http_cache_size=0)
+    drive = server.drive
+    folder = client.walk_path(drive.drive_id, drive.root_id, "folder_001")[1]
+    client.path_cache.clear()
+    assert len(list(client.get_next_folder_item(drive.drive_id, folder["id"]))) == 90
+    assert len(client.path_cache.listings) == 0
+    assert len(client.path_cache.items) == 49
+    assert client.path_cache.lookup(drive.drive_id, folder["id"], "file_00048.csv")[0]
+    assert not client.path_cache.lookup(drive.drive_id, folder["id"], "file_00049.csv")[0]
+    item = client.get_item(drive.drive_id, drive.root_id, "folder_001/file_00089.csv", "folder_001/file_00089.csv")
+    assert item.exists()
+
+
+def test_file_of_a_slowly_listed_folder_is_found(server):
+    client = KdriveClient(api_token="token", api_url=server.url, cache_ttl=1, known_paths_ttl=0, http_cache_size=0)
+    drive = server.drive
+    folder = client.walk_path(drive.drive_id, drive.root_id, "folder_001")[1]
+    for _ in client.get_next_folder_item(drive.drive_id, folder["id"]):
+        time.sleep(0.6 / 90)
+    time.sleep(0.6)
+    item = client.get_item(drive.drive_id, drive.root_id, "folder_001/file_00001.csv", "folder_001/file_00001.csv")
+    assert item.exists()
+
+
+def test_known_paths_below_a_moved_folder_are_forgotten(server):
+    client = KdriveClient(api_token="token", api_url=server.url, http_cache_size=0)
+    drive = server.drive
+    path = "folder_000/file_00001.csv"
+    assert client.get_item(drive.drive_id, drive.root_id, path, path).exists()
+    folder = client.get_item(drive.drive_id, drive.root_id, "folder_000", "folder_000")
+    client.move_item(drive.drive_id, folder.get_file_id(), drive.root_id, new_name="renamed")
+    assert not client.get_item(drive.drive_id, drive.root_id, path, path).exists()
+    assert client.get_item(drive.drive_id, drive.root_id, "renamed/file_00001.csv", path).exists()
+
+
+def test_known_path_of_a_file_whose_folder_was_renamed_elsewhere_is_checked(server):
+    client = KdriveClient(api_token="token", api_url=server.url, cache_ttl=0, http_cache_size=0)
+    drive = server.drive
+    path = "folder_000/file_00001.csv"
+    assert client.get_item(drive.drive_id, drive.root_id, path, path).exists()
+    folder = client.get_item(drive.drive_id, drive.root_id, "folder_000", "folder_000")
+    drive.rename(folder.get_file_id(), "renamed")
+    assert not client.get_item(drive.drive_id, drive.root_id, path, path).exists()
+
+
+def test_known_paths_below_a_path_are_forgotten():
+    path_cache = PathCache(max_size=50, ttl=60)
+    for path, item_id in [("a", 2), ("a/b", 3), ("a/b/c.csv", 4), ("ab", 5)]:
+        path_cache.add_known_path("1000", 1, path, item_id)
+    path_cache.invalidate_item("1000", 2)
+    assert path_cache.get_known_path("1000", 1, "a/b/c.csv") is None
+    assert path_cache.get_known_path("1000", 1, "ab") == 5
+
+
+def test_known_path_is_checked_in_one_request(start_server):
+    server = start_server(depth=5, folders_per_folder=1, files_per_folder=1, file_size=10)
+    client = KdriveClient(api_token="token", api_url=server.url, cache_ttl=0, http_cache_size=0)
+    drive = server.drive
+    path = "folder_000/folder_000/folder_000/folder_000/file_00000.csv"
+    assert client.get_item(drive.drive_id, drive.root_id, path, path).exists()
+    assert client.get_item(drive.drive_id, drive.root_id, "folder_000", "folder_000").exists()
+    server.reset_counts()
+    assert client.get_item(drive.drive_id, drive.root_id, path, path).exists()
+    assert server.get_total_requests() == 1
+
+
+def test_lookup_stops_at_the_page_holding_the_item(start_server):
+    server = start_server(max_page_size=20, depth=1, folders_per_folder=1, files_per_folder=100, file_size=10)
+    client = KdriveClient(api_token="token", api_url=server.url, page_size=20, http_cache_size=0)
+    drive = server.drive
+    folder = client.walk_path(drive.drive_id, drive.root_id, "folder_000")[1]
+    server.reset_counts()
+    assert client.find_item_in_file_id(drive.drive_id, folder["id"], "file_00001.csv")["name"] == "file_00001.csv"
+    time.sleep(0.2)
+    assert server.get_total_requests() == 1
@@ -0,0 +1,121 @@
+import time
+
+import pytest
+
+from infomaniak_client import KdriveClient
+from metadata_index import MetadataIndex
+
+
+def build_children(parent_id, first_id, count, node_type="file", last_modified_at=1600000000):
+    return [
+        {
+            "id": first_id + index, "name": "item_{}".format(index), "type": node_type,
+            "parent_id": parent_id, "last_modified_at": last_modified_at
+        }
+        for index in range(count)
+    ]
+
+
+@pytest.fixture
+def metadata_index(tmp_path):
+    metadata_index = MetadataIndex(str(tmp_path / "index.sqlite"))
+    yield metadata_index
+    metadata_index.close()
+
+
+def test_children_are_served_until_their_folder_is_marked_dirty(metadata_index):
+    children = build_children(1, 100, 3)
+    metadata_index.replace_children("1000", 1, children)
+    assert metadata_index.get_children("1000", 1) == children
+    metadata_index.mark_folder_dirty("1000", 1)
+    assert metadata_index.get_children("1000", 1) is None
+    metadata_index.replace_children("1000", 1, children[:2])
+    assert metadata_index.get_children("1000", 1) == children[:2]
+
+
+def test_invalidated_item_marks_its_parent_and_itself_dirty(metadata_index):
+    metadata_index.replace_children("1000", 1, build_children(1, 10, 2, node_type="dir"))
+    metadata_index.replace_children("1000", 10, build_children(10, 100, 3))
+    metadata_index.replace_children("1000", 11, build_children(11, 200, 3))
+    metadata_index.invalidate_item("1000", 10)
+    assert metadata_index.get_children("1000", 1) is None
+    assert metadata_index.get_children("1000", 10) is None
+    assert metadata_index.get_children("1000", 11) is not None
+
+
+def test_sub_folder_modified_since_it_was_indexed_is_marked_dirty(metadata_index):
+    metadata_index.replace_children("1000", 1, build_children(1, 10, 2, node_type="dir"))
+    metadata_index.replace_children("1000", 10, build_children(10, 100, 3))
+    metadata_index.replace_children("1000", 11, build_children(11, 200, 3))
+    folders = build_children(1, 10, 2, node_type="dir")
+    folders[0]["last_modified_at"] += 60
+    metadata_index.replace_children("1000", 1, folders)
+    assert metadata_index.get_children("1000", 10) is None
+    assert metadata_index.get_children("1000", 11) is not None
+
+
+def test_folders_listed_too_long_ago_are_stale(tmp_path):
+    metadata_index = MetadataIndex(str(tmp_path / "index.sqlite"), max_age=1)
+    metadata_index.replace_children("1000", 1, build_children(1, 100, 3))
+    metadata_index.connection.execute("UPDATE folders SET listed_at=?", (time.time() - 2,))
+    assert metadata_index.get_children("1000", 1) is None
+    metadata_index.close()
+
+
+@pytest.fixture
+def server(start_server):
+    server = start_server(depth=1, folders_per_folder=2, files_per_folder=3, file_size=10)
+    # so that the refreshes only see the changes made by the tests
+    server.drive.activities = []
+    return server
+
+
+@pytest.fixture
+def client(server, metadata_index):
+    return KdriveClient(
+        api_token="token", api_url=server.url, cache_ttl=0, http_cache_size=0, metadata_index=metadata_index
+    )
+
+
+def index_folders(client, server):
+    drive = server.drive
+    client.refresh_metadata_index(drive.drive_id)
+    folder_ids = [drive.find_child(drive.root_id, name)["id"] for name in ["folder_000", "folder_001"]]
+    for folder_id in folder_ids:
+        list(client.get_next_folder_item(drive.drive_id, folder_id))
+    return folder_ids
+
+
+def test_folder_written_to_is_listed_again(client, server, metadata_index):
+    drive = server.drive
+    folder_id, other_folder_id = index_folders(client, server)
+    client.write_file_content(drive.drive_id, folder_id, "/folder_000/new.csv", b"data")
+    assert metadata_index.get_children(drive.drive_id, folder_id) is None
+    assert metadata_index.get_children(drive.drive_id, other_folder_id) is not None
+    assert "new.csv" in [row["name"] for row in client.get_next_folder_item(drive.drive_id, folder_id)]
+    assert metadata_index.get_children(drive.drive_id, folder_id) is not None
+
+
+def test_folder_changed_elsewhere_is_marked_dirty_by_the_activity_feed(client, server, metadata_index):
+    drive = server.drive
+    folder_id, other_folder_id = index_folders(client, server)
+    client.refresh_metadata_index(drive.drive_id)
+    assert metadata_index.get_children(drive.drive_id, folder_id) is not None
+    drive.create(folder_id, "new.csv", "file", size=1)
+    client.refresh_metadata_index(drive.drive_id)
+    assert metadata_index.get_children(drive.drive_id, folder_id) is None
+    assert metadata_index.get_children(drive.drive_id, other_folder_id) is not None
+
+
+def test_index_is_dropped_when_the_activity_feed_fails(client, server, metadata_index, monkeypatch):
+    drive = server.drive
+    folder_id, other_folder_id = index_folders(client, server)
+
+    def fail(drive_id, from_date):
+        raise Exception("feed not available")
+        yield
+
+    monkeypatch.setattr(client, "get_next_activity", fail)
+    client.refresh_metadata_index(drive.drive_id)
+    assert metadata_index.get_children(drive.drive_id, folder_id) is None
+    assert metadata_index.get_children(drive.drive_id, other_folder_id) is None
@@ -0,0 +1,70 @@
+import io
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+
+from infomaniak_client import KdriveClient
+from metrics import Metrics
+
+DOWNLOAD_ENDPOINT = "GET /2/drive/{id}/files/{id}/download"
+
+
+def test_operations_of_concurrent_threads_are_kept_apart():
+    metrics = Metrics()
+    both_started = threading.Barrier(2)
+
+    def run(operation_name, url):
+        with metrics.operation(operation_name):
+            both_started.wait()
+            metrics.record_request("GET", url, 200, 0.01)
+            both_started.wait()
+
+    threads = [
+        threading.Thread(target=run, args=("read", "http://kdrive/2/drive/1/files/2/download")),
+        threading.Thread(target=run, args=("stat", "http://kdrive/3/drive/1/files/2"))
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    operations = metrics.get_summary()["operations"]
+    assert operations["read"]["endpoints"] == {DOWNLOAD_ENDPOINT: 1}
+    assert operations["stat"]["endpoints"] == {"GET /3/drive/{id}/files/{id}": 1}
+
+
+def test_work_handed_to_a_worker_counts_for_the_caller_operation():
+    metrics = Metrics()
+    record = lambda: metrics.record_request("GET", "http://kdrive/3/drive/1/files/2", 200, 0.01)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        with metrics.operation("write"):
+            executor.submit(metrics.with_current_operation(record)).result()
+            executor.submit(record).result()
+        assert executor.submit(lambda: metrics.current_operation).result() is None
+    assert metrics.get_summary()["operations"]["write"]["requests"] == 1
+
+
+@pytest.fixture
+def server(start_server):
+    return start_server(depth=1, folders_per_folder=1, files_per_folder=1, file_size=100000)
+
+
+@pytest.mark.parametrize("download_part_size", [1000000, 10000])
+def test_streamed_downloads_count_for_the_download_endpoint(server, download_part_size):
+    client = KdriveClient(
+        api_token="token",
+        api_url=server.url,
+        http_cache_size=0,
+        download_part_size=download_part_size,
+        download_threads=4
+    )
+    drive = server.drive
+    descriptor = client.walk_path(drive.drive_id, drive.root_id, "folder_000/file_00000.csv")[1]
+    stream = io.BytesIO()
+    with client.metrics.operation("read"):
+        client.download_file_to_stream(drive.drive_id, descriptor["id"], stream, size=descriptor["size"])
+    summary = client.get_metrics_summary()
+    download_requests = summary["endpoints"][DOWNLOAD_ENDPOINT]["count"]
+    assert len(stream.getvalue()) == 100000
+    assert summary["endpoints"][DOWNLOAD_ENDPOINT]["bytes_in"] == 100000
+    assert summary["operations"]["read"]["endpoints"] == {DOWNLOAD_ENDPOINT: download_requests}
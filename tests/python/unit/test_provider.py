@@ -0,0 +1,73 @@
+import io
+
+import pytest
+
+import infomaniak_client
+from infomaniak_client import MAX_REMEMBERED_CHILDREN
+from run_benchmarks import load_provider_class
+
+
+@pytest.fixture
+def server(start_server):
+    return start_server()
+
+
+@pytest.fixture
+def build_provider(server, monkeypatch):
+    # A provider on a fake kDrive, with the given settings
+    monkeypatch.setattr(infomaniak_client, "DEFAULT_API_URL", server.url)
+    provider_class = load_provider_class()
+    providers = []
+
+    def build(**config):
+        config.update({
+            "api_token": {"api_token": "token"},
+            "root_url": "https://ksuite.infomaniak.com/kdrive/app/drive/{}/files/{}".format(
+                server.drive.drive_id, server.drive.root_id
+            ),
+            "http_cache_size": 0,
+            "upload_chunk_size": 1
+        })
+        provider = provider_class("", config, {})
+        providers.append(provider)
+        return provider
+
+    yield build
+    for provider in providers:
+        provider.close()
+
+
+@pytest.mark.parametrize("async_upload_threads", [0, 4])
+@pytest.mark.parametrize("size", [1000, 2500000])
+def test_modification_time_is_set_on_the_file_just_written(build_provider, async_upload_threads, size):
+    provider = build_provider(async_upload_threads=async_upload_threads)
+    provider.write("folder/data.csv", io.BytesIO(b"x" * size))
+    assert provider.set_last_modified("folder/data.csv", 1600000000000)
+    assert provider.stat("folder/data.csv") == {
+        "path": "/folder/data.csv",
+        "size": size,
+        "lastModified": 1600000000000,
+        "isDirectory": False
+    }
+
+
+def test_uploads_run_in_the_providers_thread_by_default(server, build_provider):
+    provider = build_provider()
+    assert provider.upload_queue.executor is None
+    provider.write("data.csv", io.BytesIO(b"x" * 10))
+    provider.sync()
+    assert server.drive.find_child(server.drive.root_id, "data.csv")["size"] == 10
+
+
+def test_browsing_a_large_folder_remembers_the_paths_of_its_first_children_only(server, build_provider):
+    drive = server.drive
+    folder = drive.create(drive.root_id, "large", "dir")
+    for index in range(MAX_REMEMBERED_CHILDREN + 500):
+        drive.create(folder["id"], "file_{:05d}.csv".format(index), "file", size=1, content=b"x")
+    provider = build_provider()
+    children = provider.browse("large")["children"]
+    assert len(children) == MAX_REMEMBERED_CHILDREN + 500
+    assert children[-1]["fullPath"] == "large/file_{:05d}.csv".format(MAX_REMEMBERED_CHILDREN + 499)
+    known_paths = provider.client.path_cache.known_paths
+    assert len(known_paths) == MAX_REMEMBERED_CHILDREN + 1
+    assert provider.stat("large/file_00000.csv")["size"] == 1
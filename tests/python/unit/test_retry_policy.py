@@ -0,0 +1,73 @@
+import io
+import socket
+import time
+import pytest
+import requests
+from api_client import APIClient
+from conftest import FakeSession, build_response, get_closed_port
+from infomaniak_client import KdriveClient
+from retry_policy import RetryPolicy, is_raised_before_sending
+
+
+def test_post_is_not_retried_on_server_errors():
+    policy = RetryPolicy(max_retries=3)
+    for status_code in [500, 502, 503, 504]:
+        assert not policy.should_retry(1, method="POST", response=build_response(status_code))
+        assert policy.should_retry(1, method="GET", response=build_response(status_code))
+        assert policy.should_retry(1, method="POST", response=build_response(status_code), idempotent=True)
+
+
+def test_post_is_retried_when_the_server_did_not_process_it():
+    policy = RetryPolicy(max_retries=3)
+    assert policy.should_retry(1, method="POST", response=build_response(429, headers={"Retry-After": "1"}))
+    assert policy.should_retry(1, method="POST", response=build_response(503, headers={"Retry-After": "1"}))
+    assert not policy.should_retry(1, method="POST", response=build_response(429))
+    assert not policy.should_retry(1, method="POST", response=build_response(502, headers={"Retry-After": "1"}))
+
+
+def test_post_is_retried_on_errors_raised_before_sending():
+    policy = RetryPolicy(max_retries=3)
+    with pytest.raises(requests.ConnectionError) as connection_error:
+        requests.post("http://127.0.0.1:{}/".format(get_closed_port()), data=b"data")
+    assert is_raised_before_sending(connection_error.value)
+    assert policy.should_retry(1, method="POST", error=connection_error.value)
+    read_error = requests.ConnectionError("Connection reset by peer")
+    assert not policy.should_retry(1, method="POST", error=read_error)
+    assert policy.should_retry(1, method="GET", error=read_error)
+
+
+@pytest.mark.parametrize("method", ["GET", "POST"])
+def test_client_retries_post_only_when_opted_in(method):
+    session = FakeSession(lambda method, url: build_response(502))
+    client = APIClient("http://kdrive", None, session=session, retry_policy=RetryPolicy(max_retries=2, backoff_base=0))
+    client.request(method, "", raw=True)
+    assert len(session.requests) == (3 if method == "GET" else 1)
+    session.requests = []
+    client.post("", raw=True, idempotent=True)
+    assert len(session.requests) == 3
+
+
+def test_stalled_request_times_out_and_is_retried():
+    with socket.socket() as stalled_socket:
+        stalled_socket.bind(("127.0.0.1", 0))
+        stalled_socket.listen(8)
+        url = "http://127.0.0.1:{}/".format(stalled_socket.getsockname()[1])
+        client = APIClient(
+            url, None, retry_policy=RetryPolicy(max_retries=1, backoff_base=0), timeout=(1, 0.2)
+        )
+        start = time.time()
+        with pytest.raises(Exception, match="timed out"):
+            client.get("", url=url)
+        assert time.time() - start < 5
+
+
+def test_resent_uploads_add_versions_instead_of_failing(start_server):
+    server = start_server()
+    drive = server.drive
+    client = KdriveClient(api_token="token", api_url=server.url, http_cache_size=0, upload_chunk_size=1000)
+    for data in [b"first", b"second"]:
+        client.write_file_content(drive.drive_id, drive.root_id, "/small.csv", data)
+    for data in [b"1" * 2500, b"2" * 2500]:
+        client.upload_stream(drive.drive_id, drive.root_id, "/big.csv", io.BytesIO(data))
+    assert drive.contents[drive.find_child(drive.root_id, "small.csv")["id"]] == b"second"
+    assert drive.contents[drive.find_child(drive.root_id, "big.csv")["id"]] == b"2" * 2500
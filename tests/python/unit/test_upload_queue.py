@@ -0,0 +1,96 @@
+import io
+import threading
+import time
+
+import pytest
+
+from infomaniak_client import KdriveClient
+from upload_queue import UploadQueue
+
+
+class Drive(object):
+    # Failing uploads wait for failures_allowed, so that they fail after they were submitted
+    def __init__(self, failing_keys=()):
+        self.failing_keys = failing_keys
+        self.failures_allowed = threading.Event()
+        self.uploaded_keys = []
+        self.lock = threading.Lock()
+
+    def upload(self, key):
+        if key in self.failing_keys:
+            self.failures_allowed.wait()
+            raise Exception("upload of {} failed".format(key))
+        with self.lock:
+            self.uploaded_keys.append(key)
+
+
+def stage(queue, drive, key):
+    queue.stage(key, 1, drive.upload, key)
+
+
+def fail_uploads(queue, drive):
+    drive.failures_allowed.set()
+    while not queue.errors:
+        time.sleep(0.01)
+
+
+def test_staged_uploads_are_kept_when_an_earlier_one_failed():
+    drive = Drive(failing_keys=["a"])
+    queue = UploadQueue(max_workers=1)
+    stage(queue, drive, "a")
+    stage(queue, drive, "b")
+    fail_uploads(queue, drive)
+    with pytest.raises(Exception, match="a failed"):
+        stage(queue, drive, "c")
+    queue.close()
+    assert sorted(drive.uploaded_keys) == ["b", "c"]
+
+
+def test_submitted_upload_is_queued_when_an_earlier_one_failed():
+    drive = Drive(failing_keys=["a"])
+    queue = UploadQueue(max_workers=1)
+    queue.submit("a", 1, drive.upload, "a")
+    fail_uploads(queue, drive)
+    with pytest.raises(Exception, match="a failed"):
+        queue.submit("b", 1, drive.upload, "b")
+    queue.close()
+    assert drive.uploaded_keys == ["b"]
+
+
+def test_flush_raises_the_errors_of_background_uploads():
+    drive = Drive(failing_keys=["b"])
+    queue = UploadQueue(max_workers=2)
+    stage(queue, drive, "a")
+    stage(queue, drive, "b")
+    drive.failures_allowed.set()
+    with pytest.raises(Exception, match="b failed"):
+        queue.flush()
+    assert drive.uploaded_keys == ["a"]
+    queue.close()
+
+
+def test_without_workers_staged_uploads_run_in_the_callers_thread():
+    uploads = []
+    upload = lambda key, last_modified_at=None: uploads.append((key, last_modified_at, threading.current_thread()))
+    queue = UploadQueue(max_workers=0)
+    queue.stage("a", 1, upload, "a")
+    assert queue.update_staged("a", last_modified_at=1600000000)
+    queue.stage("b", 1, upload, "b")
+    assert uploads == [("a", 1600000000, threading.current_thread())]
+    queue.close()
+    assert uploads[1] == ("b", None, threading.current_thread())
+
+
+@pytest.mark.parametrize("size", [500, 2500])
+def test_modification_time_is_added_to_the_last_request_of_an_upload(start_server, size):
+    server = start_server()
+    drive = server.drive
+    client = KdriveClient(api_token="token", api_url=server.url, http_cache_size=0, upload_chunk_size=1000)
+    function, args = client.prepare_upload(drive.drive_id, drive.root_id, "/data.csv", io.BytesIO(b"x" * size))
+    assert drive.find_child(drive.root_id, "data.csv") is None
+    queue = UploadQueue(max_workers=0)
+    queue.stage("/data.csv", 0, function, *args)
+    assert queue.update_staged("/data.csv", last_modified_at=1600000000)
+    uploaded_file = drive.find_child(drive.root_id, "data.csv")
+    assert uploaded_file["last_modified_at"] == 1600000000
+    assert drive.contents[uploaded_file["id"]] == b"x" * size